@@ -0,0 +1,339 @@
+"""
+In-memory Supabase Client
+Подмена клиента supabase-py для бенчмарков и тестов: таблицы хранятся в DataFrame,
+запросы поддерживают используемое приложением подмножество PostgREST
+(select, eq/neq/in_/gt/gte/lt/lte, order, range, limit, insert, upsert, rpc).
+"""
+import threading
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+_COMPARATORS = {
+    'eq': lambda s, v: s == v,
+    'neq': lambda s, v: s != v,
+    'gt': lambda s, v: s > v,
+    'gte': lambda s, v: s >= v,
+    'lt': lambda s, v: s < v,
+    'lte': lambda s, v: s <= v,
+    'in': lambda s, v: s.isin(list(v)),
+}
+
+
+def _compare(series: pd.Series, op: str, value) -> np.ndarray:
+    """Маска фильтра; NULL не удовлетворяет ни одному условию, как в SQL."""
+    valid = series.notna().to_numpy()
+    mask = np.zeros(len(series), dtype=bool)
+    mask[valid] = _COMPARATORS[op](series[valid], value).to_numpy(dtype=bool)
+    return mask
+
+
+class FakeResponse:
+    def __init__(self, data: list, count: int = None):
+        self.data = data
+        self.count = count
+
+
+class FakeQuery:
+    """Построитель запроса к одной таблице; методы возвращают self, как в postgrest-py."""
+
+    def __init__(self, client: 'FakeSupabaseClient', table_name: str):
+        self.client = client
+        self.table_name = table_name
+        self.operation = 'select'
+        self.columns = None
+        self.filters = []
+        self.order_by = []
+        self.offset = 0
+        self.limit_rows = None
+        self.count_mode = None
+        self.payload = None
+        self.on_conflict = None
+        self.ignore_duplicates = False
+
+    # --- SELECT -------------------------------------------------------------
+
+    def select(self, query: str = '*', count: str = None, **kwargs) -> 'FakeQuery':
+        self.count_mode = count
+        if query.strip() != '*':
+            self.columns = []
+            for part in query.split(','):
+                alias, _, column = part.strip().rpartition(':')
+                column = column.strip().strip('"')
+                self.columns.append((alias.strip().strip('"') or column, column))
+        return self
+
+    def _filter(self, op: str, column: str, value) -> 'FakeQuery':
+        self.filters.append((op, column, value))
+        return self
+
+    def eq(self, column, value): return self._filter('eq', column, value)
+    def neq(self, column, value): return self._filter('neq', column, value)
+    def gt(self, column, value): return self._filter('gt', column, value)
+    def gte(self, column, value): return self._filter('gte', column, value)
+    def lt(self, column, value): return self._filter('lt', column, value)
+    def lte(self, column, value): return self._filter('lte', column, value)
+    def in_(self, column, values): return self._filter('in', column, values)
+
+    def order(self, column: str, desc: bool = False, **kwargs) -> 'FakeQuery':
+        self.order_by.append((column, not desc))
+        return self
+
+    def range(self, start: int, end: int) -> 'FakeQuery':
+        self.offset = start
+        self.limit_rows = end - start + 1
+        return self
+
+    def limit(self, size: int) -> 'FakeQuery':
+        self.limit_rows = size
+        return self
+
+    # --- WRITE --------------------------------------------------------------
+
+    def insert(self, records, **kwargs) -> 'FakeQuery':
+        self.operation = 'insert'
+        self.payload = records if isinstance(records, list) else [records]
+        return self
+
+    def upsert(self, records, on_conflict: str = None, ignore_duplicates: bool = False, **kwargs) -> 'FakeQuery':
+        self.operation = 'upsert'
+        self.payload = records if isinstance(records, list) else [records]
+        self.on_conflict = on_conflict
+        self.ignore_duplicates = ignore_duplicates
+        return self
+
+    def execute(self) -> FakeResponse:
+        return self.client._execute(self)
+
+
+class FakeSupabaseClient:
+    """
+    Клиент с таблицами в памяти.
+
+    Args:
+        tables: {имя таблицы: DataFrame в формате БД}
+        unique: {имя таблицы: колонки уникального ограничения}
+        latency: Задержка на запрос в секундах (имитация сети)
+        max_rows: Ограничение PostgREST на число строк в ответе
+        generated: {имя таблицы: {колонка: выражение от строк}} — колонки GENERATED ALWAYS AS ... STORED
+    """
+
+    def __init__(self, tables: Dict[str, pd.DataFrame], unique: Dict[str, List[str]] = None,
+                 latency: float = 0.0, max_rows: int = 1000,
+                 generated: Dict[str, Dict[str, Callable[[pd.DataFrame], pd.Series]]] = None):
+        self.generated = generated or {}
+        self.tables = {name: self._with_generated(name, self._to_storage(df)) for name, df in tables.items()}
+        self.unique = unique or {}
+        self.latency = latency
+        self.max_rows = max_rows
+        self.requests = []
+        self._lock = threading.Lock()
+        self.rpc_handlers: Dict[str, Callable[[dict], list]] = {}
+
+    @staticmethod
+    def _to_storage(df: pd.DataFrame) -> pd.DataFrame:
+        """Хранение в виде, близком к JSON-ответу: даты — ISO-строки, category — object."""
+        df = df.copy()
+        for col in df.columns:
+            if pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = df[col].map(lambda v: v.isoformat() if pd.notna(v) else None)
+            elif isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(object)
+        return df.reset_index(drop=True)
+
+    def _with_generated(self, table_name: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Пересчет сгенерированных колонок (GENERATED ALWAYS AS ... STORED)."""
+        for column, expression in self.generated.get(table_name, {}).items():
+            df[column] = expression(df) if not df.empty else pd.Series(dtype=object)
+        return df
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: dict = None) -> 'FakeRpc':
+        return FakeRpc(self, name, params or {})
+
+    def _execute(self, query: FakeQuery) -> FakeResponse:
+        if self.latency:
+            time.sleep(self.latency)
+        # Запросы из разных потоков применяются по одному, как транзакции в БД
+        with self._lock:
+            if query.operation == 'select':
+                response = self._select(query)
+            else:
+                response = self._write(query)
+            self.requests.append((query.table_name, query.operation, len(response.data)))
+        return response
+
+    def _select(self, query: FakeQuery) -> FakeResponse:
+        df = self.tables.get(query.table_name, pd.DataFrame())
+        referenced = [column for _, column, _ in query.filters] + [column for column, _ in query.order_by]
+        referenced += [column for _, column in query.columns or []]
+        unknown = [column for column in referenced if column not in df.columns]
+        if unknown and not df.empty:
+            # Как Postgres/PostgREST для несуществующей колонки
+            raise Exception({'code': '42703', 'message': f'column {query.table_name}.{unknown[0]} does not exist'})
+        filters = []
+        for op, column, value in query.filters:
+            # Нижняя граница по упорядоченному числовому ключу — срез, как поиск по индексу в БД
+            key = df[column] if op in ('gt', 'gte') else None
+            if key is not None and pd.api.types.is_numeric_dtype(key) and key.is_monotonic_increasing:
+                df = df.iloc[key.searchsorted(value, side='right' if op == 'gt' else 'left'):]
+            else:
+                filters.append((op, column, value))
+        mask = np.ones(len(df), dtype=bool)
+        for op, column, value in filters:
+            mask &= _compare(df[column], op, value)
+        result = df[mask] if filters else df
+        total = len(result)
+
+        # Таблица с последовательным id уже упорядочена — сортировка не нужна (как индекс в БД)
+        already_sorted = (
+            len(query.order_by) == 1 and query.order_by[0][1] and result[query.order_by[0][0]].is_monotonic_increasing
+        )
+        if query.order_by and not already_sorted:
+            result = result.sort_values(
+                [col for col, _ in query.order_by], ascending=[asc for _, asc in query.order_by], kind='stable'
+            )
+        limit = min(query.limit_rows or self.max_rows, self.max_rows)
+        result = result.iloc[query.offset:query.offset + limit]
+
+        if query.columns is not None:
+            result = pd.DataFrame({alias: result[column] for alias, column in query.columns})
+
+        data = result.astype(object).where(result.notna(), None).to_dict('records')
+        return FakeResponse(data, count=total if query.count_mode else None)
+
+    def _write(self, query: FakeQuery) -> FakeResponse:
+        incoming = pd.DataFrame(query.payload)
+        table = self.tables.get(query.table_name, pd.DataFrame())
+        updated = None
+        if query.table_name in self.generated:
+            incoming = self._with_generated(query.table_name, incoming.copy())
+        if query.operation == 'upsert' and query.on_conflict:
+            keys = [col.strip().strip('"') for col in query.on_conflict.split(',')]
+            unknown = [col for col in keys if col not in incoming.columns or (not table.empty and col not in table.columns)]
+            if unknown:
+                raise Exception({'code': '42703', 'message': f'column "{unknown[0]}" does not exist'})
+            if query.table_name in self.unique and keys != list(self.unique[query.table_name]):
+                raise Exception({'code': '42P10', 'message': 'there is no unique or exclusion constraint '
+                                                             'matching the ON CONFLICT specification'})
+        else:
+            keys = self.unique.get(query.table_name)
+
+        if keys and not table.empty:
+            existing = pd.MultiIndex.from_frame(table[keys].astype(str))
+            incoming_keys = pd.MultiIndex.from_frame(incoming[keys].astype(str))
+            conflict = incoming_keys.isin(existing)
+            if conflict.any():
+                if query.operation == 'insert':
+                    raise Exception('duplicate key value violates unique constraint')
+                if not query.ignore_duplicates:
+                    # ON CONFLICT DO UPDATE: обновляются только переданные колонки
+                    updates = incoming[conflict].drop_duplicates(subset=keys, keep='last')
+                    table = table.astype({col: object for col in updates.columns if col in table.columns})
+                    positions = existing.get_indexer(pd.MultiIndex.from_frame(updates[keys].astype(str)))
+                    for col in updates.columns:
+                        table.loc[table.index[positions], col] = updates[col].to_numpy()
+                    for col, expression in self.generated.get(query.table_name, {}).items():
+                        table.loc[table.index[positions], col] = expression(table.iloc[positions]).to_numpy()
+                    updated = updates
+                incoming = incoming[~conflict]
+
+        if 'id' in table.columns and 'id' not in incoming.columns and not incoming.empty:
+            start = int(table['id'].max()) + 1 if not table.empty else 1
+            incoming = incoming.assign(id=np.arange(start, start + len(incoming)))
+
+        self.tables[query.table_name] = pd.concat([table, incoming], ignore_index=True) if not incoming.empty else table
+        returned = pd.concat([updated, incoming], ignore_index=True) if updated is not None else incoming
+        data = returned.astype(object).where(returned.notna(), None).to_dict('records')
+        return FakeResponse(data)
+
+
+class FakeRpc:
+    def __init__(self, client: FakeSupabaseClient, name: str, params: dict):
+        self.client = client
+        self.name = name
+        self.params = params
+
+    def execute(self) -> FakeResponse:
+        if self.client.latency:
+            time.sleep(self.client.latency)
+        handler = self.client.rpc_handlers.get(self.name)
+        if handler is None:
+            # Как PostgREST, когда функция не создана в БД
+            raise Exception({'code': 'PGRST202', 'message': f'Could not find the function public.{self.name}'})
+        data = handler(self.params)
+        self.client.requests.append((f"rpc:{self.name}", 'rpc', len(data) if isinstance(data, list) else 1))
+        return FakeResponse(data)
+
+
+def email_key(source: str) -> Callable[[pd.DataFrame], pd.Series]:
+    """Выражение сгенерированной колонки email_key: lower(btrim(source)), NULL остается NULL."""
+    def expression(df: pd.DataFrame) -> pd.Series:
+        values = df[source]
+        return values.where(values.isna(), values.astype(str).str.strip().str.lower())
+    return expression
+
+
+def _grade_numbers(series: pd.Series) -> pd.Series:
+    """Аналог final_grade_value: текстовые и числовые оценки в float, прочее — NaN."""
+    return pd.to_numeric(series.astype(str).str.strip().str.replace(',', '.', regex=False), errors='coerce')
+
+
+def merge_final_grades_handler(client: FakeSupabaseClient, table_name: str = 'final_grades') -> Callable[[dict], int]:
+    """
+    Заменитель функции БД merge_final_grades (sql/function_merge_final_grades.sql)
+    для client.rpc_handlers: та же нормализация пакета и GREATEST по итоговой оценке.
+    """
+    email_col, fio_col = 'Адрес электронной почты', 'ФИО'
+    test_col, project_col, final_col = 'Оценка за тест', 'Оценка за проект', 'Итоговая оценка'
+
+    def handler(params: dict) -> int:
+        incoming = pd.DataFrame(params['payload'], columns=['email', 'fio', 'project_grade'])
+        incoming['email'] = incoming['email'].astype(str).str.strip().str.lower()
+        incoming['fio'] = incoming['fio'].where(incoming['fio'].notna(), '').astype(str).str.strip()
+        incoming['fio'] = incoming['fio'].mask(incoming['fio'] == '')
+        incoming['project_grade'] = pd.to_numeric(incoming['project_grade'], errors='coerce')
+        incoming = (
+            incoming[(incoming['email'] != '') & incoming['project_grade'].notna()]
+            .sort_values('project_grade', ascending=False, kind='stable')
+            .drop_duplicates(subset=['email'])
+        )
+
+        # Одна операция под блокировкой, как один INSERT ... ON CONFLICT
+        with client._lock:
+            table = client.tables.get(table_name, pd.DataFrame(columns=[email_col]))
+            # Только строки пакета, как поиск по уникальному индексу email_key:
+            # сохраненный email сравнивается в нормализованном виде
+            keys = table[email_col].astype(str).str.strip().str.lower()
+            matched = table[keys.isin(incoming['email'])].assign(_key=keys)
+            old = matched.drop_duplicates(subset=['_key'], keep='last').set_index('_key').reindex(incoming['email'])
+            project = incoming['project_grade'].to_numpy(dtype=float)
+            final = np.maximum.reduce([
+                _grade_numbers(old.get(test_col, pd.Series(index=old.index, dtype=object))).fillna(0).to_numpy(),
+                project,
+                _grade_numbers(old.get(final_col, pd.Series(index=old.index, dtype=object))).fillna(0).to_numpy(),
+            ])
+            is_new = ~incoming['email'].isin(matched['_key']).to_numpy()
+            # Существующая запись обновляется под своим сохраненным email
+            emails = np.where(is_new, incoming['email'].to_numpy(), old[email_col].to_numpy())
+            payload = pd.DataFrame({email_col: emails, project_col: project, final_col: final})
+
+            new_records = payload[is_new].copy()
+            parts = incoming.loc[is_new, 'fio'].fillna('').str.split()
+            new_records[fio_col] = incoming.loc[is_new, 'fio'].to_numpy()
+            new_records['Фамилия'] = parts.str[0].to_numpy()
+            new_records['Имя'] = parts.str[1].to_numpy()
+
+            for records in (payload[~is_new], new_records):
+                if not records.empty:
+                    query = FakeQuery(client, table_name).upsert(
+                        records.astype(object).where(records.notna(), None).to_dict('records'), on_conflict=email_col
+                    )
+                    client._write(query)
+        return len(payload)
+
+    return handler
@@ -0,0 +1,282 @@
+"""
+Synthetic Dataset Generators
+Генераторы реалистичных синтетических данных для бенчмарков модулей logic/.
+Все генераторы детерминированы (seed) и возвращают данные в том виде,
+в котором их получают функции logic/: загруженные файлы или таблицы Supabase.
+"""
+import numpy as np
+import pandas as pd
+from typing import Dict, Tuple
+
+import constants
+from logic.data_utils import compact_dtypes
+
+CAMPUSES = ['Москва', 'Санкт-Петербург', 'Нижний Новгород', 'Пермь']
+FACULTIES = [
+    'Факультет экономических наук', 'Факультет компьютерных наук', 'Факультет права',
+    'Факультет гуманитарных наук', 'Факультет социальных наук', 'Факультет математики',
+    'Факультет физики', 'Высшая школа бизнеса', 'Факультет креативных индустрий',
+    'Факультет мировой экономики и мировой политики',
+]
+COURSES = ['Курс 2', 'Курс 3', 'Курс 4']
+PERIODS = ['2024/2025 2 модуль', '2024/2025 4 модуль', '2025/2026 2 модуль']
+TEST_DISCIPLINES = [constants.DISCIPLINE_INPUT, constants.DISCIPLINE_MID, constants.DISCIPLINE_FINAL]
+NE_NAMES = [
+    'Цифровая грамотность', 'Введение к программированию', 'Введение к анализу данных',
+]
+SURNAMES = ['Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Соколов']
+NAMES = ['Иван', 'Петр', 'Анна', 'Мария', 'Алексей', 'Елена', 'Дмитрий', 'Ольга']
+
+
+def _rng(seed: int) -> np.random.Generator:
+    return np.random.default_rng(seed)
+
+
+def _emails(n: int, upper_share: float = 0.0, rng: np.random.Generator = None) -> np.ndarray:
+    """Корпоративные email; часть — в верхнем регистре и с пробелами, как в реальных выгрузках."""
+    emails = np.array([f"student{i:07d}{constants.HSE_EMAIL_DOMAIN}" for i in range(n)], dtype=object)
+    if upper_share and rng is not None:
+        dirty = rng.random(n) < upper_share
+        emails[dirty] = [f" {e.upper()} " for e in emails[dirty]]
+    return emails
+
+
+def _fio(n: int, rng: np.random.Generator) -> np.ndarray:
+    surnames = rng.choice(SURNAMES, n)
+    names = rng.choice(NAMES, n)
+    return np.array([f"{s} {nm} Сергеевич" for s, nm in zip(surnames, names)], dtype=object)
+
+
+def _programs(n: int, rng: np.random.Generator) -> np.ndarray:
+    return rng.choice([f"Образовательная программа {i}" for i in range(40)], n)
+
+
+def _groups(n: int, rng: np.random.Generator) -> np.ndarray:
+    return rng.choice([f"Б{year}-{num:02d}" for year in (22, 23, 24) for num in range(1, 30)], n)
+
+
+def _grade_strings(n: int, rng: np.random.Generator, missing_share: float = 0.1) -> np.ndarray:
+    """Оценки как в выгрузке SmartLMS: '0'..'10' и '-' для отсутствующих."""
+    grades = rng.integers(0, 11, n).astype(str).astype(object)
+    grades[rng.random(n) < missing_share] = '-'
+    return grades
+
+
+# =============================================================================
+# ПЕРЕЗАЧЕТ ОЦЕНОК
+# =============================================================================
+
+def make_recalculation_frame(n: int, seed: int = 0, nan_share: float = 0.05) -> pd.DataFrame:
+    """Входной файл страницы 1 (перезачет оценок)."""
+    rng = _rng(seed)
+
+    def grades():
+        values = rng.integers(0, 11, n).astype(float)
+        values[rng.random(n) < nan_share] = np.nan
+        return values
+
+    return pd.DataFrame({
+        'ФИО': _fio(n, rng),
+        'Адрес электронной почты': _emails(n),
+        'Наименование НЭ': rng.choice(NE_NAMES, n),
+        'Оценка НЭ': grades(),
+        'Оценка дисциплины-пререквизита': grades(),
+        constants.DISCIPLINE_INPUT: grades(),
+        constants.DISCIPLINE_MID: grades(),
+        constants.DISCIPLINE_FINAL: grades(),
+    })
+
+
+# =============================================================================
+# СПРАВОЧНЫЕ ТАБЛИЦЫ SUPABASE
+# =============================================================================
+
+def make_students_frame(n: int, seed: int = 1) -> pd.DataFrame:
+    """Таблица students после load_students_from_supabase (колонки уже переименованы)."""
+    rng = _rng(seed)
+    return pd.DataFrame({
+        constants.COL_EMAIL: _emails(n),
+        constants.COL_FIO: _fio(n, rng),
+        constants.COL_CAMPUS_OLD: rng.choice(CAMPUSES, n),
+        constants.COL_FACULTY: rng.choice(FACULTIES, n),
+        constants.COL_PROGRAM: _programs(n, rng),
+        constants.COL_GROUP: _groups(n, rng),
+        constants.COL_COURSE: rng.choice(COURSES, n),
+    })
+
+
+def make_registration_frame(n: int, seed: int = 2, coverage: float = 0.7) -> pd.DataFrame:
+    """Таблица registration_data: часть студентов зарегистрирована на этапы внешнего измерения."""
+    rng = _rng(seed)
+    emails = _emails(n)
+    registered = emails[rng.random(n) < coverage]
+    m = len(registered)
+    disciplines = rng.choice(TEST_DISCIPLINES, m)
+    return pd.DataFrame({
+        'id': np.arange(1, m + 1),
+        constants.COL_FIO: _fio(m, rng),
+        constants.COL_EMAIL: registered,
+        constants.COL_CAMPUS: rng.choice(CAMPUSES, m),
+        constants.COL_FACULTY: rng.choice(FACULTIES, m),
+        constants.COL_PROGRAM: _programs(m, rng),
+        constants.COL_GROUP: _groups(m, rng),
+        constants.COL_COURSE: rng.choice(COURSES, m),
+        constants.COL_ID_DISCIPLINE: rng.integers(100000, 999999, m).astype(str),
+        constants.COL_DISCIPLINE: disciplines,
+        constants.COL_PERIOD: rng.choice(PERIODS, m),
+        constants.COL_CANCEL: np.where(rng.random(m) < 0.02, 'Да', ''),
+    })
+
+
+def make_student_io_frame(n: int, seed: int = 3, coverage: float = 0.2) -> pd.DataFrame:
+    """Таблица student_io: оценки, уже выставленные в ИО (после load_student_io_from_supabase)."""
+    rng = _rng(seed)
+    emails = _emails(n)
+    picked = emails[rng.random(n) < coverage]
+    m = len(picked)
+    return pd.DataFrame({
+        constants.COL_EMAIL: picked,
+        constants.COL_DISCIPLINE: rng.choice(TEST_DISCIPLINES, m),
+        constants.COL_GRADE: rng.integers(0, 11, m).astype(str),
+    })
+
+
+def make_peresdachi_frame(n: int, seed: int = 4, coverage: float = 0.3) -> pd.DataFrame:
+    """Таблица peresdachi: ранее сохраненные пересдачи."""
+    rng = _rng(seed)
+    emails = _emails(n, upper_share=0.05, rng=rng)
+    picked = emails[rng.random(n) < coverage]
+    m = len(picked)
+    return pd.DataFrame({
+        'id': np.arange(1, m + 1),
+        constants.COL_FIO: _fio(m, rng),
+        constants.COL_EMAIL: picked,
+        constants.COL_CAMPUS: rng.choice(CAMPUSES, m),
+        constants.COL_FACULTY: rng.choice(FACULTIES, m),
+        constants.COL_PROGRAM: _programs(m, rng),
+        constants.COL_GROUP: _groups(m, rng),
+        constants.COL_COURSE: rng.choice(COURSES, m),
+        constants.COL_ID_DISCIPLINE: rng.integers(100000, 999999, m).astype(str),
+        constants.COL_DISCIPLINE: rng.choice(TEST_DISCIPLINES, m),
+        constants.COL_PERIOD: rng.choice(PERIODS, m),
+        constants.COL_GRADE: rng.integers(0, 11, m).astype(str),
+        constants.COL_CANCEL: '',
+        'created_at': pd.Timestamp('2025-01-01', tz='UTC') + pd.to_timedelta(rng.integers(0, 365 * 24 * 3600, m), unit='s'),
+    })
+
+
+def make_reference_tables(n: int, compact: bool = True) -> Dict[str, pd.DataFrame]:
+    """
+    Все справочные таблицы Supabase для загрузки из n студентов.
+
+    compact=True — в том виде, в котором их возвращают загрузчики (после compact_dtypes).
+    """
+    tables = {
+        constants.DB_TABLE_STUDENTS: make_students_frame(n),
+        constants.DB_TABLE_REGISTRATION_DATA: make_registration_frame(n),
+        constants.DB_TABLE_STUDENT_IO: make_student_io_frame(n),
+        constants.DB_TABLE_PERESDACHI: make_peresdachi_frame(n),
+    }
+    if compact:
+        tables = {name: compact_dtypes(df) for name, df in tables.items()}
+    return tables
+
+
+# Колонки email, из которых БД вычисляет email_key (sql/migration_add_email_keys.sql)
+EMAIL_KEY_SOURCES = {
+    constants.DB_TABLE_STUDENTS: 'корпоративная_почта',
+    constants.DB_TABLE_PERESDACHI: constants.COL_EMAIL,
+    constants.DB_TABLE_REGISTRATION_DATA: constants.COL_EMAIL,
+    constants.DB_TABLE_STUDENT_IO: constants.COL_EMAIL,
+    constants.DB_TABLE_FINAL_GRADES: constants.COL_EMAIL,
+}
+
+
+def make_database_tables(n: int) -> Dict[str, pd.DataFrame]:
+    """Справочные таблицы в формате БД (исходные имена колонок, без нормализации) для FakeSupabaseClient."""
+    tables = make_reference_tables(n, compact=False)
+    df_to_db = {v: k for k, v in constants.STUDENT_DB_TO_DF_MAPPING.items()}
+    tables[constants.DB_TABLE_STUDENTS] = tables[constants.DB_TABLE_STUDENTS].rename(columns=df_to_db)
+    return tables
+
+
+# =============================================================================
+# ВНЕШНЕЕ ИЗМЕРЕНИЕ
+# =============================================================================
+
+def make_test_grades_frame(n: int, seed: int = 5) -> pd.DataFrame:
+    """Экспорт оценок SmartLMS за тесты (4 курс)."""
+    rng = _rng(seed)
+    return pd.DataFrame({
+        'Фамилия': rng.choice(SURNAMES, n),
+        'Имя': rng.choice(NAMES, n),
+        constants.COL_EMAIL: _emails(n, upper_share=0.1, rng=rng),
+        constants.TEST_COL_INPUT: _grade_strings(n, rng),
+        constants.TEST_COL_MID: _grade_strings(n, rng),
+        constants.TEST_COL_FINAL: _grade_strings(n, rng),
+    })
+
+
+def make_project_grades_frame(n: int, seed: int = 6) -> pd.DataFrame:
+    """Экспорт оценок SmartLMS за проекты (3 курс): заполнено одно задание из нескольких."""
+    rng = _rng(seed)
+    data = {
+        'Фамилия': rng.choice(SURNAMES, n),
+        'Имя': rng.choice(NAMES, n),
+        constants.COL_EMAIL: _emails(n, upper_share=0.1, rng=rng),
+    }
+    chosen = rng.integers(0, len(constants.PROJECT_COLUMNS), n)
+    for i, col in enumerate(constants.PROJECT_COLUMNS):
+        values = np.full(n, '-', dtype=object)
+        mask = chosen == i
+        values[mask] = rng.integers(1, 11, mask.sum()).astype(str)
+        data[col] = values
+    return pd.DataFrame(data)
+
+
+def make_assessment_result_frame(n: int, seed: int = 7, duplicate_share: float = 0.05) -> pd.DataFrame:
+    """Результат process_external_assessment (вход deduplicate_and_split) с долей дубликатов."""
+    rng = _rng(seed)
+    base = make_peresdachi_frame(n, seed=seed, coverage=1.0).drop(columns=['id', 'created_at'])
+    base[constants.COL_EMAIL] = base[constants.COL_EMAIL].str.strip().str.lower()
+    duplicates = base.sample(frac=duplicate_share, random_state=seed)
+    return pd.concat([base, duplicates], ignore_index=True).sample(frac=1.0, random_state=int(rng.integers(1 << 31)))
+
+
+# =============================================================================
+# СПИСОК СТУДЕНТОВ И СЕРТИФИКАТЫ
+# =============================================================================
+
+def make_student_list_frame(n: int, seed: int = 8) -> pd.DataFrame:
+    """Результат load_student_list_file (вход build_student_records)."""
+    rng = _rng(seed)
+    emails = _emails(n, upper_share=0.1, rng=rng)
+    emails[rng.random(n) < 0.02] = 'external@gmail.com'
+    return pd.DataFrame({
+        'ФИО': _fio(n, rng),
+        'Корпоративная почта': emails,
+        'Филиал (кампус)': rng.choice(CAMPUSES, n),
+        'Факультет': rng.choice(FACULTIES, n),
+        'Образовательная программа': _programs(n, rng),
+        'Версия образовательной программы': rng.choice(['2022', '2023', '2024', ''], n),
+        'Группа': _groups(n, rng),
+        'Курс': rng.choice(COURSES, n),
+        'Уровень образования': rng.choice(['Бакалавриат', 'Специалитет'], n),
+    })
+
+
+def make_certificate_inputs(n: int, seed: int = 9) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    """Файл студентов генератора сертификатов и справочник навыков."""
+    rng = _rng(seed)
+    disciplines = [f"Дисциплина {i}" for i in range(30)]
+    levels = ['3', '4', '5']
+    grade_mapping = {
+        f"{d}—{lvl}": f"Навык 1 по {d} уровня {lvl}\nНавык 2 по {d} уровня {lvl}"
+        for d in disciplines for lvl in levels
+    }
+    data = {'Учащийся': _fio(n, rng)}
+    for num in range(1, 4):
+        data[f"Дисциплина {num}"] = rng.choice(disciplines, n)
+        data[f"Оценка 5 баллов Дисциплина {num}"] = rng.choice(levels + ['nan'], n)
+        data[f"Название Дисциплины {num}"] = rng.choice(['краткое название', ''], n)
+    return pd.DataFrame(data), grade_mapping
@@ -0,0 +1,127 @@
+"""
+Pagination Benchmark
+Сравнение keyset- и offset-пагинации fetch_all_from_supabase на локальной базе.
+
+Смещение range(offset, ...) заставляет Postgres пропускать offset строк на каждой
+странице, поэтому на глубоких страницах запрос дорожает; keyset (id > последний id)
+читает страницу по индексу первичного ключа за постоянное время.
+
+Использование (локальный Supabase, например `supabase start`):
+    export BENCH_SUPABASE_URL=http://127.0.0.1:54321
+    export BENCH_SUPABASE_KEY=<service_role key>
+    python -m benchmarks.pagination --rows 500k --seed
+
+Без переменных окружения сценарий не запускается: результаты против
+клиента в памяти не отражают стоимость OFFSET в Postgres.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Callable, List
+
+import constants
+import utils
+from benchmarks import generators
+from benchmarks.run import RESULTS_DIR, format_size, parse_size, synthetic_supabase
+
+ENV_URL = 'BENCH_SUPABASE_URL'
+ENV_KEY = 'BENCH_SUPABASE_KEY'
+SEED_BATCH_SIZE = 5_000
+
+
+def _timed(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def seed_table(client, table_name: str, rows: int, log=print) -> int:
+    """Дозаполнение таблицы синтетическими пересдачами до rows строк."""
+    existing = client.table(table_name).select('id', count='exact').limit(1).execute().count or 0
+    missing = rows - existing
+    if missing <= 0:
+        return existing
+
+    df = generators.make_peresdachi_frame(missing, coverage=1.0).drop(columns=['id', 'created_at'])
+    records = df.astype(object).where(df.notna(), None).to_dict('records')
+    for start in range(0, len(records), SEED_BATCH_SIZE):
+        client.table(table_name).insert(records[start:start + SEED_BATCH_SIZE]).execute()
+        log(f"Добавлено {min(start + SEED_BATCH_SIZE, len(records)):,} / {len(records):,}")
+    return existing + len(records)
+
+
+def measure_last_page(client, table_name: str, total: int, page_size: int) -> dict:
+    """Время чтения последней страницы каждым способом."""
+    key = constants.KEYSET_PAGINATION_KEYS[table_name]
+    last_id = client.table(table_name).select(key).order(key, desc=True).limit(1).execute().data[0][key]
+    offset = max(total - page_size, 0)
+    return {
+        'offset': _timed(lambda: client.table(table_name).select('*').range(offset, offset + page_size - 1).execute()),
+        'keyset': _timed(lambda: client.table(table_name).select('*').gt(key, last_id - page_size)
+                         .order(key).limit(page_size).execute()),
+    }
+
+
+def run(rows: int, table_name: str, page_size: int, repeat: int, seed: bool, log=print) -> dict:
+    from supabase import create_client
+
+    client = create_client(os.environ[ENV_URL], os.environ[ENV_KEY])
+    total = seed_table(client, table_name, rows, log) if seed else \
+        client.table(table_name).select('id', count='exact').limit(1).execute().count
+
+    results = {}
+    with synthetic_supabase(client):
+        for mode in ('offset', 'keyset'):
+            timings = [
+                _timed(lambda: utils.fetch_all_from_supabase(table_name, page_size=page_size, pagination=mode))
+                for _ in range(repeat)
+            ]
+            results[mode] = {'seconds': round(min(timings), 4)}
+            log(f"{mode:<8} полная выборка {min(timings):>10.3f} s")
+
+    for mode, seconds in measure_last_page(client, table_name, total, page_size).items():
+        results[mode]['last_page_seconds'] = round(seconds, 4)
+        log(f"{mode:<8} последняя страница {seconds:>8.4f} s")
+
+    return {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'table': table_name,
+            'rows': total,
+            'page_size': page_size,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Сравнение keyset- и offset-пагинации на локальной базе")
+    parser.add_argument('--rows', default='500k', help="Размер таблицы, например 500k")
+    parser.add_argument('--table', default=constants.DB_TABLE_PERESDACHI,
+                        choices=sorted(constants.KEYSET_PAGINATION_KEYS))
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', action='store_true', help="Дозаполнить таблицу синтетическими строками")
+    parser.add_argument('--output', default=None, help="Путь к JSON с результатами")
+    args = parser.parse_args(argv)
+
+    if not os.environ.get(ENV_URL) or not os.environ.get(ENV_KEY):
+        print(f"Задайте {ENV_URL} и {ENV_KEY} для локальной базы Supabase")
+        return 2
+
+    rows = parse_size(args.rows)
+    report = run(rows, args.table, args.page_size, args.repeat, args.seed)
+    output = args.output or os.path.join(RESULTS_DIR, f"pagination_{format_size(rows)}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,431 @@
+"""
+Benchmark Runner
+Замер времени и пикового потребления памяти функций logic/ на синтетических данных.
+
+Использование:
+    python -m benchmarks.run run --sizes 1k,10k,100k --output benchmarks/results/current.json
+    python -m benchmarks.run compare benchmarks/results/baseline.json benchmarks/results/current.json
+
+Клиент Supabase подменяется клиентом с синтетическими таблицами в памяти
+(benchmarks/fake_supabase.py), поэтому бенчмарки запускаются без сети.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Tuple
+from unittest import mock
+
+import pandas as pd
+
+import constants
+import utils
+from benchmarks import generators
+from benchmarks.fake_supabase import FakeSupabaseClient, email_key
+from logic import external_assessment, student_management
+from logic.certificate_generator import process_student_data
+from logic.data_utils import compact_dtypes, frame_memory_mb
+from logic.grade_recalculation import process_grade_recalculation, sweep_grade_recalculation
+from logic.student_management import build_student_records
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+DEFAULT_SIZES = '1k,10k,100k'
+DEFAULT_THRESHOLD = 0.2
+
+# Задержка одного запроса в сценариях, где важна конкурентность обращений к БД
+NETWORK_LATENCY = 0.01
+
+# Модули, получающие клиент Supabase через get_supabase_client
+SUPABASE_CLIENT_MODULES = [utils, external_assessment, student_management]
+
+
+def parse_size(value: str) -> int:
+    """'10k' → 10000, '1m' → 1000000."""
+    value = value.strip().lower()
+    multipliers = {'k': 1_000, 'm': 1_000_000}
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+
+def format_size(n: int) -> str:
+    for suffix, factor in (('m', 1_000_000), ('k', 1_000)):
+        if n >= factor and n % factor == 0:
+            return f"{n // factor}{suffix}"
+    return str(n)
+
+
+@contextmanager
+def synthetic_supabase(client: FakeSupabaseClient) -> Iterator[FakeSupabaseClient]:
+    """
+    Подмена клиента Supabase клиентом с синтетическими таблицами в памяти.
+
+    Загрузчики logic/ выполняются полностью (запросы, пагинация, сборка DataFrame),
+    без сети. Клиент создается при подготовке сценария и в замер не входит.
+    """
+    patches = [mock.patch.object(module, 'get_supabase_client', return_value=client)
+               for module in SUPABASE_CLIENT_MODULES]
+    # Потоки map_concurrently создают клиенты сами; в замере они работают с теми же таблицами
+    patches.append(mock.patch.object(utils, 'create_supabase_client', return_value=client))
+    for patch in patches:
+        patch.start()
+    try:
+        yield client
+    finally:
+        for patch in patches:
+            patch.stop()
+
+
+# =============================================================================
+# СЦЕНАРИИ
+# Каждый сценарий получает размер и возвращает функцию без аргументов;
+# генерация данных в замер не входит.
+# =============================================================================
+
+def _case_grade_recalculation(n: int) -> Callable[[], object]:
+    df = generators.make_recalculation_frame(n)
+    return lambda: process_grade_recalculation(df, use_dynamics=True)
+
+
+def _case_grade_sweep(n: int) -> Callable[[], object]:
+    df = generators.make_recalculation_frame(n)
+    variants = {
+        'Без динамики': {'use_dynamics': False},
+        'С динамикой': {'use_dynamics': True},
+        'Падение до 2': {'use_dynamics': True, 'dynamics_max_drop': 2},
+        'Ограничение ДПР 8→7': {'use_dynamics': False, 'dpr_cap_threshold': 8, 'dpr_cap_value': 7},
+    }
+    return lambda: sweep_grade_recalculation(df, variants)
+
+
+def _database_client(tables: Dict[str, pd.DataFrame], **kwargs) -> FakeSupabaseClient:
+    """Клиент с таблицами после миграции email_key: ключ вычисляется при записи, как в БД."""
+    generated = {
+        table: {constants.EMAIL_KEY_COLUMN: email_key(source)}
+        for table, source in generators.EMAIL_KEY_SOURCES.items() if table in tables
+    }
+    return FakeSupabaseClient(tables, generated=generated, **kwargs)
+
+
+def _case_external_assessment(n: int) -> Callable[[], object]:
+    grades_df = generators.make_test_grades_frame(n)
+    client = _database_client(generators.make_database_tables(n))
+    students_df = compact_dtypes(generators.make_students_frame(n))
+
+    def run():
+        with synthetic_supabase(client):
+            return external_assessment.process_external_assessment(grades_df.copy(), students_df)
+    return run
+
+
+def _case_project_assessment(n: int) -> Callable[[], object]:
+    grades_df = generators.make_project_grades_frame(n)
+    client = _database_client(generators.make_database_tables(n))
+    students_df = compact_dtypes(generators.make_students_frame(n))
+
+    def run():
+        with synthetic_supabase(client):
+            return external_assessment.process_project_assessment(grades_df.copy(), students_df)
+    return run
+
+
+def _case_enrichment(n: int) -> Callable[[], object]:
+    # Обе обработки на снимке с уже загруженными таблицами: замеряется только обработка
+    test_grades_df = generators.make_test_grades_frame(n)
+    project_grades_df = generators.make_project_grades_frame(n)
+    students_df = compact_dtypes(generators.make_students_frame(n))
+    with synthetic_supabase(_database_client(generators.make_database_tables(n))):
+        snapshot = external_assessment.ReferenceSnapshot()
+        external_assessment.process_external_assessment(test_grades_df.copy(), students_df, snapshot=snapshot)
+
+    def run():
+        external_assessment.process_external_assessment(test_grades_df.copy(), students_df, snapshot=snapshot)
+        return external_assessment.process_project_assessment(project_grades_df.copy(), students_df, snapshot=snapshot)
+    return run
+
+
+def _case_deduplicate_and_split(n: int) -> Callable[[], object]:
+    result_df = generators.make_assessment_result_frame(n)
+    client = _database_client(generators.make_database_tables(n))
+
+    def run():
+        with synthetic_supabase(client):
+            return external_assessment.deduplicate_and_split(result_df)
+    return run
+
+
+def _case_assessment_run(n: int, latency: float = 0.0) -> Callable[[], object]:
+    # Полный запуск страницы: обработка и дедупликация на одном снимке справочных таблиц
+    grades_df = generators.make_test_grades_frame(n)
+    client = _database_client(generators.make_database_tables(n), latency=latency)
+    students_df = compact_dtypes(generators.make_students_frame(n))
+
+    def run():
+        with synthetic_supabase(client):
+            snapshot = external_assessment.ReferenceSnapshot()
+            result_df, _ = external_assessment.process_external_assessment(grades_df.copy(), students_df, snapshot=snapshot)
+            return external_assessment.deduplicate_and_split(result_df, snapshot=snapshot)
+    return run
+
+
+def _case_new_records(n: int) -> Callable[[], object]:
+    # Загрузка фиксированного размера против таблицы peresdachi из n студентов:
+    # время должно зависеть от загрузки, а не от таблицы
+    upload_df = generators.make_assessment_result_frame(1_000, duplicate_share=0.0)
+    client = _database_client(generators.make_database_tables(n))
+
+    def run():
+        with synthetic_supabase(client):
+            return external_assessment.get_new_records_from_dataframe(upload_df)
+    return run
+
+
+def _case_save_peresdachi(n: int) -> Callable[[], object]:
+    # Запись n новых строк пакетами; каждый запуск пишет в свежую копию таблицы
+    upload_df = generators.make_assessment_result_frame(n, duplicate_share=0.0)
+    tables = generators.make_database_tables(1_000)
+
+    def run():
+        client = _database_client(tables, unique={constants.DB_TABLE_PERESDACHI: constants.PERESDACHI_UNIQUE_KEY})
+        with synthetic_supabase(client):
+            return external_assessment.save_to_supabase(upload_df)
+    return run
+
+
+def _case_save_new_records(n: int, db_dedup: bool = True) -> Callable[[], object]:
+    # Шаг страницы после обработки: новые записи определяет уникальный индекс БД (db_dedup)
+    # или сравнение с загруженной peresdachi перед записью; каждый запуск пишет в свежую копию таблиц
+    result_df = generators.make_assessment_result_frame(n)
+    tables = generators.make_database_tables(n)
+    unique = {constants.DB_TABLE_PERESDACHI: constants.PERESDACHI_UNIQUE_KEY} if db_dedup else None
+
+    def run():
+        client = _database_client(tables, unique=unique, latency=NETWORK_LATENCY)
+        with synthetic_supabase(client):
+            snapshot = external_assessment.ReferenceSnapshot()
+            if db_dedup:
+                return external_assessment.deduplicate_and_save(result_df, snapshot=snapshot)
+            split = external_assessment.deduplicate_and_split(result_df, snapshot=snapshot)
+            return external_assessment.save_to_supabase(split['display_new_records'], snapshot=snapshot)
+    return run
+
+
+def _case_final_grades(n: int) -> Callable[[], object]:
+    # Задержка на запрос имитирует сеть: время определяется числом последовательных обращений
+    result_df = generators.make_assessment_result_frame(n, duplicate_share=0.0)
+    result_df[constants.COL_GRADE] = '8'
+    emails = result_df[constants.COL_EMAIL].drop_duplicates()
+    existing = pd.DataFrame({
+        constants.COL_EMAIL: emails.iloc[::2].to_numpy(),
+        constants.COL_FINAL_TEST_GRADE: '7',
+        constants.COL_FINAL_GRADE: '7',
+    })
+
+    def run():
+        client = _database_client({constants.DB_TABLE_FINAL_GRADES: existing}, latency=NETWORK_LATENCY)
+        with synthetic_supabase(client):
+            return external_assessment.update_final_grades(result_df)
+    return run
+
+
+def _case_student_records(n: int) -> Callable[[], object]:
+    student_data = compact_dtypes(generators.make_student_list_frame(n))
+    return lambda: build_student_records(student_data)
+
+
+def _case_certificates(n: int) -> Callable[[], object]:
+    df, grade_mapping = generators.make_certificate_inputs(n)
+    return lambda: process_student_data(df, grade_mapping)
+
+
+CASES: Dict[str, Callable[[int], Callable[[], object]]] = {
+    'grade_recalculation': _case_grade_recalculation,
+    'grade_sweep': _case_grade_sweep,
+    'external_assessment': _case_external_assessment,
+    'project_assessment': _case_project_assessment,
+    'enrichment': _case_enrichment,
+    'deduplicate_and_split': _case_deduplicate_and_split,
+    'assessment_run': _case_assessment_run,
+    'assessment_run_network': lambda n: _case_assessment_run(n, latency=NETWORK_LATENCY),
+    'new_records': _case_new_records,
+    'save_peresdachi': _case_save_peresdachi,
+    'save_new_records': _case_save_new_records,
+    'save_new_records_client_dedup': lambda n: _case_save_new_records(n, db_dedup=False),
+    'final_grades': _case_final_grades,
+    'student_records': _case_student_records,
+    'certificates': _case_certificates,
+}
+
+
+# =============================================================================
+# ЗАМЕРЫ
+# =============================================================================
+
+def measure(func: Callable[[], object], repeat: int) -> Tuple[float, float]:
+    """
+    Лучшее время из repeat запусков и пиковая память одного запуска.
+
+    Память замеряется отдельным запуском под tracemalloc, чтобы трассировка
+    не искажала время.
+
+    Returns:
+        (секунды, пиковая память в МБ)
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return min(timings), peak / (1024 * 1024)
+
+
+def measure_frame_memory(n: int) -> Dict[str, dict]:
+    """Объем загруженных таблиц до и после compact_dtypes."""
+    frames = generators.make_reference_tables(n, compact=False)
+    frames['student_list'] = generators.make_student_list_frame(n)
+
+    report = {}
+    for name, df in frames.items():
+        before = frame_memory_mb(df)
+        after = frame_memory_mb(compact_dtypes(df.copy()))
+        report[f"{name}@{format_size(n)}"] = {
+            'before_mb': round(before, 3),
+            'after_mb': round(after, 3),
+            'ratio': round(after / before, 3) if before else 1.0,
+        }
+    return report
+
+
+def run_benchmarks(sizes: List[int], cases: List[str] = None, repeat: int = 3, log=print) -> dict:
+    """
+    Запуск сценариев на всех размерах.
+
+    Returns:
+        dict с ключами meta, results и memory:
+        results — {'<сценарий>@<размер>': {'seconds', 'peak_mb', 'rows'}},
+        memory — {'<таблица>@<размер>': {'before_mb', 'after_mb', 'ratio'}}
+    """
+    cases = cases or list(CASES)
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        raise ValueError(f"Неизвестные сценарии: {', '.join(unknown)}")
+
+    results, memory = {}, {}
+    for n in sizes:
+        # На больших объемах один запуск уже дает стабильное время
+        runs = repeat if n < 100_000 else 1
+        for name in cases:
+            func = CASES[name](n)
+            seconds, peak_mb = measure(func, runs)
+            key = f"{name}@{format_size(n)}"
+            results[key] = {'seconds': round(seconds, 6), 'peak_mb': round(peak_mb, 3), 'rows': n}
+            log(f"{key:<40} {seconds:>10.4f} s {peak_mb:>10.1f} MB")
+
+        for key, entry in measure_frame_memory(n).items():
+            memory[key] = entry
+            log(f"{'memory ' + key:<40} {entry['before_mb']:>10.1f} → {entry['after_mb']:.1f} MB")
+
+    return {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'repeat': repeat,
+        },
+        'results': results,
+        'memory': memory,
+    }
+
+
+def compare_results(baseline: dict, current: dict, threshold: float = DEFAULT_THRESHOLD) -> pd.DataFrame:
+    """
+    Сравнение двух прогонов.
+
+    Регрессия — рост времени или пиковой памяти больше чем на threshold (доля).
+
+    Returns:
+        DataFrame со столбцами: Сценарий, Время (база), Время, Δ времени, Память (база), Память, Δ памяти, Регрессия
+    """
+    rows = []
+    for key, cur in current['results'].items():
+        base = baseline['results'].get(key)
+        if base is None:
+            continue
+        time_delta = cur['seconds'] / base['seconds'] - 1 if base['seconds'] else 0.0
+        memory_delta = cur['peak_mb'] / base['peak_mb'] - 1 if base['peak_mb'] else 0.0
+        rows.append({
+            'Сценарий': key,
+            'Время (база)': base['seconds'],
+            'Время': cur['seconds'],
+            'Δ времени': round(time_delta, 3),
+            'Память (база)': base['peak_mb'],
+            'Память': cur['peak_mb'],
+            'Δ памяти': round(memory_delta, 3),
+            'Регрессия': time_delta > threshold or memory_delta > threshold,
+        })
+    return pd.DataFrame(rows, columns=[
+        'Сценарий', 'Время (база)', 'Время', 'Δ времени',
+        'Память (база)', 'Память', 'Δ памяти', 'Регрессия'
+    ])
+
+
+def _load_json(path: str) -> dict:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарки модулей logic/ на синтетических данных")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Запуск бенчмарков")
+    run_parser.add_argument('--sizes', default=DEFAULT_SIZES, help="Размеры через запятую, например 1k,10k,100k,1m")
+    run_parser.add_argument('--cases', default=None, help=f"Сценарии через запятую: {', '.join(CASES)}")
+    run_parser.add_argument('--repeat', type=int, default=3, help="Число запусков для замера времени")
+    run_parser.add_argument('--output', default=None, help="Путь к JSON с результатами")
+
+    compare_parser = subparsers.add_parser('compare', help="Сравнение двух прогонов")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                                help="Допустимый рост времени и памяти (доля)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        sizes = [parse_size(s) for s in args.sizes.split(',') if s.strip()]
+        cases = [c.strip() for c in args.cases.split(',')] if args.cases else None
+        report = run_benchmarks(sizes, cases, repeat=args.repeat)
+        output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d_%H%M%S}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены: {output}")
+        return 0
+
+    comparison = compare_results(_load_json(args.baseline), _load_json(args.current), args.threshold)
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(comparison.to_string(index=False))
+    regressions = comparison[comparison['Регрессия']]
+    if not regressions.empty:
+        print(f"Регрессии (> {args.threshold:.0%}): {', '.join(regressions['Сценарий'])}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -358,6 +358,77 @@ PROJECT_COLUMNS = [
     PROJECT_COL_EXTENDED
 ]
 
+# Compact dtypes: низкокардинальные колонки хранятся как category сразу после загрузки.
+# Оценка в БД — TEXT и попадает в сохраняемые записи как есть, поэтому тоже category.
+COMPACT_CATEGORY_COLUMNS = [
+    COL_CAMPUS, COL_CAMPUS_OLD, COL_FACULTY, COL_PROGRAM, COL_PROGRAM_VERSION,
+    COL_GROUP, COL_COURSE, COL_EDU_LEVEL, COL_ID_DISCIPLINE, COL_DISCIPLINE,
+    COL_PERIOD, COL_CANCEL, COL_GRADE
+]
+# Колонка переводится в category, только если уникальных значений не больше этой доли строк
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+# Проверка существующих ключей (email, дисциплина): число email в одном фильтре in_
+KEY_PROBE_CHUNK_SIZE = 200
+# Справочные таблицы запуска читаются ключевыми запросами по email загрузки
+# (индексы (email_key, дисциплина), sql/migration_add_join_key_indexes.sql), если email
+# не больше этого числа; для больших загрузок дешевле прочитать таблицы целиком
+REFERENCE_PROBE_MAX_EMAILS = 2000
+
+# Таблицы с последовательным ключом: fetch_all_from_supabase читает их
+# постранично по ключу (id > последний id) вместо смещения range(offset, ...)
+KEYSET_PAGINATION_KEYS = {
+    DB_TABLE_PERESDACHI: 'id',
+    DB_TABLE_REGISTRATION_DATA: 'id',
+}
+
+# Параллельная загрузка страниц (fetch_all_from_supabase, pagination='parallel'):
+# страницы читаются по смещению в стабильном порядке уникального ключа таблицы
+PAGINATION_ORDER_KEYS = {**KEYSET_PAGINATION_KEYS, DB_TABLE_STUDENTS: 'корпоративная_почта'}
+FETCH_MAX_WORKERS = 8
+FETCH_PAGE_RETRIES = 3
+FETCH_RETRY_DELAY = 1.0  # секунды; растет с номером попытки
+
+# Сгенерированная колонка lower(btrim(email)) с индексом (sql/migration_add_email_keys.sql)
+EMAIL_KEY_COLUMN = 'email_key'
+
+# Фоновая предзагрузка справочных данных при открытии страницы: число фоновых
+# задач и возраст предзагруженного снимка, после которого он считается устаревшим
+PREFETCH_MAX_WORKERS = 2
+PREFETCH_MAX_AGE = 600  # секунды
+
+# Пакетная запись в peresdachi: ограничения пакета по строкам и размеру JSON,
+# ключ идемпотентности и повторы при временных ошибках
+PERESDACHI_CONFLICT_COLUMNS = [COL_EMAIL, COL_DISCIPLINE]
+# Уникальный индекс (нормализованный email, дисциплина) — цель ON CONFLICT DO NOTHING
+# (sql/migration_peresdachi_unique_key.sql)
+PERESDACHI_UNIQUE_KEY = [EMAIL_KEY_COLUMN, COL_DISCIPLINE]
+WRITE_BATCH_ROWS = 500
+WRITE_BATCH_BYTES = 1_000_000
+WRITE_BATCH_RETRIES = 3
+WRITE_RETRY_DELAY = 1.0  # секунды; растет с номером попытки
+
+# final_grades: порция email в фильтре in_ и число одновременных пакетов upsert
+FINAL_GRADES_CHUNK_SIZE = 200
+WRITE_MAX_WORKERS = 4
+
+# Колонки справочных таблиц, которые нужны обработке внешнего измерения
+REGISTRATION_COLUMNS = [
+    COL_FIO, COL_EMAIL, COL_CAMPUS, COL_FACULTY, COL_PROGRAM, COL_GROUP, COL_COURSE,
+    COL_CANCEL, COL_ID_DISCIPLINE, COL_DISCIPLINE, COL_PERIOD
+]
+GRADE_LOOKUP_COLUMNS = [COL_EMAIL, COL_DISCIPLINE, COL_GRADE]
+STUDENT_LOOKUP_COLUMNS = [COL_FIO, COL_EMAIL, COL_CAMPUS_OLD, COL_FACULTY, COL_PROGRAM, COL_GROUP, COL_COURSE]
+
+# Колонки final_grades
+COL_FINAL_TEST_GRADE = 'Оценка за тест'
+COL_FINAL_PROJECT_GRADE = 'Оценка за проект'
+COL_FINAL_GRADE = 'Итоговая оценка'
+FINAL_GRADES_LOOKUP_COLUMNS = [COL_EMAIL, COL_FINAL_TEST_GRADE, COL_FINAL_GRADE]
+
+# Функция БД для слияния оценок за проект (sql/function_merge_final_grades.sql)
+FINAL_GRADES_MERGE_FUNCTION = 'merge_final_grades'
+
 # =============================================================================
 # COMMON PATTERNS
 # =============================================================================
@@ -368,6 +439,76 @@ HSE_EMAIL_DOMAIN = '@edu.hse.ru'
 STAGE_KEYWORD_ANALYSIS = 'анализу данных'
 STAGE_KEYWORD_PROGRAMMING = 'программированию'
 
+# =============================================================================
+# GRADE RECALCULATION RULES
+# =============================================================================
+
+# Параметры правил перезачета, на которые ссылаются таблицы ниже
+GRADE_RECALC_PARAMS = {
+    'use_dynamics': False,
+    'dpr_cap_threshold': 9,     # ДПР >= порога ограничивается до dpr_cap_value
+    'dpr_cap_value': 8,
+    'dynamics_max_drop': 1,     # Допустимое падение оценки между этапами
+}
+
+# Таблица правил — упорядоченный список: срабатывает первое правило, у которого
+# выполнены все условия 'when' (логическое И). Условие — (операнд, оператор, операнд),
+# операторы: <, <=, >, >=, ==, !=. Операнд — имя расчетной колонки, имя параметра
+# из GRADE_RECALC_PARAMS или число. 'then' и 'default' — операнд или None (NaN).
+#
+# Расчетные колонки:
+#   dpr_raw    — исходная оценка ДПР (до ограничения, с пропусками)
+#   ne, dpr    — оценка НЭ и ограниченная оценка ДПР (пропуск = 0)
+#   innopolis  — внешнее измерение текущего этапа (пропуск = 0)
+#   max_grade  — максимум из ne, dpr, innopolis
+#   drop_input_mid, drop_input_final, drop_mid_final — падение оценки между этапами
+
+GRADE_RULES_DPR_CAP = {
+    'rules': [
+        {'name': 'Ограничение ДПР', 'when': [('dpr_raw', '>=', 'dpr_cap_threshold')], 'then': 'dpr_cap_value'},
+    ],
+    'default': 'dpr_raw',
+}
+
+# Общие для ДПР_итог и НЭ_итог правила, проверяются первыми
+GRADE_RULES_COMMON = [
+    {'name': 'Динамика: падение вход → промежуточный',
+     'when': [('use_dynamics', '==', True), ('drop_input_mid', '>', 'dynamics_max_drop')], 'then': None},
+    {'name': 'Динамика: падение вход → итоговый',
+     'when': [('use_dynamics', '==', True), ('drop_input_final', '>', 'dynamics_max_drop')], 'then': None},
+    {'name': 'Динамика: падение промежуточный → итоговый',
+     'when': [('use_dynamics', '==', True), ('drop_mid_final', '>', 'dynamics_max_drop')], 'then': None},
+    {'name': 'НЭ не сдан', 'when': [('ne', '<', 4)], 'then': None},
+    {'name': 'Внешнее измерение — единственный максимум',
+     'when': [('innopolis', '==', 'max_grade'), ('innopolis', '>', 3),
+              ('innopolis', '!=', 'dpr'), ('innopolis', '!=', 'ne')],
+     'then': 'innopolis'},
+    {'name': 'НЭ равна ДПР', 'when': [('ne', '==', 'dpr')], 'then': None},
+]
+
+GRADE_RULE_TABLES = {
+    'ДПР_итог': {
+        'rules': GRADE_RULES_COMMON + [
+            {'name': 'ДПР не сдан', 'when': [('dpr', '<', 4), ('ne', '>=', 4)], 'then': 'ne'},
+            {'name': 'ДПР не сдан, НЭ не сдан', 'when': [('dpr', '<', 4)], 'then': None},
+            {'name': 'ДПР — максимум', 'when': [('max_grade', '==', 'dpr'), ('dpr', '>=', 4)], 'then': None},
+        ],
+        'default': 'ne',
+    },
+    'НЭ_итог': {
+        'rules': GRADE_RULES_COMMON + [
+            {'name': 'ДПР — максимум, НЭ от 8',
+             'when': [('max_grade', '==', 'dpr'), ('dpr', '>=', 4), ('ne', '>=', 8)], 'then': None},
+            {'name': 'ДПР — максимум, ДПР от 8',
+             'when': [('max_grade', '==', 'dpr'), ('dpr', '>=', 4), ('dpr', '>=', 8)], 'then': 8},
+            {'name': 'ДПР — максимум', 'when': [('max_grade', '==', 'dpr'), ('dpr', '>=', 4)], 'then': 'dpr'},
+            {'name': 'НЭ не сдан, засчитывается внешнее измерение',
+             'when': [('ne', '<', 4), ('innopolis', '>', 3), ('use_dynamics', '==', True)], 'then': 'innopolis'},
+        ],
+        'default': None,
+    },
+}
+
 # =============================================================================
 # COVER (ОБЛОЖКИ) CONSTANTS
 # =============================================================================
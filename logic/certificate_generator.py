@@ -0,0 +1,93 @@
+"""
+Logic for Certificate Generator Module
+"""
+import pandas as pd
+from typing import Dict, Tuple
+
+
+def deduplicate_lines(text):
+    """Удаляет дублирующиеся строки из текста"""
+    if pd.isna(text) or not isinstance(text, str):
+        return text
+    
+    lines = text.split('\n')
+    seen_lines = set()
+    unique_lines = []
+    
+    for line in lines:
+        line_clean = line.strip()
+        if line_clean and line_clean not in seen_lines:
+            seen_lines.add(line_clean)
+            unique_lines.append(line)
+    
+    return '\n'.join(unique_lines)
+
+def build_grade_mapping(skills_df: pd.DataFrame) -> Dict[str, str]:
+    """Справочник навыков: ключ 'Дисциплина—Уровень_оценки' → описание навыков"""
+    grade_mapping = {}
+    for _, row in skills_df.iterrows():
+        discipline = row['Дисциплина']
+        level = row['Уровень_оценки']
+        description = row['Описание_навыков']
+        clean_description = deduplicate_lines(description)
+        composite_key = f"{discipline}—{level}"
+        grade_mapping[composite_key] = clean_description
+    
+    return grade_mapping
+
+def process_student_data(df: pd.DataFrame, grade_mapping: Dict[str, str]) -> Tuple[pd.DataFrame, list]:
+    """Обработка данных студентов для сертификатов"""
+    results = []
+    processing_log = []
+    
+    processing_log.append(f"Обрабатываем {len(df)} студентов")
+    
+    for index, row in df.iterrows():
+        student_results = []
+        processed_keys = set()
+        
+        for discipline_num in range(1, 4):
+            discipline_col = f"Дисциплина {discipline_num}"
+            grade_5_col = f"Оценка 5 баллов Дисциплина {discipline_num}"
+            
+            if discipline_col not in df.columns or grade_5_col not in df.columns:
+                continue
+                
+            discipline_value = str(row[discipline_col]).strip()
+            grade_value = str(row[grade_5_col]).strip()
+            
+            if pd.isna(discipline_value) or pd.isna(grade_value) or discipline_value == 'nan' or grade_value == 'nan':
+                continue
+            
+            lookup_key = f"{discipline_value}—{grade_value}"
+            
+            if lookup_key in processed_keys:
+                continue
+            
+            if lookup_key in grade_mapping:
+                skill_description = grade_mapping[lookup_key]
+                
+                short_name_col = f"Название Дисциплины {discipline_num}"
+                if short_name_col in df.columns:
+                    display_name = str(row[short_name_col]).strip()
+                    formatted_discipline = display_name.capitalize() if display_name != 'nan' and display_name else discipline_value
+                else:
+                    formatted_discipline = discipline_value
+                
+                formatted_result = f"{formatted_discipline}:\n{skill_description}"
+                student_results.append(formatted_result)
+                processed_keys.add(lookup_key)
+        
+        final_result = "\n\n".join(student_results) if student_results else "Навыки не найдены."
+        results.append(final_result)
+    
+    processing_log.append(f"Успешно обработано")
+    
+    df_result = df.copy()
+    df_result['Итоговый результат'] = results
+    
+    columns_to_remove = [col for col in df_result.columns if col.startswith("Название Дисциплины ")]
+    if columns_to_remove:
+        df_result = df_result.drop(columns=columns_to_remove)
+    
+    return df_result, processing_log
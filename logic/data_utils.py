@@ -2,9 +2,11 @@
 Data Utilities
 Reusable pandas functions for data cleaning, normalization, and validation.
 """
+import numpy as np
 import pandas as pd
 from io import StringIO
-from typing import List
+from typing import Callable, List
+from constants import COMPACT_CATEGORY_COLUMNS, CATEGORY_MAX_UNIQUE_RATIO
 
 
 def read_uploaded_file(uploaded_file) -> pd.DataFrame:
@@ -27,26 +29,117 @@ def read_uploaded_file(uploaded_file) -> pd.DataFrame:
     else:
         raise ValueError(f"Неподдерживаемый формат файла: {file_name}")
 
+def _transform_strings(series: pd.Series, func: Callable[[pd.Series], pd.Series]) -> pd.Series:
+    """
+    Строковое преобразование с сохранением category: для категориальной колонки
+    func применяется только к категориям. Пропуски, как и при astype(str), становятся 'nan'.
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return func(series.astype(str))
+    # Код -1 (пропуск) указывает на последний элемент — 'nan'
+    categories = pd.Series(series.cat.categories.astype(str).tolist() + ['nan'])
+    remap, uniques = pd.factorize(func(categories))
+    codes = remap[series.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, uniques), index=series.index, name=series.name)
+
 def clean_email_column(df: pd.DataFrame, column_name: str) -> pd.DataFrame:
     """Очистка и нормализация колонки с email-адресами (нижний регистр, удаление пробелов)."""
     if column_name in df.columns:
-        df[column_name] = df[column_name].astype(str).str.strip().str.lower()
+        df[column_name] = _transform_strings(df[column_name], lambda s: s.str.strip().str.lower())
     return df
 
 def clean_string_column(df: pd.DataFrame, column_name: str) -> pd.DataFrame:
     """Удаление пробелов по краям строковых данных в указанной колонке."""
     if column_name in df.columns:
-        df[column_name] = df[column_name].astype(str).str.strip()
+        df[column_name] = _transform_strings(df[column_name], lambda s: s.str.strip())
     return df
 
 def filter_valid_grades(df: pd.DataFrame, column_name: str) -> pd.DataFrame:
     """Удаление пустых, NaN и невалидных значений оценок из колонки."""
     if column_name in df.columns:
-        df = df[df[column_name].notna()]
-        df = df[df[column_name].astype(str).str.strip() != '']
-        df = df[df[column_name].astype(str).str.strip().str.lower() != 'nan']
+        series = df[column_name]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Проверяются только категории, строки отбираются по кодам
+            stripped = series.cat.categories.astype(str).str.strip()
+            valid_categories = (stripped != '') & (stripped.str.lower() != 'nan')
+            codes = series.cat.codes.to_numpy()
+            mask = (codes >= 0) & np.append(valid_categories, False)[codes]
+        else:
+            stripped = series.astype(str).str.strip()
+            mask = series.notna().to_numpy() & (stripped != '').to_numpy() & (stripped.str.lower() != 'nan').to_numpy()
+        df = df[mask]
     return df
 
 def extract_missing_columns(df: pd.DataFrame, required_columns: List[str]) -> List[str]:
     """Возвращает список колонок, которых не хватает в DataFrame."""
     return [col for col in required_columns if col not in df.columns]
+
+def to_small_numeric(series: pd.Series) -> pd.Series:
+    """
+    Оценки в компактный числовой тип: int8, если все значения целые и без пропусков,
+    иначе float32. Нечисловые значения становятся NaN.
+    """
+    numeric = pd.to_numeric(series, errors='coerce')
+    values = numeric.to_numpy(dtype=float)
+    if len(values) and not np.isnan(values).any() and (values == np.round(values)).all() \
+            and values.min() >= np.iinfo(np.int8).min and values.max() <= np.iinfo(np.int8).max:
+        return numeric.astype(np.int8)
+    return numeric.astype(np.float32)
+
+def compact_dtypes(df: pd.DataFrame, category_columns: List[str] = None, grade_columns: List[str] = None,
+                   max_unique_ratio: float = CATEGORY_MAX_UNIQUE_RATIO) -> pd.DataFrame:
+    """
+    Перевод повторяющихся строковых колонок в category и оценок в компактный числовой тип.
+
+    Колонка становится категориальной, только если доля уникальных значений не больше
+    max_unique_ratio — иначе category занимает больше памяти, чем object.
+
+    Args:
+        df: Загруженный DataFrame (изменяется на месте)
+        category_columns: Кандидаты в category (по умолчанию COMPACT_CATEGORY_COLUMNS)
+        grade_columns: Колонки с числовыми оценками для to_small_numeric
+
+    Returns:
+        Тот же DataFrame
+    """
+    if category_columns is None:
+        category_columns = COMPACT_CATEGORY_COLUMNS
+    grade_columns = grade_columns or []
+
+    for col in grade_columns:
+        if col in df.columns:
+            df[col] = to_small_numeric(df[col])
+
+    n_rows = len(df)
+    for col in category_columns:
+        if col in grade_columns or col not in df.columns or not n_rows:
+            continue
+        if df[col].dtype == object and df[col].nunique(dropna=True) <= n_rows * max_unique_ratio:
+            df[col] = df[col].astype('category')
+    return df
+
+def fill_missing(series: pd.Series, value) -> pd.Series:
+    """fillna для любой колонки: для category недостающее значение добавляется в категории."""
+    if isinstance(series.dtype, pd.CategoricalDtype) and value not in series.cat.categories:
+        series = series.cat.add_categories([value])
+    return series.fillna(value)
+
+def coalesce_columns(primary: pd.Series, fallback: pd.Series) -> pd.Series:
+    """
+    Значение из primary, а где его нет — из fallback.
+
+    Если хотя бы одна колонка категориальная, обе приводятся к объединенным категориям,
+    и результат остается category.
+    """
+    if isinstance(primary.dtype, pd.CategoricalDtype) or isinstance(fallback.dtype, pd.CategoricalDtype):
+        def categories_of(series):
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                return series.cat.categories
+            return pd.Index(series.dropna().unique())
+        dtype = pd.CategoricalDtype(categories_of(primary).union(categories_of(fallback), sort=False))
+        primary, fallback = primary.astype(dtype), fallback.astype(dtype)
+    return primary.where(primary.notna(), fallback)
+
+def frame_memory_mb(df: pd.DataFrame) -> float:
+    """Полный объем памяти DataFrame (включая строки) в МБ."""
+    return df.memory_usage(deep=True).sum() / (1024 * 1024)
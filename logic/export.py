@@ -0,0 +1,187 @@
+"""
+Export Engine
+Общий экспорт DataFrame в XLSX, CSV и Parquet для кнопок скачивания всех страниц.
+
+Результат пишется во временный файл на диске (XLSX — в режиме constant_memory
+xlsxwriter), а странице возвращается открытый на чтение поток для st.download_button.
+Экономится память на этапе записи; сама кнопка скачивания читает поток целиком
+и хранит байты в медиа-хранилище Streamlit, поэтому готовый файл в памяти все же
+оказывается один раз.
+"""
+import io
+import os
+import tempfile
+from typing import Iterable, Iterator
+
+import pandas as pd
+import xlsxwriter
+
+# Ограничение количества строк на листе Excel (включая заголовок)
+XLSX_MAX_ROWS = 1_048_576
+
+# Размер порции строк при записи одного большого DataFrame
+EXPORT_CHUNK_SIZE = 50_000
+
+EXPORT_MIME_TYPES = {
+    'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    'csv': "text/csv",
+    'parquet': "application/vnd.apache.parquet",
+}
+
+_XLSX_OPTIONS = {
+    'constant_memory': True,
+    'remove_timezone': True,
+    'default_date_format': 'dd.mm.yyyy hh:mm:ss',
+    'strings_to_urls': False,
+}
+
+
+def iter_frame_chunks(df: pd.DataFrame, chunksize: int = EXPORT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """Разбиение DataFrame на последовательные порции строк (пустой DataFrame дает одну пустую порцию)."""
+    if df.empty:
+        yield df
+        return
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+
+def _write_xlsx(chunks: Iterable[pd.DataFrame], sink, sheet_name: str) -> int:
+    """Построчная запись чанков в XLSX в режиме constant_memory (новый лист при переполнении)."""
+    workbook = xlsxwriter.Workbook(sink, _XLSX_OPTIONS)
+    worksheet, row_idx, sheet_num, columns = None, 0, 0, None
+    total_rows = 0
+    try:
+        for chunk in chunks:
+            if columns is None:
+                columns = [str(col) for col in chunk.columns]
+            values = chunk.astype(object).where(chunk.notna(), None)
+            for record in values.itertuples(index=False, name=None):
+                if worksheet is None or row_idx >= XLSX_MAX_ROWS:
+                    sheet_num += 1
+                    worksheet = workbook.add_worksheet(sheet_name if sheet_num == 1 else f"{sheet_name}_{sheet_num}")
+                    worksheet.write_row(0, 0, columns)
+                    row_idx = 1
+                worksheet.write_row(row_idx, 0, record)
+                row_idx += 1
+            total_rows += len(chunk)
+        if worksheet is None:
+            worksheet = workbook.add_worksheet(sheet_name)
+            if columns:
+                worksheet.write_row(0, 0, columns)
+    finally:
+        workbook.close()
+    return total_rows
+
+
+def _write_csv(chunks: Iterable[pd.DataFrame], sink, sep: str) -> int:
+    """Дозапись чанков в бинарный CSV-приемник (UTF-8 с BOM для Excel)."""
+    total_rows = 0
+    for i, chunk in enumerate(chunks):
+        encoding = 'utf-8-sig' if i == 0 else 'utf-8'
+        sink.write(chunk.to_csv(index=False, header=(i == 0), sep=sep).encode(encoding))
+        total_rows += len(chunk)
+    return total_rows
+
+
+def _write_parquet(chunks: Iterable[pd.DataFrame], sink) -> int:
+    """Запись чанков в Parquet: каждый чанк — отдельная row group."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Для экспорта в Parquet требуется пакет pyarrow") from e
+
+    writer = None
+    total_rows = 0
+    try:
+        for chunk in chunks:
+            if writer is None:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                writer = pq.ParquetWriter(sink, table.schema)
+            else:
+                table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+            writer.write_table(table)
+            total_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return total_rows
+
+
+def write_chunks(chunks: Iterable[pd.DataFrame], sink, fmt: str = 'xlsx',
+                 sheet_name: str = 'Sheet1', sep: str = ',') -> int:
+    """
+    Запись последовательности чанков в бинарный приемник.
+
+    Чанки записываются по мере поступления, поэтому пиковая память
+    определяется размером чанка, а не объемом результата.
+
+    Args:
+        chunks: Итерируемые DataFrame с одинаковыми колонками
+        sink: Путь или бинарный файловый объект
+        fmt: 'xlsx', 'csv' или 'parquet'
+        sheet_name: Имя листа для XLSX
+        sep: Разделитель для CSV
+
+    Returns:
+        Количество записанных строк
+    """
+    if fmt == 'xlsx':
+        return _write_xlsx(chunks, sink, sheet_name)
+    if fmt == 'csv':
+        return _write_csv(chunks, sink, sep)
+    if fmt == 'parquet':
+        return _write_parquet(chunks, sink)
+    raise ValueError(f"Неподдерживаемый формат экспорта: {fmt}")
+
+
+def write_dataframe(df: pd.DataFrame, sink, fmt: str = 'xlsx', sheet_name: str = 'Sheet1', sep: str = ',') -> int:
+    """Запись одного DataFrame в бинарный приемник порциями по EXPORT_CHUNK_SIZE строк."""
+    return write_chunks(iter_frame_chunks(df), sink, fmt=fmt, sheet_name=sheet_name, sep=sep)
+
+
+def dataframe_to_bytes(df: pd.DataFrame, fmt: str = 'xlsx', sheet_name: str = 'Sheet1', sep: str = ',') -> bytes:
+    """Экспорт в байты — для вложения результата в архив."""
+    buffer = io.BytesIO()
+    write_dataframe(df, buffer, fmt=fmt, sheet_name=sheet_name, sep=sep)
+    return buffer.getvalue()
+
+
+def open_export_file(path: str) -> io.BufferedReader:
+    """
+    Открытие готового файла экспорта на чтение с удалением его из файловой системы.
+
+    На POSIX файл исчезает сразу и освобождается после закрытия потока;
+    если ОС не позволяет удалить открытый файл, он остается во временной директории.
+    """
+    stream = open(path, 'rb')
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    return stream
+
+
+def export_dataframe(df: pd.DataFrame, fmt: str = 'xlsx', sheet_name: str = 'Sheet1',
+                     sep: str = ',') -> io.BufferedReader:
+    """
+    Экспорт DataFrame во временный файл для st.download_button.
+
+    Args:
+        df: Данные для экспорта
+        fmt: 'xlsx', 'csv' или 'parquet'
+        sheet_name: Имя листа для XLSX
+        sep: Разделитель для CSV
+
+    Returns:
+        Поток на чтение готового файла (передается в data= кнопки скачивания, которая
+        читает его в память целиком)
+    """
+    with tempfile.NamedTemporaryFile(suffix=f'.{fmt}', delete=False) as sink:
+        try:
+            write_dataframe(df, sink, fmt=fmt, sheet_name=sheet_name, sep=sep)
+        except Exception:
+            sink.close()
+            os.unlink(sink.name)
+            raise
+    return open_export_file(sink.name)
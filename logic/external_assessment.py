@@ -1,159 +1,660 @@
 """
 Logic for External Assessment Module
 """
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from typing import Tuple, List
-from utils import get_supabase_client, fetch_all_from_supabase
-from logic.data_utils import clean_email_column, clean_string_column, filter_valid_grades
+from typing import Dict, Tuple, List, Optional
+from utils import (
+    get_supabase_client, fetch_all_from_supabase, iter_payload_batches, map_concurrently,
+    run_in_background, has_email_key
+)
+from logic.data_utils import (
+    clean_email_column, clean_string_column, filter_valid_grades,
+    compact_dtypes, coalesce_columns, fill_missing, to_small_numeric
+)
 import constants
 
-def load_existing_peresdachi() -> pd.DataFrame:
-    """Загрузка существующих записей из таблицы peresdachi"""
+def _fetch_by_emails(table_name: str, emails: List[str], columns: List[str] = None, filters: dict = None,
+                     chunk_size: int = constants.KEY_PROBE_CHUNK_SIZE, page_size: int = 1000,
+                     require_email_key: bool = False) -> Optional[list]:
+    """
+    Строки таблицы с указанными (нормализованными) email.
+
+    Email передаются порциями в фильтре in_ по индексированной колонке email_key, поэтому
+    объем запросов и ответа зависит от числа email, а не от размера таблицы. Без колонки
+    email_key фильтр идет по исходной колонке и не находит email, сохраненные в другом
+    регистре; при require_email_key в этом случае возвращается None.
+    """
+    rows = []
+    for i in range(0, len(emails), chunk_size):
+        chunk_filters = {constants.COL_EMAIL: emails[i:i + chunk_size], **(filters or {})}
+        rows.extend(fetch_all_from_supabase(
+            table_name, filters=chunk_filters, page_size=page_size, columns=columns, email_key=constants.COL_EMAIL
+        ))
+        if require_email_key and not has_email_key(table_name):
+            return None
+    return rows
+
+def load_existing_peresdachi(columns: List[str] = None, normalize_email: bool = False,
+                             emails: List[str] = None) -> pd.DataFrame:
+    """
+    Загрузка существующих записей из таблицы peresdachi (columns — только нужные колонки).
+    normalize_email — email в нижнем регистре без пробелов (из колонки email_key в БД).
+    emails — только записи этих email (ключевые запросы, email нормализован); без колонки
+    email_key в БД загружается вся таблица.
+    """
     try:
-        all_data = fetch_all_from_supabase(constants.DB_TABLE_PERESDACHI)
+        all_data = None
+        if emails is not None:
+            all_data = _fetch_by_emails(constants.DB_TABLE_PERESDACHI, emails, columns=columns, require_email_key=True)
+        if all_data is None:
+            all_data = fetch_all_from_supabase(
+                constants.DB_TABLE_PERESDACHI, columns=columns,
+                email_key=constants.COL_EMAIL if normalize_email or emails is not None else None
+            )
         if all_data:
-            return pd.DataFrame(all_data)
+            return compact_dtypes(pd.DataFrame(all_data).drop(columns=[constants.EMAIL_KEY_COLUMN], errors='ignore'))
         return pd.DataFrame()
     except Exception as e:
         raise ValueError(f"Таблица peresdachi не найдена или пуста: {str(e)}")
 
-def load_peresdachi_by_date_range(date_from, date_to) -> pd.DataFrame:
+def load_peresdachi_by_date_range(date_from, date_to, columns: List[str] = None) -> pd.DataFrame:
     """Загрузка записей из таблицы peresdachi с фильтром по дате добавления (created_at).
     
     Args:
         date_from: datetime.date — начало диапазона (включительно)
         date_to:   datetime.date — конец диапазона (включительно)
+        columns:   только нужные колонки (по умолчанию все)
     
     Returns:
         pd.DataFrame с записями за указанный период
     """
     try:
         from datetime import timedelta
-        supabase = get_supabase_client()
 
         # Преобразуем даты в ISO-строки для Supabase
         from_str = date_from.isoformat()
         # Добавляем 1 день, чтобы включить записи созданные в течение всего дня date_to
         to_str = (date_to + timedelta(days=1)).isoformat()
 
-        all_data = []
-        page_size = 1000
-        offset = 0
-
-        while True:
-            response = (
-                supabase.table(constants.DB_TABLE_PERESDACHI)
-                .select("*")
-                .gte("created_at", from_str)
-                .lt("created_at", to_str)
-                .range(offset, offset + page_size - 1)
-                .execute()
-            )
-            if response.data:
-                all_data.extend(response.data)
-                if len(response.data) < page_size:
-                    break
-                offset += page_size
-            else:
-                break
+        all_data = fetch_all_from_supabase(
+            constants.DB_TABLE_PERESDACHI,
+            conditions=[('gte', 'created_at', from_str), ('lt', 'created_at', to_str)],
+            columns=columns
+        )
 
         if all_data:
-            return pd.DataFrame(all_data)
+            # Служебный email_key (sql/migration_add_email_keys.sql) в выгрузку не попадает
+            return compact_dtypes(pd.DataFrame(all_data).drop(columns=[constants.EMAIL_KEY_COLUMN], errors='ignore'))
         return pd.DataFrame()
     except Exception as e:
         raise ValueError(f"Ошибка при загрузке данных peresdachi по диапазону дат: {str(e)}")
 
-def load_student_io_from_supabase() -> pd.DataFrame:
-    """Загрузка данных из таблицы student_io"""
+def load_student_io_from_supabase(emails: List[str] = None) -> pd.DataFrame:
+    """
+    Загрузка данных из таблицы student_io (email уже нормализован в колонке email_key).
+    emails — только строки этих email (ключевые запросы по индексу (email_key, дисциплина));
+    без колонки email_key в БД загружается вся таблица.
+    """
     try:
-        select_query = f'"{constants.COL_EMAIL}", "{constants.COL_DISCIPLINE}", "{constants.COL_GRADE}"'
-        all_data = fetch_all_from_supabase(constants.DB_TABLE_STUDENT_IO, select_query=select_query)
+        all_data = None
+        if emails is not None:
+            all_data = _fetch_by_emails(
+                constants.DB_TABLE_STUDENT_IO, emails, columns=constants.GRADE_LOOKUP_COLUMNS, require_email_key=True
+            )
+        if all_data is None:
+            all_data = fetch_all_from_supabase(
+                constants.DB_TABLE_STUDENT_IO, columns=constants.GRADE_LOOKUP_COLUMNS, email_key=constants.COL_EMAIL
+            )
         
         if all_data:
             df = pd.DataFrame(all_data)
-            df = clean_email_column(df, constants.COL_EMAIL)
             df = clean_string_column(df, constants.COL_DISCIPLINE)
             df = clean_string_column(df, constants.COL_GRADE)
-            return df
+            return compact_dtypes(df)
         return pd.DataFrame()
     except Exception as e:
         raise ValueError(f"Ошибка при загрузке данных из {constants.DB_TABLE_STUDENT_IO}: {str(e)}")
 
-def load_registration_data_from_supabase() -> pd.DataFrame:
-    """Загрузка данных из таблицы registration_data"""
+def load_registration_data_from_supabase(columns: List[str] = None, emails: List[str] = None) -> pd.DataFrame:
+    """
+    Загрузка данных из таблицы registration_data (columns — только нужные колонки).
+    Email нормализован в БД (колонка email_key). emails — только строки этих email
+    (ключевые запросы по индексу (email_key, дисциплина)); без email_key — вся таблица.
+    """
     try:
-        all_data = fetch_all_from_supabase(constants.DB_TABLE_REGISTRATION_DATA)
+        all_data = None
+        if emails is not None:
+            all_data = _fetch_by_emails(
+                constants.DB_TABLE_REGISTRATION_DATA, emails, columns=columns, require_email_key=True
+            )
+        if all_data is None:
+            all_data = fetch_all_from_supabase(
+                constants.DB_TABLE_REGISTRATION_DATA, columns=columns, email_key=constants.COL_EMAIL
+            )
         if all_data:
-            df = pd.DataFrame(all_data)
-            df = clean_email_column(df, constants.COL_EMAIL)
-            return df
+            return compact_dtypes(pd.DataFrame(all_data))
         return pd.DataFrame()
     except Exception as e:
         print(f"Ошибка при загрузке данных из {constants.DB_TABLE_REGISTRATION_DATA}: {str(e)}")
         return pd.DataFrame()
 
-def save_to_supabase(df: pd.DataFrame) -> Tuple[bool, str]:
-    """Сохранение данных в таблицу peresdachi в Supabase с использованием insert"""
-    # Список колонок, которые реально существуют в таблице peresdachi
-    PERESDACHI_COLUMNS = {
-        constants.COL_FIO,
-        constants.COL_EMAIL,
-        constants.COL_CAMPUS,
-        constants.COL_FACULTY,
-        constants.COL_PROGRAM,
-        constants.COL_GROUP,
-        constants.COL_COURSE,
-        constants.COL_ID_DISCIPLINE,
-        constants.COL_DISCIPLINE,
-        constants.COL_PERIOD,
-        constants.COL_GRADE,
-        constants.COL_CANCEL,
-    }
+# Колонки, которые реально существуют в таблице peresdachi
+PERESDACHI_COLUMNS = {
+    constants.COL_FIO,
+    constants.COL_EMAIL,
+    constants.COL_CAMPUS,
+    constants.COL_FACULTY,
+    constants.COL_PROGRAM,
+    constants.COL_GROUP,
+    constants.COL_COURSE,
+    constants.COL_ID_DISCIPLINE,
+    constants.COL_DISCIPLINE,
+    constants.COL_PERIOD,
+    constants.COL_GRADE,
+    constants.COL_CANCEL,
+}
+
+def _is_missing_conflict_target(error: Exception) -> bool:
+    """
+    Для ON CONFLICT нет подходящего уникального ограничения (Postgres 42P10)
+    или в таблице еще нет колонки email_key (42703).
+    """
+    message = str(error)
+    if '42P10' in message or 'no unique or exclusion constraint' in message:
+        return True
+    return ('42703' in message or 'does not exist' in message) and constants.EMAIL_KEY_COLUMN in message
+
+def write_peresdachi_batches(records: List[dict], batch_rows: int = constants.WRITE_BATCH_ROWS,
+                             batch_bytes: int = constants.WRITE_BATCH_BYTES,
+                             retries: int = constants.WRITE_BATCH_RETRIES,
+                             insert_fallback: bool = True) -> Tuple[Dict[str, int], List[dict], List[str]]:
+    """
+    Идемпотентная пакетная запись в peresdachi.
+
+    Пакеты ограничены числом строк и размером JSON и отправляются как
+    upsert с ignore_duplicates (ON CONFLICT DO NOTHING) по уникальному индексу
+    (email_key, дисциплина): существующие записи пропускаются, а не прерывают
+    запись. Если индекса еще нет, используется insert, а при insert_fallback=False
+    ошибка пробрасывается до записи первого пакета. Временные ошибки
+    повторяются для отдельного пакета; пакет, не записанный после всех
+    попыток, учитывается как failed, остальные пакеты продолжают запись.
+
+    Returns:
+        (stats, inserted_rows, errors): stats — {'inserted', 'skipped', 'failed'},
+        inserted_rows — записи, которые вернула БД, errors — сообщения по упавшим пакетам
+    """
+    supabase = get_supabase_client()
+    on_conflict = ",".join(f'"{col}"' for col in constants.PERESDACHI_UNIQUE_KEY)
+    stats = {'inserted': 0, 'skipped': 0, 'failed': 0}
+    inserted_rows, errors = [], []
+    use_upsert = True
+
+    for batch in iter_payload_batches(records, batch_rows, batch_bytes):
+        for attempt in range(1, retries + 1):
+            try:
+                table = supabase.table(constants.DB_TABLE_PERESDACHI)
+                if use_upsert:
+                    response = table.upsert(batch, on_conflict=on_conflict, ignore_duplicates=True).execute()
+                else:
+                    response = table.insert(batch).execute()
+                returned = response.data or []
+                stats['inserted'] += len(returned)
+                stats['skipped'] += len(batch) - len(returned)
+                inserted_rows.extend(returned)
+                break
+            except Exception as e:
+                if use_upsert and _is_missing_conflict_target(e):
+                    if not insert_fallback:
+                        raise
+                    use_upsert = False
+                    continue
+                # Нарушение ограничения не исправится повтором
+                if attempt == retries or 'duplicate key value' in str(e):
+                    stats['failed'] += len(batch)
+                    errors.append(str(e))
+                    break
+                else:
+                    time.sleep(constants.WRITE_RETRY_DELAY * attempt)
+    return stats, inserted_rows, errors
+
+def _write_peresdachi(df: pd.DataFrame, snapshot: 'ReferenceSnapshot' = None,
+                      insert_fallback: bool = True) -> Tuple[Dict[str, int], List[dict], List[str]]:
+    """
+    Запись df в peresdachi (write_peresdachi_batches): только колонки схемы таблицы,
+    повторы (email, дисциплина) внутри df учитываются как пропущенные.
+    Если передан snapshot, вставленные записи добавляются в него.
+    """
+    # Оставляем только колонки, присутствующие и в датафрейме, и в схеме таблицы
+    cols_to_save = [c for c in df.columns if c in PERESDACHI_COLUMNS]
+    key_cols = [c for c in constants.PERESDACHI_CONFLICT_COLUMNS if c in cols_to_save]
+    df_to_save = df[cols_to_save].drop_duplicates(subset=key_cols or None)
+    payload_duplicates = len(df) - len(df_to_save)
+
+    records = df_to_save.astype(object).where(df_to_save.notna(), None).to_dict('records')
+    stats, inserted_rows, errors = write_peresdachi_batches(records, insert_fallback=insert_fallback)
+    stats['skipped'] += payload_duplicates
+
+    if snapshot is not None and inserted_rows:
+        snapshot.record_saved(pd.DataFrame(inserted_rows))
+    return stats, inserted_rows, errors
+
+def _save_result(stats: Dict[str, int], errors: List[str]) -> Tuple[bool, str]:
+    """Успех и сообщение о сохранении; успех — ни одна запись не потеряна."""
+    message = f"Сохранено записей: {stats['inserted']}. Пропущено дубликатов: {stats['skipped']}."
+    if stats['failed']:
+        return False, f"{message} Не удалось сохранить: {stats['failed']} ({errors[-1]})"
+    return True, message
+
+def save_to_supabase(df: pd.DataFrame, snapshot: 'ReferenceSnapshot' = None) -> Tuple[bool, str, Dict[str, int]]:
+    """
+    Сохранение данных в таблицу peresdachi в Supabase пакетами (write_peresdachi_batches).
+    Повторы (email, дисциплина) внутри df и уже существующие в БД записи пропускаются.
+    Если передан snapshot, вставленные записи добавляются в него.
+
+    Returns:
+        (успех, сообщение, {'inserted', 'skipped', 'failed'}); успех — ни одна запись не потеряна
+    """
+    stats = {'inserted': 0, 'skipped': 0, 'failed': 0}
     try:
-        supabase = get_supabase_client()
         if df.empty:
-            return False, "Нет данных для сохранения."
+            return False, "Нет данных для сохранения.", stats
 
-        # Оставляем только колонки, присутствующие и в датафрейме, и в схеме таблицы
-        cols_to_save = [c for c in df.columns if c in PERESDACHI_COLUMNS]
-        df_to_save = df[cols_to_save]
+        stats, _, errors = _write_peresdachi(df, snapshot)
+        success, message = _save_result(stats, errors)
+        return success, message, stats
+    except Exception as e:
+        return False, f"Ошибка при сохранении в Supabase: {str(e)}", stats
+
+def load_existing_keys(emails: List[str], disciplines: List[str] = None, columns: List[str] = None,
+                       chunk_size: int = constants.KEY_PROBE_CHUNK_SIZE, page_size: int = 1000) -> pd.DataFrame:
+    """
+    Загрузка из peresdachi только записей с указанными email.
 
-        cleaned_records = []
-        for record in df_to_save.to_dict('records'):
-            cleaned_record = {k: (v if pd.notna(v) else None) for k, v in record.items()}
-            cleaned_records.append(cleaned_record)
+    Email передаются порциями в фильтре in_ по индексированной колонке email_key,
+    поэтому объем запроса и ответа зависит от размера загрузки, а не от размера
+    таблицы, а регистр и пробелы в сохраненных email не мешают совпадению.
 
-        supabase.table(constants.DB_TABLE_PERESDACHI).insert(cleaned_records).execute()
-        return True, "Данные успешно сохранены."
-    except Exception as e:
-        if "duplicate key value violates unique constraint" in str(e):
-            return True, "Обнаружены дубликаты при сохранении. Они были проигнорированы. Остальные данные сохранены."
-        return False, f"Ошибка при сохранении в Supabase: {str(e)}"
+    Args:
+        emails: Нормализованные email загрузки
+        disciplines: Ограничение по дисциплинам (необязательно); пробелы по краям
+            отбрасываются — так дисциплины хранятся в peresdachi (migration_peresdachi_unique_key.sql)
+        columns: Колонки ответа (по умолчанию только ключ: email и дисциплина)
+        chunk_size: Количество email в одном запросе
+        page_size: Размер страницы ответа
+
+    Returns:
+        pd.DataFrame с запрошенными колонками
+    """
+    columns = columns or [constants.COL_EMAIL, constants.COL_DISCIPLINE]
+    if not emails:
+        return pd.DataFrame(columns=columns)
+
+    disciplines = sorted({str(d).strip() for d in disciplines or [] if str(d).strip()})
+    filters = {constants.COL_DISCIPLINE: disciplines} if disciplines else None
+    rows = _fetch_by_emails(
+        constants.DB_TABLE_PERESDACHI, emails, columns=columns, filters=filters,
+        chunk_size=chunk_size, page_size=page_size
+    )
+    # Email уже нормализован (email_key); дисциплина приводится к тому же виду, что и в фильтре
+    return clean_string_column(pd.DataFrame(rows, columns=columns), constants.COL_DISCIPLINE)
+
+def upload_emails(grades_df: pd.DataFrame, project: bool = False) -> List[str]:
+    """
+    Нормализованные email файла оценок — те же, которыми process_external_assessment
+    (project=False) или process_project_assessment (project=True) ограничит снимок.
+    Используется для предзагрузки снимка до запуска обработки.
+    """
+    if constants.COL_EMAIL not in grades_df.columns:
+        return []
+    emails = grades_df[[constants.COL_EMAIL]]
+    if not project:
+        emails = emails.astype(str)
+        emails[constants.COL_EMAIL] = emails[constants.COL_EMAIL].str.replace('-', '', regex=False).str.strip()
+    return clean_email_column(emails.copy(), constants.COL_EMAIL)[constants.COL_EMAIL].unique().tolist()
+
+class ReferenceSnapshot:
+    """
+    Справочные таблицы одного запуска обработки внешнего измерения.
+
+    Каждая таблица загружается не более одного раза и только с нужными колонками;
+    снимок передается через обработку, дедупликацию и сохранение, а сохраненные
+    записи добавляются в него, чтобы он оставался согласованным с БД. Снимок,
+    ограниченный email загрузки (scope), читает из таблиц только их строки.
+    """
+
+    # Справочная таблица -> свойство снимка, которое ее загружает
+    _TABLE_ATTRS = {
+        constants.DB_TABLE_REGISTRATION_DATA: 'registration',
+        constants.DB_TABLE_STUDENT_IO: 'student_io',
+        constants.DB_TABLE_PERESDACHI: 'peresdachi',
+    }
+
+    def __init__(self):
+        self._registration = None
+        self._student_io = None
+        self._peresdachi = None
+        self._registration_lookup = None
+        self._grade_lookups = {}
+        self._student_lookup = (None, None)
+        # Таблицу загружает один поток: обращение во время фоновой загрузки ее дожидается
+        self._load_locks = {attr: threading.Lock() for attr in self._TABLE_ATTRS.values()}
+        # Email, строками которых ограничены таблицы (None — таблицы целиком)
+        self._emails = None
+        self._scope_lock = threading.Lock()
+        self.created_at = time.monotonic()
 
-def get_new_records_from_dataframe(new_df: pd.DataFrame) -> pd.DataFrame:
-    """Получить только новые записи, сравнивая с существующими в БД"""
+    def _load_once(self, attr: str, loader) -> pd.DataFrame:
+        value = getattr(self, f'_{attr}')
+        if value is None:
+            with self._load_locks[attr]:
+                value = getattr(self, f'_{attr}')
+                if value is None:
+                    value = loader()
+                    setattr(self, f'_{attr}', value)
+        return value
+
+    @property
+    def scoped_emails(self) -> Optional[List[str]]:
+        """Email области снимка (отсортированы) или None, если таблицы загружаются целиком."""
+        emails = self._emails
+        return sorted(emails) if emails is not None else None
+
+    def scope(self, emails) -> 'ReferenceSnapshot':
+        """
+        Ограничение справочных таблиц строками email загрузки (нормализованных).
+
+        Если email не больше REFERENCE_PROBE_MAX_EMAILS, еще не загруженные таблицы
+        читаются ключевыми запросами по индексам (email_key, дисциплина), а не целиком.
+        Таблицы, уже загруженные целиком, остаются как есть. Email вне прежней области
+        расширяют ее, и таблицы, загруженные по прежней области, загружаются заново.
+        """
+        emails = {email for email in emails if isinstance(email, str) and email}
+        with self._scope_lock:
+            if self._emails is None:
+                loaded = any(getattr(self, f'_{attr}') is not None for attr in self._TABLE_ATTRS.values())
+                if not loaded and len(emails) <= constants.REFERENCE_PROBE_MAX_EMAILS:
+                    self._emails = frozenset(emails)
+                return self
+            if emails <= self._emails:
+                return self
+            merged = self._emails | emails
+            self._emails = frozenset(merged) if len(merged) <= constants.REFERENCE_PROBE_MAX_EMAILS else None
+            # Дожидаемся загрузок по прежней области, чтобы они не перезаписали сброс
+            for attr in self._TABLE_ATTRS.values():
+                with self._load_locks[attr]:
+                    setattr(self, f'_{attr}', None)
+            self._registration_lookup = None
+            self._grade_lookups = {}
+        return self
+
+    @property
+    def age(self) -> float:
+        """Возраст снимка в секундах."""
+        return time.monotonic() - self.created_at
+
+    def prefetch(self, tables: List[str] = None) -> 'ReferenceSnapshot':
+        """
+        Запуск preload в фоновом потоке (например, при открытии страницы).
+
+        Обращение к таблице, которая еще загружается, дожидается фоновой загрузки,
+        а не запускает вторую; если фоновая загрузка упала, таблица загружается заново.
+        """
+        run_in_background(self.preload, tables)
+        return self
+
+    def preload(self, tables: List[str] = None) -> 'ReferenceSnapshot':
+        """
+        Одновременная загрузка еще не загруженных справочных таблиц (по умолчанию всех).
+
+        Таблицы независимы, поэтому ожидание определяется самой медленной из них,
+        а не суммой. Ошибка здесь не выбрасывается: таблица остается незагруженной,
+        и шаг обработки, который к ней обратится, повторит загрузку и обработает
+        ошибку как обычно.
+        """
+        attrs = [self._TABLE_ATTRS[table] for table in (tables or self._TABLE_ATTRS)]
+        pending = [attr for attr in attrs if getattr(self, f'_{attr}') is None]
+        if pending:
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                futures = [executor.submit(getattr, self, attr) for attr in pending]
+                for future in futures:
+                    future.exception()
+        return self
+
+    @property
+    def registration(self) -> pd.DataFrame:
+        return self._load_once('registration', lambda: load_registration_data_from_supabase(
+            columns=constants.REGISTRATION_COLUMNS, emails=self.scoped_emails
+        ))
+
+    @property
+    def student_io(self) -> pd.DataFrame:
+        return self._load_once('student_io', lambda: load_student_io_from_supabase(emails=self.scoped_emails))
+
+    @property
+    def peresdachi(self) -> pd.DataFrame:
+        """Записи peresdachi (email, дисциплина, оценка) с нормализованными email и дисциплиной."""
+        def load():
+            df = load_existing_peresdachi(
+                columns=constants.GRADE_LOOKUP_COLUMNS, normalize_email=True, emails=self.scoped_emails
+            )
+            df = df.reindex(columns=constants.GRADE_LOOKUP_COLUMNS)
+            df = clean_string_column(df, constants.COL_DISCIPLINE)
+            return df.drop_duplicates(subset=[constants.COL_EMAIL, constants.COL_DISCIPLINE])
+        return self._load_once('peresdachi', load)
+
+    @property
+    def registration_lookup(self) -> pd.DataFrame:
+        """
+        registration_data, проиндексированная по (email, дисциплина): очищенные email,
+        кампус в колонке COL_CAMPUS, по одной строке на ключ. Пустая, если таблица пуста.
+        """
+        if self._registration_lookup is None:
+            registration_df = self.registration
+            if registration_df.empty:
+                self._registration_lookup = pd.DataFrame()
+            else:
+                avail_reg_cols = [col for col in _REGISTRATION_JOIN_COLUMNS if col in registration_df.columns]
+                reg_subset = registration_df[avail_reg_cols]
+                if constants.COL_CAMPUS_OLD in reg_subset.columns and constants.COL_CAMPUS not in reg_subset.columns:
+                    reg_subset = reg_subset.rename(columns={constants.COL_CAMPUS_OLD: constants.COL_CAMPUS})
+                merge_keys = [constants.COL_EMAIL]
+                if constants.COL_DISCIPLINE in reg_subset.columns:
+                    merge_keys.append(constants.COL_DISCIPLINE)
+                reg_subset = reg_subset.drop_duplicates(subset=merge_keys)
+                self._registration_lookup = _index_by(reg_subset, merge_keys)
+        return self._registration_lookup
+
+    def grade_lookup(self, table_name: str) -> pd.Series:
+        """Оценки student_io или peresdachi, проиндексированные по (email, дисциплина)."""
+        if table_name not in self._grade_lookups:
+            source = self.student_io if table_name == constants.DB_TABLE_STUDENT_IO else self.peresdachi
+            key_cols = [constants.COL_EMAIL, constants.COL_DISCIPLINE]
+            if source.empty:
+                lookup = pd.Series(dtype=object, index=pd.MultiIndex.from_arrays([[], []], names=key_cols))
+            else:
+                grades = source[key_cols + [constants.COL_GRADE]].drop_duplicates(subset=key_cols)
+                lookup = _index_by(grades, key_cols)[constants.COL_GRADE]
+            self._grade_lookups[table_name] = lookup
+        return self._grade_lookups[table_name]
+
+    def student_lookup(self, students_df: pd.DataFrame) -> pd.DataFrame:
+        """Список студентов, проиндексированный по email (строится один раз для данного students_df)."""
+        cached_df, lookup = self._student_lookup
+        if cached_df is not students_df:
+            avail_stu_cols = [col for col in constants.STUDENT_LOOKUP_COLUMNS if col in students_df.columns]
+            students_subset = clean_email_column(students_df[avail_stu_cols].copy(), constants.COL_EMAIL)
+            if constants.COL_CAMPUS_OLD in students_subset.columns:
+                students_subset = students_subset.rename(columns={constants.COL_CAMPUS_OLD: constants.COL_CAMPUS})
+            students_subset = students_subset.drop_duplicates(subset=[constants.COL_EMAIL])
+            lookup = _index_by(students_subset, [constants.COL_EMAIL])
+            self._student_lookup = (students_df, lookup)
+        return lookup
+
+    def record_saved(self, saved_df: pd.DataFrame) -> None:
+        """Добавление сохраненных записей в снимок (если peresdachi уже загружена)."""
+        if self._peresdachi is None or saved_df.empty:
+            return
+        rows = saved_df.reindex(columns=constants.GRADE_LOOKUP_COLUMNS).astype(object)
+        self._peresdachi = pd.concat([self._peresdachi.astype(object), rows], ignore_index=True).drop_duplicates(
+            subset=[constants.COL_EMAIL, constants.COL_DISCIPLINE], keep='first'
+        )
+        self._grade_lookups.pop(constants.DB_TABLE_PERESDACHI, None)
+
+# Колонки registration_data, которые переносятся в результат
+_REGISTRATION_JOIN_COLUMNS = [
+    constants.COL_FIO, constants.COL_EMAIL, constants.COL_CAMPUS_OLD, constants.COL_CAMPUS,
+    constants.COL_FACULTY, constants.COL_PROGRAM, constants.COL_GROUP, constants.COL_COURSE,
+    constants.COL_CANCEL, constants.COL_ID_DISCIPLINE, constants.COL_DISCIPLINE, constants.COL_PERIOD
+]
+
+# Колонки профиля студента: из registration_data, при пропуске — из списка студентов
+_PROFILE_COLUMNS = [
+    constants.COL_FIO, constants.COL_CAMPUS, constants.COL_FACULTY,
+    constants.COL_PROGRAM, constants.COL_GROUP, constants.COL_COURSE
+]
+
+def _index_by(df: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    """Индекс по ключевым колонкам (значения ключей приводятся к object для сравнения с загрузкой)."""
+    df = df.astype({key: object for key in keys})
+    return df.set_index(keys)
+
+def _lookup_positions(index: pd.Index, df: pd.DataFrame) -> np.ndarray:
+    """
+    Позиции строк df в уникальном индексе справочника (-1 — не найдено).
+
+    Для составного ключа значения сопоставляются с уровнями индекса (хэш-таблицы
+    уровней строятся один раз и переиспользуются между вызовами), а пара кодов
+    уровней сворачивается в одно целое число.
+    """
+    if not isinstance(index, pd.MultiIndex):
+        return index.get_indexer(df[index.name])
+
+    found = np.ones(len(df), dtype=bool)
+    row_keys = np.zeros(len(df), dtype=np.int64)
+    lookup_keys = np.zeros(len(index), dtype=np.int64)
+    for level, codes, name in zip(index.levels, index.codes, index.names):
+        level_codes = level.get_indexer(df[name])
+        found &= level_codes >= 0
+        row_keys = row_keys * len(level) + level_codes
+        lookup_keys = lookup_keys * len(level) + codes
+    # Ключи справочника с пропуском (код -1) не должны совпадать ни с одной строкой
+    missing = (np.asarray(index.codes) < 0).any(axis=0)
+    lookup_keys[missing] = -1 - np.arange(missing.sum())
+    positions = pd.Index(lookup_keys).get_indexer(row_keys)
+    positions[~found] = -1
+    return positions
+
+def _take_rows(lookup: pd.DataFrame, positions: np.ndarray) -> pd.DataFrame:
+    """Строки справочника по позициям; для -1 — пропуски. Типы колонок (в т.ч. category) сохраняются."""
+    values = lookup.reset_index(drop=True)
+    if values.empty:
+        return pd.DataFrame(index=range(len(positions)), columns=values.columns)
+    found = positions >= 0
+    rows = values.iloc[np.where(found, positions, 0)].reset_index(drop=True)
+    if not found.all():
+        rows = rows.where(pd.Series(found))
+    return rows
+
+def enrich_assessment_rows(rows_df: pd.DataFrame, students_df: pd.DataFrame,
+                           snapshot: 'ReferenceSnapshot') -> pd.DataFrame:
+    """
+    Общий этап обеих обработок: присоединение registration_data и списка студентов.
+
+    rows_df — строки оценок с очищенным email и дисциплиной. Данные registration_data
+    берутся по (email, дисциплина), пропуски профиля дополняются из списка студентов
+    по email. Справочники строятся один раз на снимок, соединение — по индексу.
+
+    Returns:
+        DataFrame с колонками профиля, отмены, ID дисциплины и периода (пропуски — '')
+    """
+    registration_lookup = snapshot.registration_lookup
+    student_lookup = snapshot.student_lookup(students_df)
+    result_df = rows_df.reset_index(drop=True)
+
+    if not registration_lookup.empty:
+        reg_rows = _take_rows(registration_lookup, _lookup_positions(registration_lookup.index, result_df))
+        stu_rows = _take_rows(student_lookup, _lookup_positions(student_lookup.index, result_df))
+        stu_rows.columns = [col + '_stu' if col in reg_rows.columns else col for col in stu_rows.columns]
+        result_df = pd.concat([result_df, reg_rows, stu_rows], axis=1)
+
+        for col in _PROFILE_COLUMNS:
+            stu_col = col + '_stu'
+            if col in result_df.columns and stu_col in result_df.columns:
+                result_df[col] = coalesce_columns(result_df[col], result_df[stu_col])
+            elif stu_col in result_df.columns:
+                result_df[col] = result_df[stu_col]
+
+        stu_cols_to_drop = [c for c in result_df.columns if c.endswith('_stu')]
+        result_df = result_df.drop(columns=stu_cols_to_drop)
+    else:
+        stu_rows = _take_rows(student_lookup, _lookup_positions(student_lookup.index, result_df))
+        result_df = pd.concat([result_df, stu_rows], axis=1)
+
+    if constants.COL_CANCEL not in result_df.columns:
+        result_df[constants.COL_CANCEL] = ''
+
+    if constants.COL_ID_DISCIPLINE not in result_df.columns:
+        result_df[constants.COL_ID_DISCIPLINE] = ''
+    else:
+        result_df[constants.COL_ID_DISCIPLINE] = fill_missing(result_df[constants.COL_ID_DISCIPLINE], '')
+
+    if constants.COL_PERIOD not in result_df.columns:
+        result_df[constants.COL_PERIOD] = ''
+    else:
+        result_df[constants.COL_PERIOD] = fill_missing(result_df[constants.COL_PERIOD], '')
+    return result_df
+
+def apply_reference_grades(result_df: pd.DataFrame, grade_lookup: pd.Series) -> pd.DataFrame:
+    """Замена оценок на найденные в справочнике по (email, дисциплина) с последующей валидацией."""
+    if grade_lookup.empty or result_df.empty:
+        return filter_valid_grades(result_df, constants.COL_GRADE)
+    positions = _lookup_positions(grade_lookup.index, result_df)
+    found_mask = positions >= 0
+    # take сохраняет тип справочника (в т.ч. category); ненайденные ключи — NaN
+    found = grade_lookup.iloc[np.where(found_mask, positions, 0)].set_axis(result_df.index).where(found_mask)
+    # Колонка оценки переносится в конец, как и прежде при слиянии
+    result_df = result_df.reset_index(drop=True)
+    grades = coalesce_columns(found.reset_index(drop=True), result_df[constants.COL_GRADE])
+    result_df = result_df.drop(columns=[constants.COL_GRADE]).assign(**{constants.COL_GRADE: grades})
+    return filter_valid_grades(result_df, constants.COL_GRADE)
+
+def get_new_records_from_dataframe(new_df: pd.DataFrame, snapshot: ReferenceSnapshot = None) -> pd.DataFrame:
+    """Получить только новые записи, сравнивая с существующими в БД по ключам загрузки"""
     try:
-        existing_df = load_existing_peresdachi()
+        merge_cols = [constants.COL_EMAIL, constants.COL_DISCIPLINE]
+        if new_df.empty or not all(col in new_df.columns for col in merge_cols):
+            return new_df
+
+        if snapshot is not None:
+            existing_df = snapshot.peresdachi[merge_cols]
+        else:
+            emails = new_df[constants.COL_EMAIL].dropna().astype(str).unique().tolist()
+            disciplines = new_df[constants.COL_DISCIPLINE].dropna().astype(str).unique().tolist()
+            existing_df = load_existing_keys(emails, disciplines)
         if existing_df.empty:
             return new_df
-        
-        merge_cols = [constants.COL_EMAIL, constants.COL_DISCIPLINE]
-        if all(col in existing_df.columns for col in merge_cols) and all(col in new_df.columns for col in merge_cols):
-            # Нормализуем existing_df перед сравнением, чтобы совпадение работало
-            # корректно (разный регистр, пробелы и т.п. не должны мешать)
-            existing_normalized = existing_df[merge_cols].copy()
-            existing_normalized = clean_email_column(existing_normalized, constants.COL_EMAIL)
-            existing_normalized = clean_string_column(existing_normalized, constants.COL_DISCIPLINE)
-            existing_normalized = existing_normalized.drop_duplicates(subset=merge_cols)
-            merged = new_df.merge(existing_normalized, on=merge_cols, how='left', indicator=True)
-            return merged[merged['_merge'] == 'left_only'].drop('_merge', axis=1)
-        return new_df
+
+        # Email уже нормализован в БД (email_key); пробелы в дисциплине не должны мешать
+        # совпадению ни на стороне БД, ни на стороне загрузки
+        existing_normalized = clean_string_column(existing_df[merge_cols].copy(), constants.COL_DISCIPLINE)
+        new_keys = clean_string_column(new_df[merge_cols].astype(str), constants.COL_DISCIPLINE)
+        is_existing = pd.MultiIndex.from_frame(new_keys).isin(
+            pd.MultiIndex.from_frame(existing_normalized.astype(str))
+        )
+        return new_df[~is_existing].reset_index(drop=True)
     except Exception as e:
         raise ValueError(f"Ошибка при определении новых записей: {str(e)}")
 
-def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFrame) -> Tuple[pd.DataFrame, List[str]]:
-    """Обработка пересдач внешней оценки"""
+def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFrame,
+                                snapshot: ReferenceSnapshot = None) -> Tuple[pd.DataFrame, List[str]]:
+    """Обработка пересдач внешней оценки. snapshot — справочные таблицы запуска (по умолчанию новый снимок)"""
     logs = []
+    if snapshot is None:
+        snapshot = ReferenceSnapshot()
     
     # Шаг 1: Очистка данных
     grades_df = grades_df.astype(str)
@@ -175,64 +676,15 @@ def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFra
     if constants.COL_EMAIL not in grades_df.columns:
         raise ValueError(f"Колонка '{constants.COL_EMAIL}' не найдена в файле оценок")
     
+    # email очищается до melt: строк в три раза меньше
+    grades_df = clean_email_column(grades_df, constants.COL_EMAIL)
+    # Справочные таблицы нужны на разных шагах, но не зависят друг от друга;
+    # для небольшой загрузки из них читаются только строки ее email
+    snapshot.scope(grades_df[constants.COL_EMAIL].unique()).preload()
     melted_df = pd.melt(grades_df, id_vars=id_cols, value_vars=value_columns, var_name=constants.COL_DISCIPLINE, value_name=constants.COL_GRADE)
     
     # Шаг 4: Присоединение данных студентов
-    melted_df = clean_email_column(melted_df, constants.COL_EMAIL)
-    
-    registration_df = load_registration_data_from_supabase()
-    
-    students_cols = [constants.COL_FIO, constants.COL_EMAIL, constants.COL_CAMPUS_OLD, constants.COL_FACULTY, constants.COL_PROGRAM, constants.COL_GROUP, constants.COL_COURSE]
-    avail_stu_cols = [col for col in students_cols if col in students_df.columns]
-    students_subset = clean_email_column(students_df[avail_stu_cols].copy(), constants.COL_EMAIL)
-    if constants.COL_CAMPUS_OLD in students_subset.columns:
-        students_subset = students_subset.rename(columns={constants.COL_CAMPUS_OLD: constants.COL_CAMPUS})
-    students_subset = students_subset.drop_duplicates(subset=[constants.COL_EMAIL])
-        
-    if not registration_df.empty:
-        reg_cols = [
-            constants.COL_FIO, constants.COL_EMAIL, constants.COL_CAMPUS_OLD, constants.COL_CAMPUS, 
-            constants.COL_FACULTY, constants.COL_PROGRAM, constants.COL_GROUP, constants.COL_COURSE, 
-            constants.COL_CANCEL, constants.COL_ID_DISCIPLINE, constants.COL_DISCIPLINE, constants.COL_PERIOD
-        ]
-        avail_reg_cols = [col for col in reg_cols if col in registration_df.columns]
-        reg_subset = clean_email_column(registration_df[avail_reg_cols].copy(), constants.COL_EMAIL)
-        if constants.COL_CAMPUS_OLD in reg_subset.columns and constants.COL_CAMPUS not in reg_subset.columns:
-            reg_subset = reg_subset.rename(columns={constants.COL_CAMPUS_OLD: constants.COL_CAMPUS})
-        merge_keys = [constants.COL_EMAIL]
-        if constants.COL_DISCIPLINE in reg_subset.columns:
-            merge_keys.append(constants.COL_DISCIPLINE)
-            
-        reg_subset = reg_subset.drop_duplicates(subset=merge_keys)
-        
-        result_df = melted_df.merge(reg_subset, on=merge_keys, how='left')
-
-        result_df = result_df.merge(students_subset, on=constants.COL_EMAIL, how='left', suffixes=('', '_stu'))
-        
-        for col in [constants.COL_FIO, constants.COL_CAMPUS, constants.COL_FACULTY, constants.COL_PROGRAM, constants.COL_GROUP, constants.COL_COURSE]:
-            stu_col = col + '_stu'
-            if col in result_df.columns and stu_col in result_df.columns:
-                result_df[col] = result_df[col].fillna(result_df[stu_col])
-            elif stu_col in result_df.columns:
-                result_df[col] = result_df[stu_col]
-                
-        stu_cols_to_drop = [c for c in result_df.columns if c.endswith('_stu')]
-        result_df = result_df.drop(columns=stu_cols_to_drop)
-    else:
-        result_df = melted_df.merge(students_subset, on=constants.COL_EMAIL, how='left')
-    
-    if constants.COL_CANCEL not in result_df.columns:
-        result_df[constants.COL_CANCEL] = ''
-    
-    if constants.COL_ID_DISCIPLINE not in result_df.columns:
-        result_df[constants.COL_ID_DISCIPLINE] = ''
-    else:
-        result_df[constants.COL_ID_DISCIPLINE] = result_df[constants.COL_ID_DISCIPLINE].fillna('')
-
-    if constants.COL_PERIOD not in result_df.columns:
-        result_df[constants.COL_PERIOD] = ''
-    else:
-        result_df[constants.COL_PERIOD] = result_df[constants.COL_PERIOD].fillna('')
+    result_df = enrich_assessment_rows(melted_df, students_df, snapshot)
     
     # Шаг 6: Переименование и структура
     output_columns = [
@@ -249,21 +701,10 @@ def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFra
     # Шаг 7: Проверка student_io
     logs.append(f"Проверка существующих оценок в {constants.DB_TABLE_STUDENT_IO}...")
     try:
-        student_io_df = load_student_io_from_supabase()
+        student_io_df = snapshot.student_io
         if not student_io_df.empty:
-            result_df = clean_email_column(result_df, constants.COL_EMAIL)
-            result_df = clean_string_column(result_df, constants.COL_DISCIPLINE)
-            
-            merged_with_io = result_df.merge(
-                student_io_df[[constants.COL_EMAIL, constants.COL_DISCIPLINE, constants.COL_GRADE]], 
-                on=[constants.COL_EMAIL, constants.COL_DISCIPLINE], 
-                how='left', suffixes=('_from_file', '_from_io')
-            )
-            merged_with_io[constants.COL_GRADE] = merged_with_io[constants.COL_GRADE + '_from_io'].where(
-                pd.notna(merged_with_io[constants.COL_GRADE + '_from_io']), merged_with_io[constants.COL_GRADE + '_from_file']
-            )
-            result_df = merged_with_io.drop(columns=[constants.COL_GRADE + '_from_file', constants.COL_GRADE + '_from_io'])
-            result_df = filter_valid_grades(result_df, constants.COL_GRADE)
+            # email и дисциплина уже очищены до enrich_assessment_rows
+            result_df = apply_reference_grades(result_df, snapshot.grade_lookup(constants.DB_TABLE_STUDENT_IO))
             logs.append(f"Проверка завершена. Найдено {len(student_io_df)} записей в {constants.DB_TABLE_STUDENT_IO}.")
         else:
             logs.append(f"Таблица {constants.DB_TABLE_STUDENT_IO} пуста, используются оценки из файла.")
@@ -273,21 +714,9 @@ def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFra
     # Шаг 8: Проверка peresdachi
     logs.append(f"Проверка существующих оценок в {constants.DB_TABLE_PERESDACHI}...")
     try:
-        existing_peresdachi_df = load_existing_peresdachi()
+        existing_peresdachi_df = snapshot.peresdachi
         if not existing_peresdachi_df.empty:
-            existing_peresdachi_df = clean_email_column(existing_peresdachi_df, constants.COL_EMAIL)
-            existing_peresdachi_df = clean_string_column(existing_peresdachi_df, constants.COL_DISCIPLINE)
-            
-            merged_with_peresdachi = result_df.merge(
-                existing_peresdachi_df[[constants.COL_EMAIL, constants.COL_DISCIPLINE, constants.COL_GRADE]], 
-                on=[constants.COL_EMAIL, constants.COL_DISCIPLINE], 
-                how='left', suffixes=('_current', '_peresdachi')
-            )
-            merged_with_peresdachi[constants.COL_GRADE] = merged_with_peresdachi[constants.COL_GRADE + '_peresdachi'].where(
-                pd.notna(merged_with_peresdachi[constants.COL_GRADE + '_peresdachi']), merged_with_peresdachi[constants.COL_GRADE + '_current']
-            )
-            result_df = merged_with_peresdachi.drop(columns=[constants.COL_GRADE + '_current', constants.COL_GRADE + '_peresdachi'])
-            result_df = filter_valid_grades(result_df, constants.COL_GRADE)
+            result_df = apply_reference_grades(result_df, snapshot.grade_lookup(constants.DB_TABLE_PERESDACHI))
             logs.append(f"Проверка {constants.DB_TABLE_PERESDACHI} завершена. Найдено {len(existing_peresdachi_df)} записей.")
         else:
             logs.append(f"Таблица {constants.DB_TABLE_PERESDACHI} пуста, используются текущие оценки.")
@@ -296,79 +725,34 @@ def process_external_assessment(grades_df: pd.DataFrame, students_df: pd.DataFra
 
     return result_df, logs
 
-def process_project_assessment(grades_df: pd.DataFrame, students_df: pd.DataFrame) -> Tuple[pd.DataFrame, List[str]]:
-    """Обработка внешнего измерения (Проекты)"""
+def process_project_assessment(grades_df: pd.DataFrame, students_df: pd.DataFrame,
+                               snapshot: ReferenceSnapshot = None) -> Tuple[pd.DataFrame, List[str]]:
+    """Обработка внешнего измерения (Проекты). snapshot — справочные таблицы запуска (по умолчанию новый снимок)"""
     logs = []
+    if snapshot is None:
+        snapshot = ReferenceSnapshot()
     
     existing_project_columns = [col for col in constants.PROJECT_COLUMNS if col in grades_df.columns]
     if not existing_project_columns:
         raise ValueError("Не найдены колонки с оценками за проект (Задание:...).")
 
     def clean_numeric(series):
-        return pd.to_numeric(series.astype(str).replace('-', float('nan')), errors='coerce')
+        return to_small_numeric(series.astype(str).replace('-', float('nan')))
 
     project_data = grades_df[existing_project_columns].apply(clean_numeric)
-    grades_df[constants.COL_GRADE] = project_data.max(axis=1)
+    # float32 сохраняет прежнее текстовое представление оценки ('8.0') в результате
+    grades_df[constants.COL_GRADE] = project_data.max(axis=1).astype(np.float32)
     grades_df[constants.COL_DISCIPLINE] = constants.DISCIPLINE_FINAL
     
     if constants.COL_EMAIL not in grades_df.columns:
         raise ValueError(f"Колонка '{constants.COL_EMAIL}' не найдена в файле.")
     
     grades_df = clean_email_column(grades_df, constants.COL_EMAIL)
+    # Справочные таблицы нужны на разных шагах, но не зависят друг от друга;
+    # для небольшой загрузки из них читаются только строки ее email
+    snapshot.scope(grades_df[constants.COL_EMAIL].unique()).preload()
     
-    registration_df = load_registration_data_from_supabase()
-    
-    students_cols = [constants.COL_FIO, constants.COL_EMAIL, constants.COL_CAMPUS_OLD, constants.COL_FACULTY, constants.COL_PROGRAM, constants.COL_GROUP, constants.COL_COURSE]
-    available_cols = [col for col in students_cols if col in students_df.columns]
-    students_subset = clean_email_column(students_df[available_cols].copy(), constants.COL_EMAIL)
-    if constants.COL_CAMPUS_OLD in students_subset.columns:
-        students_subset = students_subset.rename(columns={constants.COL_CAMPUS_OLD: constants.COL_CAMPUS})
-    students_subset = students_subset.drop_duplicates(subset=[constants.COL_EMAIL])
-    
-    if not registration_df.empty:
-        reg_cols = [
-            constants.COL_FIO, constants.COL_EMAIL, constants.COL_CAMPUS_OLD, constants.COL_CAMPUS, 
-            constants.COL_FACULTY, constants.COL_PROGRAM, constants.COL_GROUP, constants.COL_COURSE, 
-            constants.COL_CANCEL, constants.COL_ID_DISCIPLINE, constants.COL_DISCIPLINE, constants.COL_PERIOD
-        ]
-        avail_reg_cols = [col for col in reg_cols if col in registration_df.columns]
-        reg_subset = clean_email_column(registration_df[avail_reg_cols].copy(), constants.COL_EMAIL)
-        if constants.COL_CAMPUS_OLD in reg_subset.columns and constants.COL_CAMPUS not in reg_subset.columns:
-            reg_subset = reg_subset.rename(columns={constants.COL_CAMPUS_OLD: constants.COL_CAMPUS})
-        merge_keys = [constants.COL_EMAIL]
-        if constants.COL_DISCIPLINE in reg_subset.columns:
-            merge_keys.append(constants.COL_DISCIPLINE)
-            
-        reg_subset = reg_subset.drop_duplicates(subset=merge_keys)
-        
-        result_df = grades_df.merge(reg_subset, on=merge_keys, how='left')
-
-        result_df = result_df.merge(students_subset, on=constants.COL_EMAIL, how='left', suffixes=('', '_stu'))
-        
-        for col in [constants.COL_FIO, constants.COL_CAMPUS, constants.COL_FACULTY, constants.COL_PROGRAM, constants.COL_GROUP, constants.COL_COURSE]:
-            stu_col = col + '_stu'
-            if col in result_df.columns and stu_col in result_df.columns:
-                result_df[col] = result_df[col].fillna(result_df[stu_col])
-            elif stu_col in result_df.columns:
-                result_df[col] = result_df[stu_col]
-                
-        stu_cols_to_drop = [c for c in result_df.columns if c.endswith('_stu')]
-        result_df = result_df.drop(columns=stu_cols_to_drop)
-    else:
-        result_df = grades_df.merge(students_subset, on=constants.COL_EMAIL, how='left')
-        
-    if constants.COL_CANCEL not in result_df.columns:
-        result_df[constants.COL_CANCEL] = ''
-        
-    if constants.COL_ID_DISCIPLINE not in result_df.columns:
-        result_df[constants.COL_ID_DISCIPLINE] = ''
-    else:
-        result_df[constants.COL_ID_DISCIPLINE] = result_df[constants.COL_ID_DISCIPLINE].fillna('')
-
-    if constants.COL_PERIOD not in result_df.columns:
-        result_df[constants.COL_PERIOD] = ''
-    else:
-        result_df[constants.COL_PERIOD] = result_df[constants.COL_PERIOD].fillna('')
+    result_df = enrich_assessment_rows(grades_df, students_df, snapshot)
     
     output_columns = [
         constants.COL_FIO, constants.COL_EMAIL, constants.COL_CAMPUS, constants.COL_FACULTY,
@@ -386,18 +770,9 @@ def process_project_assessment(grades_df: pd.DataFrame, students_df: pd.DataFram
     # Шаг 1: student_io
     logs.append(f"Проверка {constants.DB_TABLE_STUDENT_IO}...")
     try:
-        student_io_df = load_student_io_from_supabase()
+        student_io_df = snapshot.student_io
         if not student_io_df.empty:
-            result_df = clean_email_column(result_df, constants.COL_EMAIL)
-            merged_with_io = result_df.merge(
-                student_io_df[[constants.COL_EMAIL, constants.COL_DISCIPLINE, constants.COL_GRADE]],
-                on=[constants.COL_EMAIL, constants.COL_DISCIPLINE], how='left', suffixes=('_from_file', '_from_io')
-            )
-            merged_with_io[constants.COL_GRADE] = merged_with_io[constants.COL_GRADE + '_from_io'].where(
-                pd.notna(merged_with_io[constants.COL_GRADE + '_from_io']), merged_with_io[constants.COL_GRADE + '_from_file']
-            )
-            result_df = merged_with_io.drop(columns=[constants.COL_GRADE + '_from_file', constants.COL_GRADE + '_from_io'])
-            result_df = filter_valid_grades(result_df, constants.COL_GRADE)
+            result_df = apply_reference_grades(result_df, snapshot.grade_lookup(constants.DB_TABLE_STUDENT_IO))
             logs.append(f"Проверка {constants.DB_TABLE_STUDENT_IO} завершена.")
     except Exception as e:
         logs.append(f"Ошибка проверки {constants.DB_TABLE_STUDENT_IO}: {e}")
@@ -405,27 +780,20 @@ def process_project_assessment(grades_df: pd.DataFrame, students_df: pd.DataFram
     # Шаг 2: peresdachi
     logs.append(f"Проверка {constants.DB_TABLE_PERESDACHI}...")
     try:
-        existing_peresdachi_df = load_existing_peresdachi()
+        existing_peresdachi_df = snapshot.peresdachi
         if not existing_peresdachi_df.empty:
-            existing_peresdachi_df = clean_email_column(existing_peresdachi_df, constants.COL_EMAIL)
-            merged_with_peresdachi = result_df.merge(
-                existing_peresdachi_df[[constants.COL_EMAIL, constants.COL_DISCIPLINE, constants.COL_GRADE]],
-                on=[constants.COL_EMAIL, constants.COL_DISCIPLINE], how='left', suffixes=('_current', '_peresdachi')
-            )
-            merged_with_peresdachi[constants.COL_GRADE] = merged_with_peresdachi[constants.COL_GRADE + '_peresdachi'].where(
-                pd.notna(merged_with_peresdachi[constants.COL_GRADE + '_peresdachi']), merged_with_peresdachi[constants.COL_GRADE + '_current']
-            )
-            result_df = merged_with_peresdachi.drop(columns=[constants.COL_GRADE + '_current', constants.COL_GRADE + '_peresdachi'])
-            result_df = filter_valid_grades(result_df, constants.COL_GRADE)
+            result_df = apply_reference_grades(result_df, snapshot.grade_lookup(constants.DB_TABLE_PERESDACHI))
             logs.append(f"Проверка {constants.DB_TABLE_PERESDACHI} завершена.")
     except Exception as e:
         logs.append(f"Ошибка проверки {constants.DB_TABLE_PERESDACHI}: {e}")
 
     return result_df, logs
 
-def deduplicate_and_split(result_df: pd.DataFrame, conflict_cols: List[str] = None):
+def deduplicate_and_split(result_df: pd.DataFrame, conflict_cols: List[str] = None,
+                          snapshot: ReferenceSnapshot = None):
     """
     Дедупликация результата и разделение на полный набор и только новые записи.
+    snapshot — справочные таблицы запуска: уже загруженные записи peresdachi не запрашиваются повторно.
 
     Returns:
         dict с ключами: result_df, display_new_records, total_count, new_count, duplicates_removed
@@ -441,7 +809,7 @@ def deduplicate_and_split(result_df: pd.DataFrame, conflict_cols: List[str] = No
     if duplicates_removed > 0:
         result_df = result_df_cleaned
 
-    display_new_records = get_new_records_from_dataframe(result_df)
+    display_new_records = get_new_records_from_dataframe(result_df, snapshot=snapshot)
     display_new_records = display_new_records.drop_duplicates(subset=conflict_cols, keep='first')
 
     return {
@@ -453,10 +821,222 @@ def deduplicate_and_split(result_df: pd.DataFrame, conflict_cols: List[str] = No
     }
 
 
+def deduplicate_and_save(result_df: pd.DataFrame, conflict_cols: List[str] = None,
+                         snapshot: ReferenceSnapshot = None) -> dict:
+    """
+    Дедупликация результата и сохранение новых записей в peresdachi.
+
+    Повторы внутри загрузки удаляются здесь, а уже сохраненные записи отсекает
+    уникальный индекс (email_key, дисциплина) через ON CONFLICT DO NOTHING: на запись
+    уходит весь результат, и новыми считаются строки, которые вернула вставка, без
+    сравнения с таблицей на стороне приложения. Если индекса еще нет, новые записи
+    определяет deduplicate_and_split, а сохраняет save_to_supabase.
+
+    Returns:
+        dict с ключами deduplicate_and_split и save_success, save_msg, save_stats
+    """
+    if conflict_cols is None:
+        conflict_cols = [constants.COL_EMAIL, constants.COL_DISCIPLINE]
+
+    deduplicated = result_df.drop_duplicates(subset=conflict_cols, keep='first')
+    stats = {'inserted': 0, 'skipped': 0, 'failed': 0}
+    split = {
+        'result_df': deduplicated,
+        'display_new_records': deduplicated.iloc[:0],
+        'total_count': len(deduplicated),
+        'new_count': 0,
+        'duplicates_removed': len(result_df) - len(deduplicated),
+    }
+    if deduplicated.empty:
+        return {**split, 'save_success': False, 'save_msg': "Нет данных для сохранения.", 'save_stats': stats}
+
+    try:
+        stats, inserted_rows, errors = _write_peresdachi(deduplicated, snapshot, insert_fallback=False)
+    except Exception as e:
+        if not _is_missing_conflict_target(e):
+            return {**split, 'save_success': False, 'save_msg': f"Ошибка при сохранении в Supabase: {str(e)}",
+                    'save_stats': stats}
+        split = deduplicate_and_split(result_df, conflict_cols, snapshot=snapshot)
+        save_success, save_msg, save_stats = save_to_supabase(split['display_new_records'], snapshot=snapshot)
+        return {**split, 'save_success': save_success, 'save_msg': save_msg, 'save_stats': save_stats}
+
+    if inserted_rows:
+        inserted_keys = pd.MultiIndex.from_frame(
+            pd.DataFrame(inserted_rows).reindex(columns=conflict_cols).astype(str)
+        )
+        is_new = pd.MultiIndex.from_frame(deduplicated[conflict_cols].astype(str)).isin(inserted_keys)
+        split['display_new_records'] = deduplicated[is_new]
+        split['new_count'] = int(is_new.sum())
+    save_success, save_msg = _save_result(stats, errors)
+    return {**split, 'save_success': save_success, 'save_msg': save_msg, 'save_stats': stats}
+
+
+def _load_final_grades(emails: List[str]) -> pd.DataFrame:
+    """
+    Существующие записи final_grades для указанных email.
+
+    Порции email запрашиваются параллельно; ошибка порции после повторов
+    прерывает загрузку, чтобы не перезаписать итоговые оценки без учета старых.
+    """
+    def fetch_chunk(client, chunk_emails):
+        return fetch_all_from_supabase(
+            constants.DB_TABLE_FINAL_GRADES, filters={constants.COL_EMAIL: chunk_emails},
+            columns=constants.FINAL_GRADES_LOOKUP_COLUMNS, email_key=constants.COL_EMAIL, client=client
+        )
+
+    chunk_size = constants.FINAL_GRADES_CHUNK_SIZE
+    chunks = [emails[i:i + chunk_size] for i in range(0, len(emails), chunk_size)]
+    rows = [row for chunk_rows in map_concurrently(fetch_chunk, chunks) for row in chunk_rows]
+    existing = pd.DataFrame(rows, columns=constants.FINAL_GRADES_LOOKUP_COLUMNS)
+    existing = existing[existing[constants.COL_EMAIL].notna() & (existing[constants.COL_EMAIL] != '')]
+    return existing.drop_duplicates(subset=[constants.COL_EMAIL], keep='last').set_index(constants.COL_EMAIL)
+
+def _grade_values(series: pd.Series) -> pd.Series:
+    """Оценки в float; пустые и нечисловые значения — NaN."""
+    return pd.to_numeric(series.astype(str).str.strip(), errors='coerce')
+
+def _best_project_grades(work_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Строки с числовой оценкой за проект и непустым email; повторы email
+    сводятся к строке с наибольшей оценкой (порядок строк сохраняется).
+    """
+    work_df = work_df.assign(**{constants.COL_FINAL_PROJECT_GRADE: _grade_values(work_df[constants.COL_GRADE])})
+    email = work_df[constants.COL_EMAIL]
+    work_df = work_df[email.notna() & (email.astype(str) != '') & work_df[constants.COL_FINAL_PROJECT_GRADE].notna()]
+    return (
+        work_df.sort_values(constants.COL_FINAL_PROJECT_GRADE, kind='stable')
+        .drop_duplicates(subset=[constants.COL_EMAIL], keep='last')
+        .sort_index()
+    )
+
+def build_final_grade_payloads(work_df: pd.DataFrame, existing: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Векторный расчет записей final_grades.
+
+    Итоговая оценка — максимум из оценки за тест, новой оценки за проект и прежней
+    итоговой (пропуски считаются нулем). Для новых студентов добавляются ФИО,
+    фамилия и имя. Повторы email сводятся к одной записи с наибольшей оценкой за проект.
+
+    Returns:
+        (обновления существующих записей, новые записи)
+    """
+    work_df = _best_project_grades(work_df)
+
+    old = existing.reindex(work_df[constants.COL_EMAIL].astype(object))
+    old_test = _grade_values(old[constants.COL_FINAL_TEST_GRADE]).fillna(0.0).to_numpy()
+    old_final = _grade_values(old[constants.COL_FINAL_GRADE]).fillna(0.0).to_numpy()
+    project = work_df[constants.COL_FINAL_PROJECT_GRADE].to_numpy(dtype=float)
+
+    payload = pd.DataFrame({
+        constants.COL_EMAIL: work_df[constants.COL_EMAIL].astype(object).to_numpy(),
+        constants.COL_FINAL_PROJECT_GRADE: project,
+        constants.COL_FINAL_GRADE: np.maximum.reduce([old_test, project, old_final]),
+    })
+    is_new = ~work_df[constants.COL_EMAIL].astype(object).isin(existing.index).to_numpy()
+
+    new_records = payload[is_new].copy()
+    if constants.COL_FIO in work_df.columns:
+        fio = work_df.loc[is_new, constants.COL_FIO].astype(object)
+        parts = fio.where(fio.map(lambda v: isinstance(v, str)), '').str.split()
+        new_records[constants.COL_FIO] = fio.where(fio.notna(), None).to_numpy()
+        new_records['Фамилия'] = parts.str[0].to_numpy()
+        new_records['Имя'] = parts.str[1].to_numpy()
+    return payload[~is_new], new_records
+
+def build_final_grade_merge_payload(work_df: pd.DataFrame) -> List[dict]:
+    """
+    Записи для функции БД merge_final_grades: email, ФИО и оценка за проект.
+    Повторы email сводятся к наибольшей оценке за проект.
+    """
+    work_df = _best_project_grades(work_df)
+    fio = work_df[constants.COL_FIO].astype(object) if constants.COL_FIO in work_df.columns else None
+    payload = pd.DataFrame({
+        'email': work_df[constants.COL_EMAIL].astype(object).to_numpy(),
+        'fio': fio.where(fio.map(lambda v: isinstance(v, str)), None).to_numpy() if fio is not None else None,
+        'project_grade': work_df[constants.COL_FINAL_PROJECT_GRADE].to_numpy(dtype=float),
+    })
+    return payload.astype(object).where(payload.notna(), None).to_dict('records')
+
+def _is_missing_function(error: Exception) -> bool:
+    """Функция БД не найдена: PostgREST PGRST202 или Postgres 42883 (миграция не применена)."""
+    message = str(error)
+    return 'PGRST202' in message or '42883' in message or 'Could not find the function' in message
+
+def _write_batches_concurrently(func, batches: List[list]) -> Tuple[int, List[Exception]]:
+    """Параллельная запись пакетов (не более WRITE_MAX_WORKERS) с повтором упавших."""
+    results = map_concurrently(func, batches, max_workers=constants.WRITE_MAX_WORKERS,
+                               retries=constants.WRITE_BATCH_RETRIES, retry_delay=constants.WRITE_RETRY_DELAY,
+                               return_exceptions=True)
+    processed_count = sum(result for result in results if not isinstance(result, Exception))
+    return processed_count, [result for result in results if isinstance(result, Exception)]
+
+def _merge_final_grades_on_server(work_df: pd.DataFrame) -> Tuple[bool, int, str]:
+    """
+    Слияние оценок за проект функцией БД merge_final_grades: максимум считает
+    Postgres (GREATEST) в одном INSERT ... ON CONFLICT на пакет, без чтения final_grades.
+
+    Первый пакет отправляется отдельно и без повторов: если функция не развернута,
+    выбрасывается исключение, и вызывающий код переходит к расчету на клиенте.
+    """
+    records = build_final_grade_merge_payload(work_df)
+    if not records:
+        return True, 0, "Нет полезной нагрузки"
+    chunk_size = constants.FINAL_GRADES_CHUNK_SIZE
+    batches = [records[i:i + chunk_size] for i in range(0, len(records), chunk_size)]
+
+    def merge_batch(client, batch):
+        client.rpc(constants.FINAL_GRADES_MERGE_FUNCTION, {'payload': batch}).execute()
+        return len(batch)
+
+    probe = map_concurrently(merge_batch, batches[:1], retries=1, return_exceptions=True)[0]
+    if isinstance(probe, Exception):
+        if _is_missing_function(probe):
+            raise probe
+        processed_count, errors = _write_batches_concurrently(merge_batch, batches)
+    else:
+        processed_count, errors = _write_batches_concurrently(merge_batch, batches[1:])
+        processed_count += probe
+
+    if errors:
+        return False, processed_count, f"Не удалось обновить {len(records) - processed_count} записей: {errors[-1]}"
+    return True, processed_count, "Успешно обновлено"
+
+def _merge_final_grades_on_client(work_df: pd.DataFrame, emails: List[str]) -> Tuple[bool, int, str]:
+    """
+    Расчет итоговых оценок на клиенте: существующие записи загружаются параллельными
+    порциями, записи рассчитываются векторно, пакеты upsert отправляются параллельно.
+    Обновления и новые записи идут разными пакетами: у обновлений нет колонок ФИО,
+    и они не затираются.
+    """
+    existing = _load_final_grades(emails)
+    updates, new_records = build_final_grade_payloads(work_df, existing)
+
+    chunk_size = constants.FINAL_GRADES_CHUNK_SIZE
+    batches = []
+    for records_df in (updates, new_records):
+        records = records_df.astype(object).where(records_df.notna(), None).to_dict('records')
+        batches.extend(records[i:i + chunk_size] for i in range(0, len(records), chunk_size))
+    if not batches:
+        return True, 0, "Нет полезной нагрузки"
+
+    def upsert_batch(client, batch):
+        client.table(constants.DB_TABLE_FINAL_GRADES).upsert(batch, on_conflict=constants.COL_EMAIL).execute()
+        return len(batch)
+
+    processed_count, errors = _write_batches_concurrently(upsert_batch, batches)
+    if errors:
+        failed = len(updates) + len(new_records) - processed_count
+        return False, processed_count, f"Не удалось обновить {failed} записей: {errors[-1]}"
+    return True, processed_count, "Успешно обновлено"
+
 def update_final_grades(df: pd.DataFrame) -> Tuple[bool, int, str]:
-    """Обновление таблицы final_grades в Supabase на основе новых оценок за проекты."""
+    """
+    Обновление таблицы final_grades в Supabase на основе новых оценок за проекты.
+
+    Основной путь — функция БД merge_final_grades (sql/function_merge_final_grades.sql).
+    Если миграция не применена, итоговые оценки рассчитываются на клиенте.
+    """
     try:
-        supabase = get_supabase_client()
         if df.empty:
             return True, 0, "Данные отсутствуют"
             
@@ -464,73 +1044,17 @@ def update_final_grades(df: pd.DataFrame) -> Tuple[bool, int, str]:
             return False, 0, f"Нет необходимых колонок '{constants.COL_EMAIL}' или '{constants.COL_GRADE}'"
             
         work_df = clean_email_column(df.copy(), constants.COL_EMAIL)
-        unique_emails = work_df[constants.COL_EMAIL].unique().tolist()
+        unique_emails = [email for email in work_df[constants.COL_EMAIL].dropna().unique().tolist() if email]
         
         if not unique_emails:
             return True, 0, "Нет уникальных email"
 
-        existing_records_map = {}
-        chunk_size = 200
-        for i in range(0, len(unique_emails), chunk_size):
-            chunk_emails = unique_emails[i:i + chunk_size]
-            try:
-                response = supabase.table(constants.DB_TABLE_FINAL_GRADES).select('*').in_(constants.COL_EMAIL, chunk_emails).execute()
-                for rec in response.data:
-                    email = rec.get(constants.COL_EMAIL, '').lower().strip()
-                    if email:
-                        existing_records_map[email] = rec
-            except Exception:
-                pass
-
-        payloads = []
-        processed_count = 0
-        
-        for _, row in work_df.iterrows():
-            email = row.get(constants.COL_EMAIL)
-            new_project_grade = row.get(constants.COL_GRADE)
-            fio = row.get(constants.COL_FIO, '')
-            
-            if not email or pd.isna(new_project_grade):
-                continue
-            try:
-                new_project_grade = float(new_project_grade)
-            except:
-                continue
-                
-            record = existing_records_map.get(email, {})
-            old_test_grade = record.get('Оценка за тест')
-            old_final_grade = record.get('Итоговая оценка')
-            
-            def to_float(val):
-                return float(val) if val is not None and str(val).strip() else 0.0
-            
-            val_test, val_old_final = to_float(old_test_grade), to_float(old_final_grade)
-            
-            current_project = new_project_grade 
-            new_final = max(val_test, current_project, val_old_final)
-            
-            payload = {constants.COL_EMAIL: email}
-            if not record:
-                payload[constants.COL_FIO] = fio
-                if isinstance(fio, str):
-                    parts = fio.split()
-                    if len(parts) >= 1: payload['Фамилия'] = parts[0]
-                    if len(parts) >= 2: payload['Имя'] = parts[1]
-            
-            payload['Оценка за проект'] = current_project
-            payload['Итоговая оценка'] = new_final
-            
-            payloads.append(payload)
-            processed_count += 1
-
-        if not payloads:
-            return True, 0, "Нет полезной нагрузки"
-            
-        for i in range(0, len(payloads), chunk_size):
-            batch = payloads[i:i + chunk_size]
-            supabase.table(constants.DB_TABLE_FINAL_GRADES).upsert(batch, on_conflict=constants.COL_EMAIL).execute()
-            
-        return True, processed_count, "Успешно обновлено"
+        try:
+            return _merge_final_grades_on_server(work_df)
+        except Exception as e:
+            if not _is_missing_function(e):
+                raise
+        return _merge_final_grades_on_client(work_df, unique_emails)
             
     except Exception as e:
         return False, 0, f"Критическая ошибка при обновлении final_grades: {str(e)}"
@@ -1,110 +1,452 @@
 """
 Logic for Grade Recalculation Module
 """
+import io
+import os
+import operator
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import pandas as pd
 import numpy as np
-from constants import STAGE_KEYWORD_ANALYSIS, STAGE_KEYWORD_PROGRAMMING
+from typing import Callable, Dict, Iterator, List, Tuple
+from constants import (
+    STAGE_KEYWORD_ANALYSIS, STAGE_KEYWORD_PROGRAMMING,
+    DISCIPLINE_INPUT as COL_INPUT, DISCIPLINE_MID as COL_MID, DISCIPLINE_FINAL as COL_FINAL,
+    GRADE_RECALC_PARAMS, GRADE_RULES_DPR_CAP, GRADE_RULE_TABLES
+)
+from logic.export import write_chunks, dataframe_to_bytes
 
-def process_grade_recalculation(df: pd.DataFrame, use_dynamics: bool) -> pd.DataFrame:
+COL_NE_NAME = 'Наименование НЭ'
+COL_NE_GRADE = 'Оценка НЭ'
+COL_DPR_GRADE = 'Оценка дисциплины-пререквизита'
+
+REQUIRED_COLUMNS = [COL_NE_NAME, COL_NE_GRADE, COL_DPR_GRADE, COL_INPUT, COL_MID, COL_FINAL]
+
+# Потоковая обработка: размер чанка CSV
+STREAM_CHUNK_SIZE = 50_000
+
+# Расчетные колонки, доступные в условиях таблиц правил (см. constants.py)
+RULE_COLUMNS = {
+    'dpr_raw', 'ne', 'dpr', 'innopolis', 'max_grade', 'vhod', 'prom', 'itog',
+    'drop_input_mid', 'drop_input_final', 'drop_mid_final',
+}
+
+_RULE_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+
+# =============================================================================
+# КОМПИЛЯЦИЯ ТАБЛИЦ ПРАВИЛ
+# =============================================================================
+
+def _compile_operand(operand, known_names: set) -> Callable[[dict], object]:
+    """Операнд правила → функция, возвращающая значение из контекста расчета."""
+    if operand is None:
+        return lambda context: np.nan
+    if isinstance(operand, str):
+        if operand not in known_names:
+            raise ValueError(f"Неизвестный операнд в таблице правил: '{operand}'")
+        return lambda context: context[operand]
+    if isinstance(operand, (bool, int, float)):
+        return lambda context: operand
+    raise ValueError(f"Недопустимый операнд в таблице правил: {operand!r}")
+
+
+def compile_rule_table(table: dict, param_names=None) -> Callable[[dict], np.ndarray]:
+    """
+    Компиляция таблицы правил в векторную функцию.
+
+    Условия каждого правила один раз разбираются в функции над контекстом
+    (словарь колонок-массивов и скалярных параметров). Полученная функция строит
+    булевы маски по всему DataFrame и выбирает результат через np.select:
+    приоритет у правила, стоящего в таблице раньше.
+
+    Args:
+        table: {'rules': [{'name', 'when', 'then'}, ...], 'default': операнд}
+        param_names: Допустимые имена параметров (по умолчанию ключи GRADE_RECALC_PARAMS)
+
+    Returns:
+        Функция context -> np.ndarray значений для каждой строки
+    """
+    known_names = RULE_COLUMNS | set(param_names if param_names is not None else GRADE_RECALC_PARAMS)
+
+    compiled_rules = []
+    for rule in table['rules']:
+        conditions = []
+        for left, op, right in rule['when']:
+            if op not in _RULE_OPERATORS:
+                raise ValueError(f"Неизвестный оператор '{op}' в правиле '{rule.get('name', '')}'")
+            conditions.append((
+                _compile_operand(left, known_names),
+                _RULE_OPERATORS[op],
+                _compile_operand(right, known_names),
+            ))
+        compiled_rules.append((conditions, _compile_operand(rule['then'], known_names)))
+    compiled_default = _compile_operand(table.get('default'), known_names)
+
+    def evaluate(context: dict) -> np.ndarray:
+        n_rows = context['n_rows']
+        masks, outcomes = [], []
+        for conditions, outcome in compiled_rules:
+            mask = np.ones(n_rows, dtype=bool)
+            for left, compare, right in conditions:
+                mask &= compare(left(context), right(context))
+            masks.append(mask)
+            outcomes.append(np.broadcast_to(np.asarray(outcome(context), dtype=float), n_rows))
+        default = np.broadcast_to(np.asarray(compiled_default(context), dtype=float), n_rows)
+        return np.select(masks, outcomes, default=default)
+
+    return evaluate
+
+
+_DPR_CAP_RULES = compile_rule_table(GRADE_RULES_DPR_CAP)
+_OUTPUT_RULES: Dict[str, Callable[[dict], np.ndarray]] = {
+    output_col: compile_rule_table(table) for output_col, table in GRADE_RULE_TABLES.items()
+}
+
+
+# =============================================================================
+# РАСЧЕТ
+# =============================================================================
+
+@lru_cache(maxsize=4096)
+def classify_stage(name: str) -> int:
+    """
+    Этап внешнего измерения по наименованию НЭ: 1 — входной, 2 — промежуточный, 3 — итоговый.
+
+    Результат кэшируется на уровне процесса: различных наименований НЭ единицы,
+    поэтому повторные загрузки не классифицируют их заново.
+    """
+    lowered = name.casefold()
+    if STAGE_KEYWORD_PROGRAMMING.casefold() in lowered:
+        return 2
+    if STAGE_KEYWORD_ANALYSIS.casefold() in lowered:
+        return 3
+    return 1
+
+
+def detect_stage(names: pd.Series) -> pd.Series:
+    """
+    Этап для каждой строки.
+
+    Колонка факторизуется, каждое уникальное наименование классифицируется один раз,
+    после чего этап раздается строкам по коду категории. Пропуски и нестроковые
+    значения относятся к этапу 1.
+    """
+    codes, uniques = pd.factorize(names)
+    # Последний элемент соответствует коду -1 (пропуск)
+    stage_by_code = np.array(
+        [classify_stage(name) if isinstance(name, str) else 1 for name in uniques] + [1],
+        dtype=np.int64
+    )
+    return pd.Series(stage_by_code[codes], index=names.index)
+
+
+def build_rule_context(df: pd.DataFrame, stage: np.ndarray) -> dict:
+    """
+    Расчетные колонки, не зависящие от параметров правил.
+
+    Вычисляются один раз на DataFrame и переиспользуются всеми вариантами
+    параметров (см. sweep_grade_recalculation).
+    """
+    vhod = df[COL_INPUT].to_numpy(dtype=float)
+    prom = df[COL_MID].to_numpy(dtype=float)
+    itog = df[COL_FINAL].to_numpy(dtype=float)
+    innopolis = np.select([stage == 1, stage == 2], [vhod, prom], default=itog)
+
+    return {
+        'n_rows': len(df),
+        'vhod': vhod,
+        'prom': prom,
+        'itog': itog,
+        # Сравнения с NaN дают False, поэтому пропуски не блокируют перезачет
+        'drop_input_mid': vhod - prom,
+        'drop_input_final': vhod - itog,
+        'drop_mid_final': prom - itog,
+        'dpr_raw': df[COL_DPR_GRADE].to_numpy(dtype=float),
+        'innopolis': np.nan_to_num(innopolis, nan=0.0),
+        'ne': np.nan_to_num(df[COL_NE_GRADE].to_numpy(dtype=float), nan=0.0),
+    }
+
+
+def apply_rule_params(base_context: dict, params: dict) -> dict:
+    """Дополнение базового контекста параметрами и зависящими от них колонками."""
+    context = {**base_context, **params}
+    context['dpr_capped'] = _DPR_CAP_RULES(context)
+    context['dpr'] = np.nan_to_num(context['dpr_capped'], nan=0.0)
+    context['max_grade'] = np.maximum(np.maximum(context['ne'], context['dpr']), context['innopolis'])
+    return context
+
+
+def resolve_rule_params(use_dynamics: bool = None, params: dict = None) -> dict:
+    """Параметры правил по умолчанию с учетом переопределений."""
+    params = params or {}
+    unknown = set(params) - set(GRADE_RECALC_PARAMS)
+    if unknown:
+        raise ValueError(f"Неизвестные параметры правил: {', '.join(sorted(unknown))}")
+    resolved = {**GRADE_RECALC_PARAMS, **params}
+    if use_dynamics is not None:
+        resolved['use_dynamics'] = bool(use_dynamics)
+    return resolved
+
+
+def prepare_recalculation_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Копия входных данных с проверкой обязательных колонок и колонкой 'Этап'."""
+    processed_df = df.copy()
+
+    for col in REQUIRED_COLUMNS:
+        if col not in processed_df.columns:
+            raise KeyError(f"Отсутствует обязательный столбец: '{col}'")
+
+    processed_df['Этап'] = detect_stage(processed_df[COL_NE_NAME])
+    return processed_df
+
+
+def process_grade_recalculation(df: pd.DataFrame, use_dynamics: bool, params: dict = None) -> pd.DataFrame:
     """
     Обработка данных для перезачета оценок
-    
+
+    Правила расчета ДПР_итог и НЭ_итог заданы таблицами в constants.py
+    (GRADE_RULE_TABLES) и выполняются векторно над всем DataFrame.
+
     Args:
         df: DataFrame с данными студентов
         use_dynamics: Учитывать ли динамику оценок
-        
+        params: Переопределение параметров правил (ключи GRADE_RECALC_PARAMS)
+
     Returns:
         Обработанный DataFrame с колонками ДПР_итог и НЭ_итог
     """
-    processed_df = df.copy()
+    processed_df = prepare_recalculation_frame(df)
+    base_context = build_rule_context(processed_df, processed_df['Этап'].to_numpy())
+    context = apply_rule_params(base_context, resolve_rule_params(use_dynamics, params))
 
-    required_columns = [
-        'Наименование НЭ', 'Оценка НЭ', 'Оценка дисциплины-пререквизита',
-        'Внешнее измерение цифровых компетенций. Входной контроль',
-        'Внешнее измерение цифровых компетенций. Промежуточный контроль',
-        'Внешнее измерение цифровых компетенций. Итоговый контроль'
-    ]
-    
-    for col in required_columns:
-        if col not in processed_df.columns:
-            raise KeyError(f"Отсутствует обязательный столбец: '{col}'")
+    write_capped_dpr(processed_df, context['dpr_raw'], context['dpr_capped'])
+    for output_col, values in evaluate_outputs(context).items():
+        processed_df[output_col] = values
 
-    processed_df['Оценка дисциплины-пререквизита'] = processed_df['Оценка дисциплины-пререквизита'].apply(
-        lambda x: 8 if x >= 9 else x
+    return processed_df
+
+
+def evaluate_outputs(context: dict) -> Dict[str, np.ndarray]:
+    """Значения выходных колонок (ДПР_итог, НЭ_итог) по таблицам правил."""
+    return {output_col: evaluate(context) for output_col, evaluate in _OUTPUT_RULES.items()}
+
+
+def cap_dpr_grades(dpr_raw: np.ndarray, params: dict) -> np.ndarray:
+    """Ограничение оценки ДПР (таблица GRADE_RULES_DPR_CAP зависит только от dpr_raw и параметров)."""
+    return _DPR_CAP_RULES({**params, 'n_rows': len(dpr_raw), 'dpr_raw': dpr_raw})
+
+
+def write_capped_dpr(processed_df: pd.DataFrame, dpr_raw: np.ndarray, dpr_capped: np.ndarray) -> None:
+    """Запись ограниченной оценки ДПР с сохранением исходных значений там, где ограничение не сработало."""
+    processed_df[COL_DPR_GRADE] = processed_df[COL_DPR_GRADE].where(
+        processed_df[COL_DPR_GRADE].isna() | (dpr_capped == dpr_raw), dpr_capped
     )
 
-    processed_df['Этап'] = 1
-    processed_df.loc[processed_df['Наименование НЭ'].str.contains(STAGE_KEYWORD_ANALYSIS, case=False, na=False), 'Этап'] = 3
-    processed_df.loc[processed_df['Наименование НЭ'].str.contains(STAGE_KEYWORD_PROGRAMMING, case=False, na=False), 'Этап'] = 2
-
-    dpr_results = []
-    ie_results = []
-
-    for index, row in processed_df.iterrows():
-        if row['Этап'] == 1:
-            innopolis_grade = row['Внешнее измерение цифровых компетенций. Входной контроль']
-        elif row['Этап'] == 2:
-            innopolis_grade = row['Внешнее измерение цифровых компетенций. Промежуточный контроль']
-        else:
-            innopolis_grade = row['Внешнее измерение цифровых компетенций. Итоговый контроль']
-
-        if use_dynamics:
-            vhod = row['Внешнее измерение цифровых компетенций. Входной контроль']
-            prom = row['Внешнее измерение цифровых компетенций. Промежуточный контроль']
-            itog = row['Внешнее измерение цифровых компетенций. Итоговый контроль']
-            
-            if (vhod - prom > 1) or (vhod - itog > 1) or (prom - itog > 1):
-                dpr_results.append(np.nan)
-                ie_results.append(np.nan)
-                continue
-
-        ne_grade = row['Оценка НЭ']
-        dpr_grade = row['Оценка дисциплины-пререквизита']
-        
-        ne_grade = 0 if pd.isna(ne_grade) else ne_grade
-        dpr_grade = 0 if pd.isna(dpr_grade) else dpr_grade
-        innopolis_grade = 0 if pd.isna(innopolis_grade) else innopolis_grade
-
-        max_grade = max(ne_grade, dpr_grade, innopolis_grade)
-        
-        # Расчет ДПР_итог
-        dpr_final = np.nan
-        if ne_grade < 4:
-            dpr_final = np.nan
-        elif max_grade == innopolis_grade and innopolis_grade > 3 and innopolis_grade != dpr_grade and innopolis_grade != ne_grade:
-            dpr_final = innopolis_grade
-        elif ne_grade == dpr_grade:
-            dpr_final = np.nan
-        elif dpr_grade < 4:
-            dpr_final = ne_grade if ne_grade >= 4 else np.nan
-        elif max_grade == dpr_grade and dpr_grade >= 4:
-            dpr_final = np.nan
-        else:
-            dpr_final = ne_grade
-        dpr_results.append(dpr_final)
-
-        # Расчет НЭ_итог
-        ie_final = np.nan
-        if ne_grade < 4:
-            ie_final = np.nan
-        elif max_grade == innopolis_grade and innopolis_grade > 3 and innopolis_grade != dpr_grade and innopolis_grade != ne_grade:
-            ie_final = innopolis_grade
-        elif ne_grade == dpr_grade:
-            ie_final = np.nan
-        elif max_grade == dpr_grade and dpr_grade >= 4:
-            if ne_grade >= 8:
-                ie_final = np.nan
-            elif dpr_grade >= 8:
-                ie_final = 8
-            else:
-                ie_final = dpr_grade
-        elif ne_grade < 4 and innopolis_grade > 3 and use_dynamics:
-             ie_final = innopolis_grade
-        else:
-            ie_final = np.nan
-        ie_results.append(ie_final)
-
-    processed_df['ДПР_итог'] = dpr_results
-    processed_df['НЭ_итог'] = ie_results
-    
-    return processed_df
+
+def _count_changed(values: np.ndarray, baseline: np.ndarray) -> np.ndarray:
+    """Построчный признак отличия от базового варианта (NaN == NaN)."""
+    return ~((values == baseline) | (np.isnan(values) & np.isnan(baseline)))
+
+
+def sweep_variants_from_rows(rows: List[dict], name_col: str = 'Вариант') -> Dict[str, dict]:
+    """
+    Варианты правил из строк таблицы (редактор вариантов на странице 1).
+
+    Пустые ячейки параметров опускаются (берутся значения по умолчанию). Пустые и
+    повторяющиеся названия — ошибка: в словаре вариантов такие строки заменили бы
+    друг друга, и один из вариантов пропал бы из сравнения.
+
+    Raises:
+        ValueError: если у строк пустые или повторяющиеся названия
+    """
+    names = [str(row.get(name_col)).strip() if pd.notna(row.get(name_col)) else '' for row in rows]
+    blank = [i + 1 for i, name in enumerate(names) if not name]
+    if blank:
+        raise ValueError(f"Не задано название варианта в строках: {', '.join(map(str, blank))}")
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Повторяющиеся названия вариантов: {', '.join(duplicates)}")
+    return {
+        name: {k: v for k, v in row.items() if k != name_col and pd.notna(v)}
+        for name, row in zip(names, rows)
+    }
+
+
+def sweep_grade_recalculation(df: pd.DataFrame, variants: Dict[str, dict]) -> pd.DataFrame:
+    """
+    Сравнение вариантов правил перезачета (what-if) за один проход.
+
+    Этап, внешнее измерение и разницы между этапами вычисляются один раз,
+    для каждого варианта пересчитываются только зависящие от параметров
+    колонки и таблицы правил. Первый вариант считается базовым.
+
+    Args:
+        df: DataFrame с данными студентов
+        variants: {название варианта: параметры правил (ключи GRADE_RECALC_PARAMS)}
+
+    Returns:
+        DataFrame: строка на вариант с параметрами, числом перезачтенных оценок
+        и числом студентов, у которых результат отличается от базового варианта
+    """
+    if not variants:
+        raise ValueError("Не задано ни одного варианта правил")
+
+    processed_df = prepare_recalculation_frame(df)
+    base_context = build_rule_context(processed_df, processed_df['Этап'].to_numpy())
+
+    rows = []
+    baseline = None
+    for name, variant_params in variants.items():
+        params = resolve_rule_params(params=variant_params)
+        context = apply_rule_params(base_context, params)
+        outputs = evaluate_outputs(context)
+        if baseline is None:
+            baseline = outputs
+
+        changed = np.zeros(len(processed_df), dtype=bool)
+        for output_col, values in outputs.items():
+            changed |= _count_changed(values, baseline[output_col])
+
+        row = {'Вариант': name, **params}
+        for output_col, values in outputs.items():
+            row[f'Перезачтено {output_col}'] = int(np.count_nonzero(~np.isnan(values)))
+        row['Изменений относительно базового'] = int(np.count_nonzero(changed))
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+# =============================================================================
+# ПОТОКОВАЯ ОБРАБОТКА
+# =============================================================================
+
+def iter_grade_recalculation(source, use_dynamics: bool, chunksize: int = STREAM_CHUNK_SIZE,
+                             params: dict = None) -> Iterator[pd.DataFrame]:
+    """
+    Перезачет CSV-файла по частям.
+
+    Args:
+        source: Путь или файловый объект с CSV
+        use_dynamics: Учитывать ли динамику оценок
+        chunksize: Количество строк в одном чанке
+        params: Переопределение параметров правил
+
+    Yields:
+        Обработанные чанки с колонками ДПР_итог и НЭ_итог
+    """
+    for chunk in pd.read_csv(source, chunksize=chunksize):
+        yield process_grade_recalculation(chunk, use_dynamics=use_dynamics, params=params)
+
+
+def stream_grade_recalculation(source, sink, use_dynamics: bool, fmt: str = 'xlsx',
+                               chunksize: int = STREAM_CHUNK_SIZE, params: dict = None,
+                               sheet_name: str = 'Результат') -> Tuple[int, pd.DataFrame]:
+    """
+    Потоковый перезачет: CSV читается чанками, результат пишется в sink по мере расчета.
+
+    Пиковое потребление памяти определяется размером чанка, а не размером файла.
+
+    Args:
+        source: Путь или файловый объект с CSV
+        sink: Бинарный файловый объект для результата
+        use_dynamics: Учитывать ли динамику оценок
+        fmt: Формат результата: 'xlsx', 'csv' или 'parquet'
+        chunksize: Количество строк в одном чанке
+        params: Переопределение параметров правил
+        sheet_name: Имя листа для XLSX
+
+    Returns:
+        (количество обработанных строк, первые 10 строк результата для предпросмотра)
+    """
+    preview = {}
+
+    def chunks_with_preview():
+        for chunk in iter_grade_recalculation(source, use_dynamics, chunksize=chunksize, params=params):
+            preview.setdefault('df', chunk.head(10))
+            yield chunk
+
+    total_rows = write_chunks(chunks_with_preview(), sink, fmt=fmt, sheet_name=sheet_name)
+    return total_rows, preview.get('df', pd.DataFrame())
+
+
+# =============================================================================
+# ПАКЕТНАЯ ОБРАБОТКА
+# =============================================================================
+
+def read_recalculation_file(file_name: str, content: bytes) -> pd.DataFrame:
+    """Чтение файла для перезачета (XLSX или CSV) из байтов."""
+    if file_name.lower().endswith('.xlsx'):
+        return pd.read_excel(io.BytesIO(content), engine='openpyxl')
+    if file_name.lower().endswith('.csv'):
+        return pd.read_csv(io.BytesIO(content))
+    raise ValueError(f"Неподдерживаемый формат файла: {file_name}")
+
+
+def _recalculate_file(file_name: str, content: bytes, use_dynamics: bool) -> dict:
+    """
+    Перезачет одного файла пакета; выполняется в отдельном процессе.
+
+    Ошибки не пробрасываются, а возвращаются в поле 'Ошибка', чтобы один
+    некорректный файл не останавливал обработку остальных.
+    """
+    summary = {'Файл': file_name, 'Строк': 0, 'Перезачтено ДПР_итог': 0, 'Перезачтено НЭ_итог': 0, 'Ошибка': ''}
+    try:
+        result_df = process_grade_recalculation(read_recalculation_file(file_name, content), use_dynamics)
+        content = dataframe_to_bytes(result_df, 'xlsx', sheet_name='Результат')
+
+        summary['Строк'] = len(result_df)
+        summary['Перезачтено ДПР_итог'] = int(result_df['ДПР_итог'].notna().sum())
+        summary['Перезачтено НЭ_итог'] = int(result_df['НЭ_итог'].notna().sum())
+        return {'summary': summary, 'content': content}
+    except Exception as e:
+        summary['Ошибка'] = str(e)
+        return {'summary': summary, 'content': None}
+
+
+def process_grade_recalculation_batch(files: List[Tuple[str, bytes]], use_dynamics: bool,
+                                      max_workers: int = None) -> Tuple[bytes, pd.DataFrame]:
+    """
+    Параллельный перезачет нескольких файлов в пуле процессов.
+
+    Args:
+        files: Список (имя файла, содержимое)
+        use_dynamics: Учитывать ли динамику оценок
+        max_workers: Число процессов (по умолчанию — по числу ядер, не больше числа файлов)
+
+    Returns:
+        (ZIP с результатом по каждому файлу и листом 'Сводка', DataFrame сводки)
+    """
+    if not files:
+        raise ValueError("Не выбрано ни одного файла")
+
+    if max_workers is None:
+        max_workers = min(len(files), os.cpu_count() or 1)
+
+    if max_workers <= 1 or len(files) == 1:
+        results = [_recalculate_file(name, content, use_dynamics) for name, content in files]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(_recalculate_file, name, content, use_dynamics) for name, content in files]
+            results = [future.result() for future in futures]
+
+    summary_df = pd.DataFrame([result['summary'] for result in results])
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for result in results:
+            if result['content'] is not None:
+                stem = os.path.splitext(result['summary']['Файл'])[0]
+                zf.writestr(f"Результат_{stem}.xlsx", result['content'])
+
+        zf.writestr("Сводка.xlsx", dataframe_to_bytes(summary_df, 'xlsx', sheet_name='Сводка'))
+
+    return archive.getvalue(), summary_df
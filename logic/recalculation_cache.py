@@ -0,0 +1,165 @@
+"""
+Incremental Grade Recalculation Cache
+Кэш результатов перезачета по отпечатку строки: при повторной загрузке
+файла пересчитываются только измененные строки.
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from constants import GRADE_RULES_DPR_CAP, GRADE_RULE_TABLES
+from logic.grade_recalculation import (
+    REQUIRED_COLUMNS, COL_NE_NAME, COL_DPR_GRADE,
+    prepare_recalculation_frame, write_capped_dpr,
+    build_rule_context, apply_rule_params, resolve_rule_params, evaluate_outputs, cap_dpr_grades
+)
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'dc_platform_grade_cache.sqlite3')
+DEFAULT_CACHE_MAX_ENTRIES = 500_000
+
+# Ограничение SQLite на число параметров в одном запросе
+_SQLITE_CHUNK_SIZE = 500
+
+
+def _rules_salt(params: dict) -> np.uint64:
+    """64-битная соль из параметров и таблиц правил: их изменение инвалидирует кэш."""
+    payload = repr((sorted(params.items()), GRADE_RULES_DPR_CAP, GRADE_RULE_TABLES)).encode('utf-8')
+    return np.frombuffer(hashlib.blake2b(payload, digest_size=8).digest(), dtype=np.uint64)[0]
+
+
+def row_fingerprints(df: pd.DataFrame, params: dict) -> np.ndarray:
+    """
+    Отпечаток каждой строки: хэш шести обязательных колонок и параметров правил (включая use_dynamics).
+
+    Оценки приводятся к float, чтобы 5 и 5.0 из разных форматов файла давали один отпечаток.
+
+    Returns:
+        np.ndarray dtype int64 (знаковый, для хранения в SQLite INTEGER)
+    """
+    normalized = pd.DataFrame({
+        col: (df[col].astype(object) if col == COL_NE_NAME else df[col].astype(float))
+        for col in REQUIRED_COLUMNS
+    })
+    row_hashes = pd.util.hash_pandas_object(normalized, index=False).to_numpy()
+    return pd.util.hash_array(row_hashes ^ _rules_salt(params)).view(np.int64)
+
+
+class RecalculationCache:
+    """
+    Ограниченный дисковый кэш отпечаток → (ДПР_итог, НЭ_итог) на SQLite.
+
+    При превышении max_entries вытесняются записи, которые дольше всего не использовались.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS recalculation_cache ("
+                "fingerprint INTEGER PRIMARY KEY, dpr REAL, ne REAL, used_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_recalculation_cache_used_at ON recalculation_cache(used_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_many(self, fingerprints: np.ndarray) -> pd.DataFrame:
+        """Найденные в кэше записи: DataFrame с индексом fingerprint и колонками ДПР_итог, НЭ_итог."""
+        keys = [int(fp) for fp in np.unique(fingerprints)]
+        rows = []
+        with closing(self._connect()) as conn, conn:
+            for i in range(0, len(keys), _SQLITE_CHUNK_SIZE):
+                chunk = keys[i:i + _SQLITE_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows.extend(conn.execute(
+                    f"SELECT fingerprint, dpr, ne FROM recalculation_cache WHERE fingerprint IN ({placeholders})",
+                    chunk
+                ).fetchall())
+                conn.execute(
+                    f"UPDATE recalculation_cache SET used_at = ? WHERE fingerprint IN ({placeholders})",
+                    [time.time(), *chunk]
+                )
+
+        found = pd.DataFrame(rows, columns=['fingerprint', 'ДПР_итог', 'НЭ_итог'])
+        found['fingerprint'] = found['fingerprint'].astype(np.int64)
+        return found.set_index('fingerprint').astype(float)
+
+    def put_many(self, fingerprints: np.ndarray, dpr: np.ndarray, ne: np.ndarray) -> None:
+        """Сохранение результатов и вытеснение старых записей сверх лимита."""
+        now = time.time()
+        # NaN сохраняется в SQLite как NULL
+        records = [
+            (int(fp), None if np.isnan(d) else float(d), None if np.isnan(n) else float(n), now)
+            for fp, d, n in zip(fingerprints, dpr, ne)
+        ]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO recalculation_cache (fingerprint, dpr, ne, used_at) VALUES (?, ?, ?, ?)",
+                records
+            )
+            (count,) = conn.execute("SELECT COUNT(*) FROM recalculation_cache").fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM recalculation_cache WHERE fingerprint IN ("
+                    "SELECT fingerprint FROM recalculation_cache ORDER BY used_at LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def clear(self) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM recalculation_cache")
+
+
+def process_grade_recalculation_cached(df: pd.DataFrame, use_dynamics: bool, cache: RecalculationCache,
+                                       params: dict = None) -> Tuple[pd.DataFrame, int]:
+    """
+    Перезачет с кэшем по отпечатку строки.
+
+    Этап и ограничение ДПР вычисляются для всех строк (это дешево), таблицы правил
+    выполняются только для строк, отпечатка которых нет в кэше.
+
+    Args:
+        df: DataFrame с данными студентов
+        use_dynamics: Учитывать ли динамику оценок
+        cache: Кэш результатов
+        params: Переопределение параметров правил
+
+    Returns:
+        (результат как у process_grade_recalculation, количество строк, взятых из кэша)
+    """
+    processed_df = prepare_recalculation_frame(df)
+    params = resolve_rule_params(use_dynamics, params)
+
+    fingerprints = row_fingerprints(processed_df, params)
+    cached = cache.get_many(fingerprints)
+    hit_mask = np.isin(fingerprints, cached.index.to_numpy())
+
+    outputs = {col: np.full(len(processed_df), np.nan) for col in ['ДПР_итог', 'НЭ_итог']}
+    if hit_mask.any():
+        hits = cached.reindex(fingerprints[hit_mask])
+        for col in outputs:
+            outputs[col][hit_mask] = hits[col].to_numpy()
+
+    miss_mask = ~hit_mask
+    if miss_mask.any():
+        missed_df = processed_df[miss_mask]
+        context = apply_rule_params(build_rule_context(missed_df, missed_df['Этап'].to_numpy()), params)
+        computed = evaluate_outputs(context)
+        for col in outputs:
+            outputs[col][miss_mask] = computed[col]
+        cache.put_many(fingerprints[miss_mask], computed['ДПР_итог'], computed['НЭ_итог'])
+
+    dpr_raw = processed_df[COL_DPR_GRADE].to_numpy(dtype=float)
+    write_capped_dpr(processed_df, dpr_raw, cap_dpr_grades(dpr_raw, params))
+    for col, values in outputs.items():
+        processed_df[col] = values
+
+    return processed_df, int(hit_mask.sum())
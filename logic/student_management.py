@@ -3,11 +3,11 @@ Logic for Student Management
 Handling student list loading, parsing, and updating in Supabase.
 """
 import pandas as pd
-from typing import Tuple
+from typing import List, Tuple
 import time
 from utils import get_supabase_client, fetch_all_from_supabase
-from logic.data_utils import read_uploaded_file
-from constants import STUDENT_REQUIRED_COLUMNS, STUDENT_DB_TO_DF_MAPPING, HSE_EMAIL_DOMAIN
+from logic.data_utils import read_uploaded_file, compact_dtypes
+from constants import STUDENT_REQUIRED_COLUMNS, STUDENT_DB_TO_DF_MAPPING, HSE_EMAIL_DOMAIN, EMAIL_KEY_COLUMN
 
 def load_student_list_file(uploaded_file) -> pd.DataFrame:
     """
@@ -56,44 +56,48 @@ def load_student_list_file(uploaded_file) -> pd.DataFrame:
             result_df = result_df[result_df['Корпоративная почта'].astype(str).str.contains(HSE_EMAIL_DOMAIN, na=False)]
             result_df['Корпоративная почта'] = pd.Series(result_df['Корпоративная почта']).astype(str).str.lower().str.strip()
             
-        return result_df
+        return compact_dtypes(result_df)
         
     except Exception as e:
         raise ValueError(f"Ошибка загрузки списка студентов: {e}")
 
+def build_student_records(student_data: pd.DataFrame) -> list:
+    """
+    Подготовка записей для таблицы students: фильтрация по домену,
+    удаление дубликатов email, маппинг колонок DataFrame в колонки БД.
+    """
+    records_for_upsert = []
+    processed_emails = set()
+    
+    for _, row in student_data.iterrows():
+        email = str(row.get('Корпоративная почта', '')).strip().lower()
+        if not email or HSE_EMAIL_DOMAIN not in email:
+            continue
+        if email in processed_emails:
+            continue
+        processed_emails.add(email)
+            
+        student_record = {
+            'корпоративная_почта': email,
+            'фио': str(row.get('ФИО', 'Неизвестно')).strip() or 'Неизвестно',
+            'филиал_кампус': str(row.get('Филиал (кампус)', '')) if pd.notna(row.get('Филиал (кампус)')) and str(row.get('Филиал (кампус)', '')).strip() else None,
+            'факультет': str(row.get('Факультет', '')) if pd.notna(row.get('Факультет')) and str(row.get('Факультет', '')).strip() else None,
+            'образовательная_программа': str(row.get('Образовательная программа', '')) if pd.notna(row.get('Образовательная программа')) and str(row.get('Образовательная программа', '')).strip() else None,
+            'версия_образовательной_программы': str(row.get('Версия образовательной программы', '')) if pd.notna(row.get('Версия образовательной программы')) and str(row.get('Версия образовательной программы', '')).strip() else None,
+            'группа': str(row.get('Группа', '')) if pd.notna(row.get('Группа')) and str(row.get('Группа', '')).strip() else None,
+            'курс': str(row.get('Курс', '')) if pd.notna(row.get('Курс')) and str(row.get('Курс', '')).strip() else None,
+            'уровень_образования': str(row.get('Уровень образования', '')) if pd.notna(row.get('Уровень образования')) and str(row.get('Уровень образования', '')).strip() else None,
+        }
+        records_for_upsert.append(student_record)
+    
+    return records_for_upsert
+
 def upload_students_to_supabase(supabase, student_data: pd.DataFrame) -> Tuple[bool, str]:
     """
     Загрузка данных студентов в таблицу students с использованием оптимизированного UPSERT.
     """
     try:
-        records_for_upsert = []
-        processed_emails = set()
-        
-        # Инвертируем маппинг для сохранения в БД (DF Name -> DB Name)
-        # STUDENT_DB_TO_DF_MAPPING: 'db_col' -> 'Df Col'
-        # Нам нужно обратное, но у нас в коде keys это db_col.
-        # Подготовим маппинг для value из row.
-        
-        for _, row in student_data.iterrows():
-            email = str(row.get('Корпоративная почта', '')).strip().lower()
-            if not email or HSE_EMAIL_DOMAIN not in email:
-                continue
-            if email in processed_emails:
-                continue
-            processed_emails.add(email)
-                
-            student_record = {
-                'корпоративная_почта': email,
-                'фио': str(row.get('ФИО', 'Неизвестно')).strip() or 'Неизвестно',
-                'филиал_кампус': str(row.get('Филиал (кампус)', '')) if pd.notna(row.get('Филиал (кампус)')) and str(row.get('Филиал (кампус)', '')).strip() else None,
-                'факультет': str(row.get('Факультет', '')) if pd.notna(row.get('Факультет')) and str(row.get('Факультет', '')).strip() else None,
-                'образовательная_программа': str(row.get('Образовательная программа', '')) if pd.notna(row.get('Образовательная программа')) and str(row.get('Образовательная программа', '')).strip() else None,
-                'версия_образовательной_программы': str(row.get('Версия образовательной программы', '')) if pd.notna(row.get('Версия образовательной программы')) and str(row.get('Версия образовательной программы', '')).strip() else None,
-                'группа': str(row.get('Группа', '')) if pd.notna(row.get('Группа')) and str(row.get('Группа', '')).strip() else None,
-                'курс': str(row.get('Курс', '')) if pd.notna(row.get('Курс')) and str(row.get('Курс', '')).strip() else None,
-                'уровень_образования': str(row.get('Уровень образования', '')) if pd.notna(row.get('Уровень образования')) and str(row.get('Уровень образования', '')).strip() else None,
-            }
-            records_for_upsert.append(student_record)
+        records_for_upsert = build_student_records(student_data)
         
         if not records_for_upsert:
             return False, "Нет записей для обработки"
@@ -131,23 +135,35 @@ def upload_students_to_supabase(supabase, student_data: pd.DataFrame) -> Tuple[b
     except Exception as e:
         return False, f"Критическая ошибка UPSERT студентов: {e}"
 
-def load_students_from_supabase(filters: dict = None) -> pd.DataFrame:
+def load_students_from_supabase(filters: dict = None, columns: List[str] = None,
+                                normalize_email: bool = False) -> pd.DataFrame:
     """
     Загрузка списка студентов из Supabase с кэшированием (TTL 300с).
     Поддерживает фильтрацию (например, {'курс': 'Курс 4'}).
+    columns — только нужные колонки в именах DataFrame (например, constants.STUDENT_LOOKUP_COLUMNS).
+    normalize_email — почта в нижнем регистре без пробелов (из колонки email_key в БД).
     """
     try:
-        # Используем fetch_all_from_supabase из utils для пагинации
-        all_data = fetch_all_from_supabase('students', filters=filters)
+        db_columns = None
+        if columns:
+            df_to_db = {v: k for k, v in STUDENT_DB_TO_DF_MAPPING.items()}
+            db_columns = [df_to_db.get(col, col) for col in columns]
+
+        # Используем fetch_all_from_supabase из utils: страницы загружаются параллельно
+        all_data = fetch_all_from_supabase(
+            'students', filters=filters, pagination='parallel', columns=db_columns,
+            email_key='корпоративная_почта' if normalize_email else None
+        )
         
         if all_data:
-            df = pd.DataFrame(all_data)
+            # Служебный email_key (select *) в список студентов не попадает
+            df = pd.DataFrame(all_data).drop(columns=[EMAIL_KEY_COLUMN], errors='ignore')
             
             # Переименование колонок используя константу
             existing_columns = {k: v for k, v in STUDENT_DB_TO_DF_MAPPING.items() if k in df.columns}
             df = df.rename(columns=existing_columns)
             
-            return df
+            return compact_dtypes(df)
         else:
             return pd.DataFrame()
             
@@ -7,7 +7,8 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 from datetime import datetime
-import io
+import os
+import tempfile
 from utils import icon
 
 # Заголовок страницы
@@ -26,7 +27,23 @@ st.markdown("""
 - Внешнее измерение цифровых компетенций (Входной, Промежуточный, Итоговый контроль)
 """)
 
-from logic.grade_recalculation import process_grade_recalculation
+from logic.grade_recalculation import (
+    process_grade_recalculation, sweep_grade_recalculation, sweep_variants_from_rows,
+    stream_grade_recalculation, process_grade_recalculation_batch
+)
+from logic.recalculation_cache import RecalculationCache, process_grade_recalculation_cached
+from logic.export import EXPORT_MIME_TYPES, export_dataframe, open_export_file
+from constants import GRADE_RECALC_PARAMS
+
+SWEEP_MODE = "Сравнение вариантов правил"
+
+# Варианты по умолчанию для режима сравнения (первый — базовый)
+DEFAULT_SWEEP_VARIANTS = pd.DataFrame([
+    {'Вариант': 'Без динамики', **GRADE_RECALC_PARAMS, 'use_dynamics': False},
+    {'Вариант': 'С динамикой', **GRADE_RECALC_PARAMS, 'use_dynamics': True},
+    {'Вариант': 'С динамикой, падение > 2', **GRADE_RECALC_PARAMS, 'use_dynamics': True, 'dynamics_max_drop': 2},
+    {'Вариант': 'Без ограничения ДПР', **GRADE_RECALC_PARAMS, 'dpr_cap_threshold': 11},
+])
 
 # Загрузка файла
 uploaded_file = st.file_uploader(
@@ -40,45 +57,174 @@ if uploaded_file is not None:
     
     processing_mode = st.radio(
         "Режим обработки:",
-        ("Перезачет БЕЗ динамики", "Перезачет С динамикой"),
+        ("Перезачет БЕЗ динамики", "Перезачет С динамикой", SWEEP_MODE),
         help="""
         - **БЕЗ динамики**: Стандартный перезачет по максимальной оценке.
         - **С динамикой**: Если оценка падает более чем на 1 балл между этапами, перезачет блокируется.
+        - **Сравнение вариантов правил**: Сколько студентов меняют результат при разных параметрах правил.
         """
     )
 
+    if processing_mode == SWEEP_MODE:
+        st.markdown("Первый вариант считается базовым, остальные сравниваются с ним.")
+        variants_df = st.data_editor(
+            DEFAULT_SWEEP_VARIANTS,
+            num_rows="dynamic",
+            use_container_width=True,
+            key="sweep_variants",
+            column_config={
+                'Вариант': st.column_config.TextColumn("Вариант", required=True),
+                'use_dynamics': st.column_config.CheckboxColumn("Учитывать динамику"),
+                'dpr_cap_threshold': st.column_config.NumberColumn("ДПР ограничивается от", min_value=0, max_value=11, step=1),
+                'dpr_cap_value': st.column_config.NumberColumn("Ограничение ДПР до", min_value=0, max_value=10, step=1),
+                'dynamics_max_drop': st.column_config.NumberColumn("Допустимое падение", min_value=0, max_value=10, step=1),
+            }
+        )
+
+    stream_mode = False
+    if file_name.endswith('.csv') and processing_mode != SWEEP_MODE:
+        stream_mode = st.checkbox(
+            "Потоковая обработка (для очень больших CSV)",
+            help="Файл обрабатывается частями, результат записывается на диск по мере расчета. "
+                 "Память на расчет не зависит от размера файла; готовый результат "
+                 "для скачивания загружается в память целиком."
+        )
+        if stream_mode:
+            stream_format = st.radio("Формат результата:", ("xlsx", "csv", "parquet"), horizontal=True)
+
+    use_cache = False
+    if processing_mode != SWEEP_MODE and not stream_mode:
+        use_cache = st.checkbox(
+            "Использовать кэш результатов",
+            value=True,
+            help="Строки, которые не изменились с прошлой загрузки, берутся из кэша без пересчета."
+        )
+
     if st.button("Обработать файл", type="primary"):
         with st.spinner("Обработка данных..."):
             try:
-                if file_name.endswith('.xlsx'):
-                    df_initial = pd.read_excel(uploaded_file, engine='openpyxl')
+                current_date = datetime.now().strftime('%d-%m-%y')
+
+                if stream_mode:
+                    use_dynamics_flag = (processing_mode == "Перезачет С динамикой")
+                    with tempfile.NamedTemporaryFile(suffix=f'.{stream_format}', delete=False) as sink:
+                        try:
+                            total_rows, preview_df = stream_grade_recalculation(
+                                uploaded_file, sink, use_dynamics=use_dynamics_flag, fmt=stream_format
+                            )
+                        except Exception:
+                            # Частично записанный результат не остается во временной директории
+                            sink.close()
+                            os.unlink(sink.name)
+                            raise
+                    # Файл удаляется из файловой системы сразу и освобождается после закрытия потока
+                    result_file = open_export_file(sink.name)
+
+                    st.success(f"Обработка успешно завершена! Обработано строк: {total_rows}")
+                    st.subheader("Предварительный просмотр")
+                    st.dataframe(preview_df, use_container_width=True)
+
+                    with result_file:
+                        st.download_button(
+                            label="Скачать результат",
+                            data=result_file,
+                            file_name=f"Результат_{file_name.split('.')[0]}_{current_date}.{stream_format}",
+                            mime=EXPORT_MIME_TYPES[stream_format]
+                        )
                 else:
-                    df_initial = pd.read_csv(uploaded_file)
+                    if file_name.endswith('.xlsx'):
+                        df_initial = pd.read_excel(uploaded_file, engine='openpyxl')
+                    else:
+                        df_initial = pd.read_csv(uploaded_file)
 
-                use_dynamics_flag = (processing_mode == "Перезачет С динамикой")
-                result_df = process_grade_recalculation(df_initial, use_dynamics=use_dynamics_flag)
+                    if processing_mode == SWEEP_MODE:
+                        # Пустые ячейки новых строк заменяются параметрами по умолчанию;
+                        # пустые и повторяющиеся названия вариантов не принимаются
+                        try:
+                            variants = sweep_variants_from_rows(variants_df.to_dict('records'))
+                        except ValueError as e:
+                            st.error(str(e))
+                            st.stop()
+                        result_df = sweep_grade_recalculation(df_initial, variants)
+                        sheet_name = 'Сравнение'
+                    else:
+                        use_dynamics_flag = (processing_mode == "Перезачет С динамикой")
+                        if use_cache:
+                            result_df, cached_rows = process_grade_recalculation_cached(
+                                df_initial, use_dynamics_flag, RecalculationCache()
+                            )
+                            st.info(f"Взято из кэша строк: {cached_rows} из {len(result_df)}")
+                        else:
+                            result_df = process_grade_recalculation(df_initial, use_dynamics=use_dynamics_flag)
+                        sheet_name = 'Результат'
                 
-                st.success("Обработка успешно завершена!")
+                    st.success("Обработка успешно завершена!")
                 
-                st.subheader("Предварительный просмотр")
-                st.dataframe(result_df.head(10), use_container_width=True)
+                    if processing_mode == SWEEP_MODE:
+                        st.subheader("Сравнение вариантов")
+                        st.dataframe(result_df, use_container_width=True)
+                    else:
+                        st.subheader("Предварительный просмотр")
+                        st.dataframe(result_df.head(10), use_container_width=True)
 
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    result_df.to_excel(writer, index=False, sheet_name='Результат')
-                excel_data = output.getvalue()
-
-                current_date = datetime.now().strftime('%d-%m-%y')
-                download_filename = f"Результат_{file_name.split('.')[0]}_{current_date}.xlsx"
+                    download_filename = f"{sheet_name}_{file_name.split('.')[0]}_{current_date}.xlsx"
                 
-                st.download_button(
-                    label="Скачать результат",
-                    data=excel_data,
-                    file_name=download_filename,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+                    with export_dataframe(result_df, 'xlsx', sheet_name=sheet_name) as excel_data:
+                        st.download_button(
+                            label="Скачать результат",
+                            data=excel_data,
+                            file_name=download_filename,
+                            mime=EXPORT_MIME_TYPES['xlsx']
+                        )
 
             except KeyError as e:
                 st.error(f"Ошибка в структуре файла: {e}")
             except Exception as e:
                 st.error(f"Произошла ошибка: {e}")
+
+# Пакетная обработка нескольких файлов
+st.markdown("---")
+st.subheader("Пакетная обработка")
+st.markdown("Загрузите сразу несколько файлов (например, по каждому факультету) — они будут обработаны параллельно.")
+
+batch_files = st.file_uploader(
+    "Выберите файлы для пакетной обработки",
+    type=['xlsx', 'csv'],
+    accept_multiple_files=True,
+    key="grade_files_batch"
+)
+
+if batch_files:
+    batch_mode = st.radio(
+        "Режим обработки пакета:",
+        ("Перезачет БЕЗ динамики", "Перезачет С динамикой"),
+        key="batch_processing_mode"
+    )
+
+    if st.button("Обработать пакет", type="primary", key="process_batch_btn"):
+        with st.spinner(f"Обработка файлов: {len(batch_files)}..."):
+            try:
+                archive, summary_df = process_grade_recalculation_batch(
+                    [(f.name, f.getvalue()) for f in batch_files],
+                    use_dynamics=(batch_mode == "Перезачет С динамикой")
+                )
+
+                failed = summary_df[summary_df['Ошибка'] != '']
+                if failed.empty:
+                    st.success("Пакетная обработка успешно завершена!")
+                else:
+                    st.warning(f"Не удалось обработать файлов: {len(failed)}. Подробности в сводке.")
+
+                st.subheader("Сводка")
+                st.dataframe(summary_df, use_container_width=True)
+
+                current_date = datetime.now().strftime('%d-%m-%y')
+                st.download_button(
+                    label="Скачать результаты (ZIP)",
+                    data=archive,
+                    file_name=f"Результаты_перезачета_{current_date}.zip",
+                    mime="application/zip",
+                    key="dl_batch_zip"
+                )
+            except Exception as e:
+                st.error(f"Произошла ошибка: {e}")
@@ -3,13 +3,14 @@
 Supabase интеграция для пересдач
 """
 
+import time
 import streamlit as st
 import pandas as pd
-import io
 from datetime import datetime
 from typing import Tuple
-from utils import icon, get_supabase_client, load_lottie_url
-from constants import LOTTIE_SUCCESS_URL, LOTTIE_EMPTY_URL
+from utils import icon, get_supabase_client, load_lottie_url, run_in_background
+from logic.export import EXPORT_MIME_TYPES, export_dataframe
+from constants import LOTTIE_SUCCESS_URL, LOTTIE_EMPTY_URL, STUDENT_LOOKUP_COLUMNS, PREFETCH_MAX_AGE
 from streamlit_lottie import st_lottie
 
 # Заголовок страницы
@@ -244,12 +245,13 @@ from logic.external_assessment import (
     load_existing_peresdachi,
     load_peresdachi_by_date_range,
     load_student_io_from_supabase,
-    save_to_supabase,
     get_new_records_from_dataframe,
-    deduplicate_and_split,
+    deduplicate_and_save,
+    upload_emails,
     process_external_assessment,
     process_project_assessment,
-    update_final_grades
+    update_final_grades,
+    ReferenceSnapshot
 )
 from logic.student_management import load_students_from_supabase
 
@@ -261,6 +263,62 @@ except Exception as e:
     st.error(f"Ошибка подключения к Supabase: {str(e)}")
     st.stop()
 
+# Предзагрузка при открытии страницы: к загрузке файла и нажатию «Обработать»
+# список студентов уже загружен или загружается в фоне. Загрузка старше PREFETCH_MAX_AGE
+# заменяется новой, чтобы студенты, измененные за время сессии, попали в сопоставление
+STUDENT_FILTERS = {'курс': ['Курс 2', 'Курс 3', 'Курс 4']}
+
+def prefetch_students() -> None:
+    """Фоновая загрузка списка студентов, если ее нет или она устарела."""
+    prefetched = st.session_state.get('students_prefetch')
+    if prefetched is None or time.monotonic() - prefetched[0] > PREFETCH_MAX_AGE:
+        st.session_state['students_prefetch'] = (time.monotonic(), run_in_background(
+            load_students_from_supabase, filters=STUDENT_FILTERS, columns=STUDENT_LOOKUP_COLUMNS, normalize_email=True
+        ))
+
+prefetch_students()
+
+def get_prefetched_students() -> pd.DataFrame:
+    """Список студентов из фоновой загрузки; если она упала — повторная загрузка."""
+    prefetch_students()
+    try:
+        return st.session_state['students_prefetch'][1].result()
+    except Exception:
+        st.session_state.pop('students_prefetch', None)
+        return load_students_from_supabase(
+            filters=STUDENT_FILTERS, columns=STUDENT_LOOKUP_COLUMNS, normalize_email=True
+        )
+
+def prefetch_reference_snapshot(state_key: str, upload, grades_df: pd.DataFrame, project: bool = False) -> None:
+    """
+    Фоновая загрузка справочных таблиц, как только файл загружен: пока открыт предпросмотр,
+    читаются строки email файла (для большого файла — таблицы целиком).
+
+    Загрузка запускается один раз на файл: повторные запуски скрипта (скачивание, вкладки,
+    виджеты) ее не повторяют; обновление устаревшего снимка — в take_reference_snapshot.
+    """
+    upload_id = (upload.name, upload.size)
+    prefetched = st.session_state.get(state_key)
+    if prefetched is None or prefetched[0] != upload_id:
+        snapshot = ReferenceSnapshot().scope(upload_emails(grades_df, project=project)).prefetch()
+        st.session_state[state_key] = (upload_id, snapshot)
+
+def take_reference_snapshot(state_key: str, upload) -> ReferenceSnapshot:
+    """
+    Снимок справочных таблиц для запуска обработки.
+
+    Предзагруженный снимок отдается один раз; если он уже использован или старше
+    PREFETCH_MAX_AGE, таблицы загружаются заново в ходе обработки. Использованный снимок
+    остается отмеченным для этого файла (без данных), чтобы следующие запуски скрипта
+    не начинали новую фоновую загрузку.
+    """
+    upload_id = (upload.name, upload.size)
+    prefetched = st.session_state.get(state_key)
+    st.session_state[state_key] = (upload_id, None)
+    if prefetched is None or prefetched[0] != upload_id or prefetched[1] is None or prefetched[1].age > PREFETCH_MAX_AGE:
+        return ReferenceSnapshot()
+    return prefetched[1]
+
 st.markdown("---")
 
 # Используем табы для разделения функционала
@@ -285,12 +343,11 @@ with tab_tests:
                     grades_df = pd.read_excel(grades_file)
 
             st.success("Файл с оценками успешно загружен!")
+            prefetch_reference_snapshot('reference_snapshot_tests', grades_file, grades_df)
 
-            # Загрузка студентов (с кэшированием в session_state)
-            if 'students_df_tests' not in st.session_state:
-                with st.spinner("Загрузка списка студентов из Supabase..."):
-                    st.session_state['students_df_tests'] = load_students_from_supabase(filters={'курс': ['Курс 2', 'Курс 3', 'Курс 4']})
-            students_df = st.session_state['students_df_tests']
+            # Список студентов из предзагрузки (обновляется через PREFETCH_MAX_AGE)
+            with st.spinner("Загрузка списка студентов из Supabase..."):
+                students_df = get_prefetched_students()
 
             if students_df.empty:
                 st.error("Список студентов пуст. Загрузите данные в таблицу `students` в Supabase.")
@@ -315,7 +372,9 @@ with tab_tests:
             if st.button("Обработать данные (Тесты)", type="primary", key="process_btn_tests"):
                 with st.spinner("Обработка пересдач..."):
                     try:
-                        result_df, logs = process_external_assessment(grades_df, students_df)
+                        # Справочные таблицы загружаются один раз на запуск (обычно уже в фоне)
+                        snapshot = take_reference_snapshot('reference_snapshot_tests', grades_file)
+                        result_df, logs = process_external_assessment(grades_df, students_df, snapshot=snapshot)
                         for log_msg in logs:
                             st.info(log_msg)
 
@@ -325,20 +384,15 @@ with tab_tests:
                             # 1. Сохраняем результат в session_state
                             st.session_state['result_df_tests'] = result_df
                             
-                            # 2. Дедупликация и разделение на новые/старые
-                            split = deduplicate_and_split(result_df)
+                            # 2. Дедупликация и автоматическое сохранение: новые записи — те,
+                            # которые вставила БД (уникальный индекс пропускает уже сохраненные)
+                            split = deduplicate_and_save(result_df, snapshot=snapshot)
 
                             # Сохраняем обработанное состояние для отображения
                             st.session_state['tests_processed_state'] = {
                                 **split,
                                 'processed_at': datetime.now(),
-                                'save_msg': ''
                             }
-
-                            # Автоматическое сохранение при обработке
-                            save_success, save_msg = save_to_supabase(split['display_new_records'])
-                            st.session_state['tests_processed_state']['save_success'] = save_success
-                            st.session_state['tests_processed_state']['save_msg'] = save_msg
                             
                     except Exception as e:
                         st.error(f"Ошибка: {str(e)}")
@@ -354,7 +408,7 @@ with tab_tests:
                      st.warning(f"Удалено {state['duplicates_removed']} дубликатов.")
 
                 if state['save_success']:
-                    st.success(f"{state.get('save_msg', 'Сохранено новых записей')}: {state['new_count']}.") 
+                    st.success(state.get('save_msg') or f"Сохранено новых записей: {state['new_count']}.")
                     lottie_success = load_lottie_url(LOTTIE_SUCCESS_URL)
                     if lottie_success:
                         st_lottie(lottie_success, height=150, key="success_anim_tests", loop=False) # LOOP FALSE
@@ -374,22 +428,16 @@ with tab_tests:
                 
                 with subtab1:
                     st.dataframe(state['result_df'], use_container_width=True)
-                    output_all = io.BytesIO()
-                    with pd.ExcelWriter(output_all, engine='openpyxl') as writer:
-                        state['result_df'].to_excel(writer, index=False)
-                    output_all.seek(0)
-                    st.download_button("Скачать все (XLSX)", output_all, f"Tests_All_{current_date}.xlsx", key="dl_all_tests")
+                    with export_dataframe(state['result_df'], 'xlsx') as output_all:
+                        st.download_button("Скачать все (XLSX)", output_all, f"Tests_All_{current_date}.xlsx", mime=EXPORT_MIME_TYPES['xlsx'], key="dl_all_tests")
 
                 with subtab2:
                     if state['display_new_records'].empty:
                         st.info("Новых нет")
                     else:
                         st.dataframe(state['display_new_records'], use_container_width=True)
-                        output_new = io.BytesIO()
-                        with pd.ExcelWriter(output_new, engine='openpyxl') as writer:
-                            state['display_new_records'].to_excel(writer, index=False)
-                        output_new.seek(0)
-                        st.download_button("Скачать новые (XLSX)", output_new, f"Tests_New_{current_date}.xlsx", key="dl_new_tests")
+                        with export_dataframe(state['display_new_records'], 'xlsx') as output_new:
+                            st.download_button("Скачать новые (XLSX)", output_new, f"Tests_New_{current_date}.xlsx", mime=EXPORT_MIME_TYPES['xlsx'], key="dl_new_tests")
 
         except Exception as e:
             st.error(f"Ошибка файла: {str(e)}")
@@ -415,12 +463,11 @@ with tab_projects:
                     project_grades_df = pd.read_excel(project_file)
             
             st.success("Файл успешно загружен!")
+            prefetch_reference_snapshot('reference_snapshot_projects', project_file, project_grades_df, project=True)
             
-            # Загрузка студентов (с кэшированием в session_state)
-            if 'students_df_projects' not in st.session_state:
-                with st.spinner("Загрузка студентов из Supabase..."):
-                    st.session_state['students_df_projects'] = load_students_from_supabase(filters={'курс': ['Курс 2', 'Курс 3', 'Курс 4']})
-            students_df = st.session_state['students_df_projects']
+            # Список студентов из предзагрузки (обновляется через PREFETCH_MAX_AGE)
+            with st.spinner("Загрузка студентов из Supabase..."):
+                students_df = get_prefetched_students()
             
             if students_df.empty:
                 st.error("Список студентов пуст.")
@@ -435,7 +482,8 @@ with tab_projects:
                 if st.button("Обработать данные (Проекты)", type="primary", key="process_btn_projects"):
                      with st.spinner("Обработка проектов..."):
                         try:
-                            result_df, logs = process_project_assessment(project_grades_df, students_df)
+                            snapshot = take_reference_snapshot('reference_snapshot_projects', project_file)
+                            result_df, logs = process_project_assessment(project_grades_df, students_df, snapshot=snapshot)
                             for log_msg in logs:
                                 st.info(log_msg)
                             
@@ -445,23 +493,18 @@ with tab_projects:
                                 # 1. Сохраняем в session_state
                                 st.session_state['result_df_projects'] = result_df
                                 
-                                # 2. Дедупликация и разделение на новые/старые
-                                split = deduplicate_and_split(result_df)
+                                # 2. Дедупликация и сохранение новых записей
+                                split = deduplicate_and_save(result_df, snapshot=snapshot)
 
                                 # Сохранение состояния
                                 st.session_state['projects_processed_state'] = {
                                     **split,
                                     'processed_at': datetime.now(),
-                                    'save_msg': ''
                                 }
-
-                                save_success, save_msg = save_to_supabase(split['display_new_records'])
-                                st.session_state['projects_processed_state']['save_success'] = save_success
-                                st.session_state['projects_processed_state']['save_msg'] = save_msg
                                 
                                 # Обновляем final_grades для ВСЕХ обработанных записей (результат шага 1)
                                 # так как даже если запись не новая для peresdachi, оценка могла измениться
-                                if save_success:
+                                if split['save_success']:
                                     st.info("Обновление сводной таблицы final_grades...")
                                     fg_success, fg_updated, fg_msg = update_final_grades(result_df)
                                     if fg_success:
@@ -483,7 +526,7 @@ with tab_projects:
                          st.warning(f"Удалено {state['duplicates_removed']} дубликатов.")
 
                     if state['save_success']:
-                        st.success(f"{state.get('save_msg', 'Сохранено новых записей')}: {state['new_count']}")
+                        st.success(state.get('save_msg') or f"Сохранено новых записей: {state['new_count']}")
                         lottie_success = load_lottie_url(LOTTIE_SUCCESS_URL)
                         if lottie_success:
                             st_lottie(lottie_success, height=150, key="success_anim_projects", loop=False) # LOOP FALSE
@@ -501,22 +544,16 @@ with tab_projects:
 
                     with subtab1:
                         st.dataframe(state['result_df'], use_container_width=True)
-                        output_all = io.BytesIO()
-                        with pd.ExcelWriter(output_all, engine='openpyxl') as writer:
-                            state['result_df'].to_excel(writer, index=False)
-                        output_all.seek(0)
-                        st.download_button("Скачать все (XLSX)", output_all, f"Projects_All_{current_date}.xlsx", key="dl_all_projects")
+                        with export_dataframe(state['result_df'], 'xlsx') as output_all:
+                            st.download_button("Скачать все (XLSX)", output_all, f"Projects_All_{current_date}.xlsx", mime=EXPORT_MIME_TYPES['xlsx'], key="dl_all_projects")
                     
                     with subtab2:
                         if state['display_new_records'].empty:
                             st.info("Новых записей нет")
                         else:
                             st.dataframe(state['display_new_records'], use_container_width=True)
-                            output_new = io.BytesIO()
-                            with pd.ExcelWriter(output_new, engine='openpyxl') as writer:
-                                state['display_new_records'].to_excel(writer, index=False)
-                            output_new.seek(0)
-                            st.download_button("Скачать новые (XLSX)", output_new, f"Projects_New_{current_date}.xlsx", key="dl_new_projects")
+                            with export_dataframe(state['display_new_records'], 'xlsx') as output_new:
+                                st.download_button("Скачать новые (XLSX)", output_new, f"Projects_New_{current_date}.xlsx", mime=EXPORT_MIME_TYPES['xlsx'], key="dl_new_projects")
 
         except Exception as e:
             st.error(f"Ошибка чтения файла: {str(e)}")
@@ -566,16 +603,12 @@ with st.expander("📥 Выгрузка данных из базы (peresdachi)"
             st.metric("Найдено записей", len(filtered_df))
             st.dataframe(filtered_df, use_container_width=True)
 
-            output_filtered = io.BytesIO()
-            with pd.ExcelWriter(output_filtered, engine='openpyxl') as writer:
-                filtered_df.to_excel(writer, index=False)
-            output_filtered.seek(0)
-
             file_label = f"{d_from}_to_{d_to}".replace("-", "") if d_from else "filtered"
-            st.download_button(
-                label="⬇️ Скачать XLSX",
-                data=output_filtered,
-                file_name=f"peresdachi_{file_label}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                key="dl_peresdachi_filtered"
-            )
+            with export_dataframe(filtered_df, 'xlsx') as output_filtered:
+                st.download_button(
+                    label="⬇️ Скачать XLSX",
+                    data=output_filtered,
+                    file_name=f"peresdachi_{file_label}.xlsx",
+                    mime=EXPORT_MIME_TYPES['xlsx'],
+                    key="dl_peresdachi_filtered"
+                )
@@ -263,8 +263,8 @@ else:
             try:
                 from logic.student_management import load_students_from_supabase
                 st.info("Получение списка зарегистрированных студентов из базы...")
-                all_students_df = load_students_from_supabase()
-                enrolled_emails = set(all_students_df['Адрес электронной почты'].str.lower().str.strip())
+                all_students_df = load_students_from_supabase(columns=['Адрес электронной почты'], normalize_email=True)
+                enrolled_emails = set(all_students_df['Адрес электронной почты'].dropna())
                 st.success(f"Загружено {len(enrolled_emails)} уникальных студентов из базы.")
 
                 st.info("Обработка файлов курсов...")
@@ -11,6 +11,7 @@ from logic.student_management import (
     upload_students_to_supabase, 
     load_students_from_supabase
 )
+from logic.export import EXPORT_MIME_TYPES, export_dataframe
 
 # Заголовок страницы
 st.markdown(
@@ -218,15 +219,14 @@ else:
                             if filtered_students.empty:
                                 st.info("Нет данных для скачивания по выбранным фильтрам")
                             else:
-                                csv_data = filtered_students.to_csv(index=False, sep=';', encoding='utf-8-sig')
-                                
-                                st.download_button(
-                                    label="📥 Скачать список студентов (CSV)",
-                                    data=csv_data,
-                                    file_name=f"students_export_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                                    mime="text/csv",
-                                    key="download_filtered_csv"
-                                )
+                                with export_dataframe(filtered_students, 'csv', sep=';') as csv_data:
+                                    st.download_button(
+                                        label="📥 Скачать список студентов (CSV)",
+                                        data=csv_data,
+                                        file_name=f"students_export_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                                        mime=EXPORT_MIME_TYPES['csv'],
+                                        key="download_filtered_csv"
+                                    )
                                 
                                 st.success(f"CSV файл готов! {len(filtered_students)} записей")
                                 
@@ -241,20 +241,14 @@ else:
                             if filtered_students.empty:
                                 st.info("Нет данных для скачивания по выбранным фильтрам")
                             else:
-                                from io import BytesIO
-                                buffer = BytesIO()
-                                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                                    filtered_students.to_excel(writer, index=False, sheet_name='Students')
-                                
-                                buffer.seek(0)
-                                
-                                st.download_button(
-                                    label="📥 Скачать список студентов (Excel)",
-                                    data=buffer,
-                                    file_name=f"students_export_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                    key="download_filtered_xlsx"
-                                )
+                                with export_dataframe(filtered_students, 'xlsx', sheet_name='Students') as buffer:
+                                    st.download_button(
+                                        label="📥 Скачать список студентов (Excel)",
+                                        data=buffer,
+                                        file_name=f"students_export_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                                        mime=EXPORT_MIME_TYPES['xlsx'],
+                                        key="download_filtered_xlsx"
+                                    )
                                 
                                 st.success(f"Excel-файл готов! {len(filtered_students)} записей")
                                 
@@ -275,7 +269,7 @@ else:
                     label="📥 Скачать пустой список (CSV)",
                     data="",
                     file_name=f"students_export_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                    mime="text/csv",
+                    mime=EXPORT_MIME_TYPES['csv'],
                     disabled=True
                 )
             with col_btn2:
@@ -283,7 +277,7 @@ else:
                     label="📥 Скачать пустой список (Excel)",
                     data="",
                     file_name=f"students_export_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    mime=EXPORT_MIME_TYPES['xlsx'],
                     disabled=True
                 )
 
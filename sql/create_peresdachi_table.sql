@@ -15,13 +15,23 @@ CREATE TABLE IF NOT EXISTS peresdachi (
     "Период аттестации" TEXT,
     "Оценка" TEXT,
     "Отмена" TEXT,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    -- Нормализованный email для поиска без учета регистра (см. migration_add_email_keys.sql)
+    email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED
 );
 
 -- Создание индексов для ускорения поиска
 CREATE INDEX IF NOT EXISTS idx_peresdachi_email ON peresdachi("Адрес электронной почты");
 CREATE INDEX IF NOT EXISTS idx_peresdachi_discipline ON peresdachi("Наименование дисциплины");
 CREATE INDEX IF NOT EXISTS idx_peresdachi_fio ON peresdachi("ФИО");
+CREATE INDEX IF NOT EXISTS idx_peresdachi_email_key ON peresdachi(email_key);
+-- Выгрузка по дате добавления (см. migration_peresdachi_created_at_index.sql)
+CREATE INDEX IF NOT EXISTS idx_peresdachi_created_at ON peresdachi(created_at);
+
+-- Одна запись на (нормализованный email, дисциплина): повторы при записи пропускаются
+-- через ON CONFLICT DO NOTHING (см. migration_peresdachi_unique_key.sql)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_peresdachi_email_key_discipline
+ON peresdachi(email_key, "Наименование дисциплины");
 
 -- Добавление комментария к таблице
 COMMENT ON TABLE peresdachi IS 'Таблица для хранения данных о пересдачах внешней оценки';
@@ -18,7 +18,9 @@ CREATE TABLE public.registration_data (
     "ИсторияСдач" TEXT,
     "Отмена" TEXT,
     "Оценка" TEXT,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    -- Нормализованный email для поиска без учета регистра (см. migration_add_email_keys.sql)
+    email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED
 );
 
 -- Настройка RLS (Row Level Security) если требуется
@@ -36,3 +38,8 @@ CREATE POLICY "Allow all update operations" ON public.registration_data
 -- Создание индексов для быстрого поиска по email
 CREATE INDEX IF NOT EXISTS idx_registration_data_email 
 ON public.registration_data ("Адрес электронной почты");
+
+-- Ключевые запросы по email загрузки и соединение по (email, дисциплина)
+-- (см. migration_add_join_key_indexes.sql)
+CREATE INDEX IF NOT EXISTS idx_registration_data_email_key_discipline
+ON public.registration_data (email_key, "Наименование дисциплины");
@@ -0,0 +1,21 @@
+-- SQL скрипт для создания таблицы student_io в Supabase
+-- Выполните этот скрипт в SQL Editor в Supabase Dashboard
+--
+-- student_io — оценки, уже выставленные в ИО. При обработке внешнего измерения они имеют
+-- приоритет над peresdachi и файлом (поиск по ключу email + дисциплина).
+
+CREATE TABLE IF NOT EXISTS student_io (
+    id BIGSERIAL PRIMARY KEY,
+    "Адрес электронной почты" TEXT,
+    "Наименование дисциплины" TEXT,
+    "Оценка" TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    -- Нормализованный email для поиска без учета регистра (см. migration_add_email_keys.sql)
+    email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED
+);
+
+-- Ключевые запросы по email загрузки (in_ по email_key) и соединение по (email, дисциплина)
+CREATE INDEX IF NOT EXISTS idx_student_io_email_key_discipline
+ON student_io(email_key, "Наименование дисциплины");
+
+COMMENT ON TABLE student_io IS 'Оценки, выставленные в ИО: приоритетный источник оценок внешнего измерения';
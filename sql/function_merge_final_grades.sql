@@ -0,0 +1,113 @@
+-- Функция слияния оценок за проект в final_grades
+-- Выполните этот скрипт в SQL Editor в Supabase Dashboard
+-- после sql/migration_add_email_keys.sql (нужна колонка email_key).
+--
+-- Итоговая оценка = GREATEST(оценка за тест, новая оценка за проект, прежняя итоговая);
+-- пустые и нечисловые значения считаются нулем. Весь пакет записывается одним
+-- INSERT ... ON CONFLICT, без чтения существующих строк на стороне приложения.
+--
+-- Email пакета нормализуются (lower(btrim(...))), поэтому конфликт определяется по
+-- email_key — той же нормализации на стороне таблицы: запись, сохраненная в другом
+-- регистре или с пробелами, обновляется, а не дублируется. Для этого email_key
+-- делается уникальным; накопленные дубликаты по email_key сводятся к одной записи.
+--
+-- Вызов из приложения: supabase.rpc('merge_final_grades', {'payload': [
+--     {"email": "...", "fio": "...", "project_grade": 8}, ...
+-- ]})
+
+-- Оценка в числовом виде: значения в колонках могут храниться как текст
+CREATE OR REPLACE FUNCTION final_grade_value(value TEXT)
+RETURNS NUMERIC
+LANGUAGE sql
+IMMUTABLE
+AS $$
+    SELECT CASE
+        WHEN btrim(value) ~ '^-?[0-9]+([.,][0-9]+)?$' THEN replace(btrim(value), ',', '.')::NUMERIC
+    END
+$$;
+
+BEGIN;
+
+LOCK TABLE final_grades IN SHARE ROW EXCLUSIVE MODE;
+
+-- Дубликаты по email_key: остается запись, email которой уже нормализован (иначе первая
+-- по email), с наибольшими оценками группы; остальные удаляются
+WITH ranked AS (
+    SELECT "Адрес электронной почты" AS email,
+           email_key,
+           row_number() OVER (
+               PARTITION BY email_key
+               ORDER BY ("Адрес электронной почты" = email_key) DESC, "Адрес электронной почты"
+           ) AS position,
+           max(final_grade_value("Оценка за тест"::TEXT)) OVER (PARTITION BY email_key) AS test_grade,
+           max(final_grade_value("Оценка за проект"::TEXT)) OVER (PARTITION BY email_key) AS project_grade,
+           max(final_grade_value("Итоговая оценка"::TEXT)) OVER (PARTITION BY email_key) AS final_grade,
+           count(*) OVER (PARTITION BY email_key) AS duplicates
+    FROM final_grades
+    WHERE email_key IS NOT NULL
+),
+kept AS (
+    UPDATE final_grades AS fg
+    SET "Оценка за тест" = ranked.test_grade,
+        "Оценка за проект" = ranked.project_grade,
+        "Итоговая оценка" = ranked.final_grade
+    FROM ranked
+    WHERE fg."Адрес электронной почты" = ranked.email AND ranked.position = 1 AND ranked.duplicates > 1
+)
+DELETE FROM final_grades AS fg
+USING ranked
+WHERE fg."Адрес электронной почты" = ranked.email AND ranked.position > 1;
+
+-- Уникальный индекс заменяет обычный индекс по email_key из migration_add_email_keys.sql
+CREATE UNIQUE INDEX IF NOT EXISTS idx_final_grades_email_key_unique ON final_grades(email_key);
+DROP INDEX IF EXISTS idx_final_grades_email_key;
+
+COMMIT;
+
+CREATE OR REPLACE FUNCTION merge_final_grades(payload JSONB)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH incoming AS (
+        -- Повторы email в пакете сводятся к наибольшей оценке за проект:
+        -- ON CONFLICT не может обновить одну строку дважды в одном запросе
+        SELECT DISTINCT ON (email) email, fio, project_grade
+        FROM (
+            SELECT lower(btrim(p.email)) AS email,
+                   NULLIF(btrim(p.fio), '') AS fio,
+                   p.project_grade
+            FROM jsonb_to_recordset(payload) AS p(email TEXT, fio TEXT, project_grade NUMERIC)
+        ) AS normalized
+        WHERE email <> '' AND project_grade IS NOT NULL
+        ORDER BY email, project_grade DESC
+    ),
+    merged AS (
+        INSERT INTO final_grades AS fg (
+            "Адрес электронной почты", "ФИО", "Фамилия", "Имя", "Оценка за проект", "Итоговая оценка"
+        )
+        SELECT email,
+               fio,
+               NULLIF(split_part(regexp_replace(fio, '\s+', ' ', 'g'), ' ', 1), ''),
+               NULLIF(split_part(regexp_replace(fio, '\s+', ' ', 'g'), ' ', 2), ''),
+               project_grade,
+               GREATEST(project_grade, 0)
+        FROM incoming
+        -- Конфликт по нормализованному email: "A@Edu.hse.ru" в таблице совпадает с "a@edu.hse.ru" пакета
+        ON CONFLICT (email_key) DO UPDATE SET
+            -- ФИО существующей записи не меняется
+            "Оценка за проект" = EXCLUDED."Оценка за проект",
+            "Итоговая оценка" = GREATEST(
+                COALESCE(final_grade_value(fg."Оценка за тест"::TEXT), 0),
+                EXCLUDED."Оценка за проект"::TEXT::NUMERIC,
+                COALESCE(final_grade_value(fg."Итоговая оценка"::TEXT), 0)
+            )
+        RETURNING 1
+    )
+    SELECT count(*)::INTEGER FROM merged
+$$;
+
+COMMENT ON FUNCTION merge_final_grades(JSONB) IS
+    'Пакетное слияние оценок за проект в final_grades: итоговая оценка = GREATEST(тест, проект, прежняя итоговая)';
+
+-- Обновить схему PostgREST, чтобы функция была доступна через API
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,31 @@
+-- Миграция: нормализованные ключи email (email_key) с индексами
+-- Выполните этот скрипт в SQL Editor в Supabase Dashboard
+--
+-- email_key = lower(btrim(email)) вычисляется базой при каждой записи. Приложение
+-- читает email через эту колонку (уже в нижнем регистре и без пробелов) и фильтрует
+-- по ней in_(...), поэтому совпадение не зависит от регистра сохраненных адресов и
+-- идет по индексу, а не полным выкачиванием таблицы. Без этой миграции приложение
+-- работает как раньше и нормализует email на своей стороне.
+
+ALTER TABLE students
+ADD COLUMN IF NOT EXISTS email_key TEXT GENERATED ALWAYS AS (lower(btrim(корпоративная_почта))) STORED;
+CREATE INDEX IF NOT EXISTS idx_students_email_key ON students(email_key);
+
+ALTER TABLE peresdachi
+ADD COLUMN IF NOT EXISTS email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED;
+CREATE INDEX IF NOT EXISTS idx_peresdachi_email_key ON peresdachi(email_key);
+
+ALTER TABLE registration_data
+ADD COLUMN IF NOT EXISTS email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED;
+CREATE INDEX IF NOT EXISTS idx_registration_data_email_key ON registration_data(email_key);
+
+ALTER TABLE student_io
+ADD COLUMN IF NOT EXISTS email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED;
+CREATE INDEX IF NOT EXISTS idx_student_io_email_key ON student_io(email_key);
+
+ALTER TABLE final_grades
+ADD COLUMN IF NOT EXISTS email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED;
+CREATE INDEX IF NOT EXISTS idx_final_grades_email_key ON final_grades(email_key);
+
+-- Обновить схему PostgREST, чтобы новые колонки были доступны через API
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,20 @@
+-- Миграция: составные индексы (email_key, дисциплина) для справочных таблиц
+-- Выполните этот скрипт в SQL Editor в Supabase Dashboard
+-- после sql/migration_add_email_keys.sql (нужна колонка email_key).
+--
+-- Обработка внешнего измерения соединяет загрузку с registration_data и student_io
+-- по (email, дисциплина). Для небольших загрузок приложение читает из этих таблиц
+-- только строки email загрузки (фильтр in_ по email_key порциями) вместо полных таблиц;
+-- составной индекс обслуживает и такой фильтр (по первой колонке), и поиск по ключу целиком.
+-- Одноколоночные индексы по email_key после этого избыточны и удаляются.
+
+CREATE INDEX IF NOT EXISTS idx_registration_data_email_key_discipline
+ON registration_data(email_key, "Наименование дисциплины");
+DROP INDEX IF EXISTS idx_registration_data_email_key;
+
+CREATE INDEX IF NOT EXISTS idx_student_io_email_key_discipline
+ON student_io(email_key, "Наименование дисциплины");
+DROP INDEX IF EXISTS idx_student_io_email_key;
+
+ANALYZE registration_data;
+ANALYZE student_io;
@@ -0,0 +1,17 @@
+-- Миграция: индекс peresdachi по дате добавления (created_at)
+-- Выполните этот скрипт в SQL Editor в Supabase Dashboard
+--
+-- Выгрузка за период (load_peresdachi_by_date_range) читает страницы запросом
+-- created_at >= начало AND created_at < конец AND id > последний ORDER BY id LIMIT ...
+-- Без индекса каждая страница — последовательное чтение всей таблицы; с индексом
+-- читаются только строки диапазона. Выбран B-tree, а не BRIN: диапазоны выгрузок
+-- узкие (дни и недели), B-tree находит их точно и дает планировщику верную оценку
+-- числа строк, а выигрыш BRIN в размере заметен только на таблицах в десятки
+-- миллионов строк, которых у peresdachi нет.
+--
+-- На большой таблице можно создать индекс без блокировки записи:
+-- CREATE INDEX CONCURRENTLY (выполняется вне транзакции, отдельной командой).
+
+CREATE INDEX IF NOT EXISTS idx_peresdachi_created_at ON peresdachi(created_at);
+
+ANALYZE peresdachi;
@@ -0,0 +1,38 @@
+-- Миграция: уникальный ключ peresdachi по (нормализованный email, дисциплина)
+-- Выполните этот скрипт в SQL Editor в Supabase Dashboard
+-- после sql/migration_add_email_keys.sql (нужна колонка email_key).
+--
+-- Приложение пишет в peresdachi через INSERT ... ON CONFLICT (email_key, "Наименование дисциплины")
+-- DO NOTHING: повтор уже сохраненной записи отсекает индекс, а новыми считаются строки,
+-- которые вернула вставка. Без этой миграции приложение сравнивает загрузку с таблицей само.
+--
+-- Перед созданием индекса накопленные дубликаты сводятся к одной записи на ключ:
+-- остается самая ранняя (наименьший id) — та же, что приложение использовало как
+-- существующую оценку. Таблица блокируется на запись до конца транзакции, чтобы между
+-- чисткой и созданием индекса не появились новые дубликаты.
+
+BEGIN;
+
+LOCK TABLE peresdachi IN SHARE ROW EXCLUSIVE MODE;
+
+-- Приложение сравнивает дисциплины без пробелов по краям — так же хранятся и в ключе
+UPDATE peresdachi
+SET "Наименование дисциплины" = btrim("Наименование дисциплины")
+WHERE "Наименование дисциплины" <> btrim("Наименование дисциплины");
+
+DELETE FROM peresdachi AS p
+USING (
+    SELECT id,
+           row_number() OVER (PARTITION BY email_key, "Наименование дисциплины" ORDER BY id) AS position
+    FROM peresdachi
+    WHERE email_key IS NOT NULL AND "Наименование дисциплины" IS NOT NULL
+) AS ranked
+WHERE p.id = ranked.id AND ranked.position > 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_peresdachi_email_key_discipline
+ON peresdachi(email_key, "Наименование дисциплины");
+
+COMMIT;
+
+-- Обновить схему PostgREST, чтобы ON CONFLICT по новому индексу был доступен через API
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,119 @@
+-- Необязательная миграция: секционирование peresdachi по "Период аттестации" (LIST)
+-- Выполните этот скрипт в SQL Editor в Supabase Dashboard после
+-- migration_add_email_keys.sql и migration_peresdachi_unique_key.sql (дубликаты уже сведены).
+--
+-- Зачем: запросы и обслуживание по одному периоду (выгрузка, архивирование, удаление
+-- старого периода через DETACH/DROP PARTITION) затрагивают только его секцию.
+-- Выгрузка по created_at от секционирования не ускоряется — ее обслуживает
+-- индекс по created_at, который создается в каждой секции.
+--
+-- Ограничения:
+-- * Уникальный индекс секционированной таблицы обязан включать ключ секционирования,
+--   поэтому ключ становится (email_key, дисциплина, период). ON CONFLICT по
+--   (email_key, дисциплина) перестает быть доступен, и приложение определяет новые
+--   записи сравнением с таблицей на своей стороне, как до migration_peresdachi_unique_key.sql.
+-- * Первичный ключ невозможен: период может быть пустым. Для постраничной загрузки
+--   по id создается обычный индекс.
+-- * Новый период сначала попадает в секцию по умолчанию; отдельная секция для него
+--   создается вызовом SELECT create_peresdachi_period_partition('2025/2026 3 модуль');
+--
+-- Исходная таблица сохраняется как peresdachi_unpartitioned; после проверки ее можно
+-- удалить: DROP TABLE peresdachi_unpartitioned;
+
+BEGIN;
+
+LOCK TABLE peresdachi IN ACCESS EXCLUSIVE MODE;
+
+ALTER TABLE peresdachi RENAME TO peresdachi_unpartitioned;
+-- Последовательность id переходит к новой таблице
+ALTER SEQUENCE peresdachi_id_seq OWNED BY NONE;
+ALTER TABLE peresdachi_unpartitioned ALTER COLUMN id DROP DEFAULT;
+
+CREATE TABLE peresdachi (
+    id BIGINT NOT NULL DEFAULT nextval('peresdachi_id_seq'),
+    "ФИО" TEXT,
+    "Адрес электронной почты" TEXT,
+    "Кампус" TEXT,
+    "Факультет" TEXT,
+    "Образовательная программа" TEXT,
+    "Группа" TEXT,
+    "Курс" TEXT,
+    "ID дисциплины" TEXT,
+    "Наименование дисциплины" TEXT,
+    "Период аттестации" TEXT,
+    "Оценка" TEXT,
+    "Отмена" TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED
+) PARTITION BY LIST ("Период аттестации");
+
+ALTER SEQUENCE peresdachi_id_seq OWNED BY peresdachi.id;
+
+-- Строки без отдельной секции периода (в том числе с пустым периодом)
+CREATE TABLE peresdachi_default PARTITION OF peresdachi DEFAULT;
+
+-- Индексы создаются в каждой секции
+CREATE INDEX IF NOT EXISTS idx_peresdachi_part_id ON peresdachi(id);
+CREATE INDEX IF NOT EXISTS idx_peresdachi_part_created_at ON peresdachi(created_at);
+CREATE INDEX IF NOT EXISTS idx_peresdachi_part_email ON peresdachi("Адрес электронной почты");
+CREATE INDEX IF NOT EXISTS idx_peresdachi_part_discipline ON peresdachi("Наименование дисциплины");
+CREATE INDEX IF NOT EXISTS idx_peresdachi_part_fio ON peresdachi("ФИО");
+CREATE INDEX IF NOT EXISTS idx_peresdachi_part_email_key ON peresdachi(email_key);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_peresdachi_part_email_key_discipline_period
+ON peresdachi(email_key, "Наименование дисциплины", "Период аттестации");
+
+-- Отдельная секция для периода; строки периода из секции по умолчанию переносятся в нее
+CREATE OR REPLACE FUNCTION create_peresdachi_period_partition(period TEXT)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    partition_name TEXT := 'peresdachi_p_' || substr(md5(period), 1, 12);
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+
+    ALTER TABLE peresdachi DETACH PARTITION peresdachi_default;
+    EXECUTE format('CREATE TABLE %I PARTITION OF peresdachi FOR VALUES IN (%L)', partition_name, period);
+    WITH moved AS (
+        DELETE FROM peresdachi_default WHERE "Период аттестации" = period RETURNING *
+    )
+    INSERT INTO peresdachi (
+        id, "ФИО", "Адрес электронной почты", "Кампус", "Факультет", "Образовательная программа",
+        "Группа", "Курс", "ID дисциплины", "Наименование дисциплины", "Период аттестации",
+        "Оценка", "Отмена", created_at
+    )
+    SELECT id, "ФИО", "Адрес электронной почты", "Кампус", "Факультет", "Образовательная программа",
+           "Группа", "Курс", "ID дисциплины", "Наименование дисциплины", "Период аттестации",
+           "Оценка", "Отмена", created_at
+    FROM moved;
+    ALTER TABLE peresdachi ATTACH PARTITION peresdachi_default DEFAULT;
+    RETURN partition_name;
+END
+$$;
+
+-- Секции для периодов, которые уже есть в таблице
+SELECT create_peresdachi_period_partition(period)
+FROM (
+    SELECT DISTINCT "Период аттестации" AS period
+    FROM peresdachi_unpartitioned
+    WHERE "Период аттестации" IS NOT NULL
+) AS periods;
+
+INSERT INTO peresdachi (
+    id, "ФИО", "Адрес электронной почты", "Кампус", "Факультет", "Образовательная программа",
+    "Группа", "Курс", "ID дисциплины", "Наименование дисциплины", "Период аттестации",
+    "Оценка", "Отмена", created_at
+)
+SELECT id, "ФИО", "Адрес электронной почты", "Кампус", "Факультет", "Образовательная программа",
+       "Группа", "Курс", "ID дисциплины", "Наименование дисциплины", "Период аттестации",
+       "Оценка", "Отмена", created_at
+FROM peresdachi_unpartitioned;
+
+COMMIT;
+
+ANALYZE peresdachi;
+
+-- Обновить схему PostgREST: таблица peresdachi пересоздана
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,16 @@
+"""
+Общие фикстуры тестов
+"""
+import pytest
+import utils
+
+
+@pytest.fixture(autouse=True)
+def shared_thread_client(monkeypatch):
+    """
+    Потоки map_concurrently получают тот же клиент, что и get_supabase_client.
+
+    Тесты подменяют get_supabase_client фейковым клиентом с таблицами в памяти;
+    без этой подмены потоки создавали бы настоящие клиенты из secrets.
+    """
+    monkeypatch.setattr(utils, 'create_supabase_client', lambda: utils.get_supabase_client())
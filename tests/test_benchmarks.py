@@ -0,0 +1,56 @@
+"""
+Тесты для benchmarks/run.py
+"""
+import json
+
+import pytest
+from benchmarks import pagination
+from benchmarks.run import CASES, compare_results, main, parse_size, run_benchmarks
+
+
+@pytest.mark.parametrize('value,expected', [('500', 500), ('1k', 1_000), ('10K', 10_000), ('1m', 1_000_000), ('2.5k', 2_500)])
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+def test_all_cases_run_on_small_sizes():
+    report = run_benchmarks([200], repeat=1, log=lambda _: None)
+    assert set(report['results']) == {f'{name}@200' for name in CASES}
+    for entry in report['results'].values():
+        assert entry['seconds'] >= 0
+        assert entry['peak_mb'] > 0
+    for entry in report['memory'].values():
+        assert entry['after_mb'] <= entry['before_mb']
+
+
+def test_unknown_case_rejected():
+    with pytest.raises(ValueError, match="Неизвестные сценарии"):
+        run_benchmarks([100], cases=['missing'], log=lambda _: None)
+
+
+def _report(seconds, peak_mb):
+    return {'meta': {}, 'results': {'case@1k': {'seconds': seconds, 'peak_mb': peak_mb, 'rows': 1000}}}
+
+
+def test_compare_flags_regressions():
+    comparison = compare_results(_report(1.0, 10.0), _report(1.1, 10.0), threshold=0.2)
+    assert not comparison['Регрессия'].any()
+
+    comparison = compare_results(_report(1.0, 10.0), _report(1.0, 13.0), threshold=0.2)
+    assert comparison['Регрессия'].all()
+
+
+def test_compare_exit_code(tmp_path):
+    baseline, current = tmp_path / 'baseline.json', tmp_path / 'current.json'
+    baseline.write_text(json.dumps(_report(1.0, 10.0)), encoding='utf-8')
+    current.write_text(json.dumps(_report(2.0, 10.0)), encoding='utf-8')
+
+    assert main(['compare', str(baseline), str(baseline)]) == 0
+    assert main(['compare', str(baseline), str(current)]) == 1
+
+
+def test_pagination_benchmark_requires_local_database(monkeypatch):
+    monkeypatch.delenv(pagination.ENV_URL, raising=False)
+    monkeypatch.delenv(pagination.ENV_KEY, raising=False)
+
+    assert pagination.main(['--rows', '1k']) == 2
@@ -1,5 +1,9 @@
+import numpy as np
 import pandas as pd
-from logic.data_utils import clean_email_column, clean_string_column, filter_valid_grades
+from logic.data_utils import (
+    clean_email_column, clean_string_column, filter_valid_grades,
+    compact_dtypes, coalesce_columns, fill_missing, to_small_numeric
+)
 
 def test_clean_email_column():
     df = pd.DataFrame({
@@ -23,3 +27,38 @@ def test_filter_valid_grades():
     # Should keep '5' and ' 8 '
     # Actually filter_valid_grades removes NaN, empty string, and "nan"
     assert filtered_df['grade'].tolist() == ['5', ' 8 ']
+
+def test_compact_dtypes_converts_repeated_strings_only():
+    df = pd.DataFrame({
+        'Курс': ['Курс 2', 'Курс 3'] * 50,
+        'Группа': [f'Б24-{i:02d}' for i in range(100)],
+        'Адрес электронной почты': [f's{i}@edu.hse.ru' for i in range(100)],
+    })
+    compact_dtypes(df)
+    assert isinstance(df['Курс'].dtype, pd.CategoricalDtype)
+    # Все значения уникальны — category не дает выигрыша
+    assert df['Группа'].dtype == object
+    assert df['Адрес электронной почты'].dtype == object
+
+def test_to_small_numeric():
+    assert to_small_numeric(pd.Series(['5', '10', '0'])).dtype == np.int8
+    result = to_small_numeric(pd.Series(['7.5', None, 'abc']))
+    assert result.dtype == np.float32
+    assert result.iloc[0] == 7.5 and result.iloc[1:].isna().all()
+
+def test_clean_string_column_keeps_category():
+    df = pd.DataFrame({'name': pd.Series([' a', 'a ', None, 'b'], dtype='category')})
+    cleaned = clean_string_column(df, 'name')
+    assert isinstance(cleaned['name'].dtype, pd.CategoricalDtype)
+    assert cleaned['name'].tolist() == ['a', 'a', 'nan', 'b']
+
+def test_fill_missing_on_category():
+    series = pd.Series(['x', None], dtype='category')
+    assert fill_missing(series, '').tolist() == ['x', '']
+
+def test_coalesce_columns_with_categories():
+    primary = pd.Series(['7', None, None], dtype='category')
+    fallback = pd.Series(['1', '2', None])
+    result = coalesce_columns(primary, fallback)
+    assert result.iloc[:2].tolist() == ['7', '2']
+    assert pd.isna(result.iloc[2])
@@ -0,0 +1,72 @@
+"""
+Тесты для logic/export.py
+"""
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from logic import export
+from logic.export import dataframe_to_bytes, export_dataframe, write_chunks
+
+
+@pytest.fixture
+def sample_df():
+    return pd.DataFrame({
+        'ФИО': ['Иванов Иван', 'Петров Петр', 'Сидоров Сидор'],
+        'Оценка': [8.0, np.nan, 5.0],
+        'Курс': [2, 3, 4],
+    })
+
+
+@pytest.mark.parametrize('fmt', ['xlsx', 'csv', 'parquet'])
+def test_round_trip(sample_df, fmt):
+    content = dataframe_to_bytes(sample_df, fmt)
+    if fmt == 'xlsx':
+        result = pd.read_excel(io.BytesIO(content))
+    elif fmt == 'csv':
+        result = pd.read_csv(io.BytesIO(content), encoding='utf-8-sig')
+    else:
+        result = pd.read_parquet(io.BytesIO(content))
+    pd.testing.assert_frame_equal(result, sample_df, check_dtype=False)
+
+
+def test_csv_separator_and_bom(sample_df):
+    content = dataframe_to_bytes(sample_df, 'csv', sep=';')
+    assert content.startswith('﻿'.encode('utf-8'))
+    assert content.decode('utf-8-sig').splitlines()[0] == 'ФИО;Оценка;Курс'
+
+
+def test_xlsx_sheet_name(sample_df):
+    content = dataframe_to_bytes(sample_df, 'xlsx', sheet_name='Students')
+    assert list(pd.read_excel(io.BytesIO(content), sheet_name=None)) == ['Students']
+
+
+def test_xlsx_empty_frame_keeps_header():
+    content = dataframe_to_bytes(pd.DataFrame(columns=['a', 'b']), 'xlsx')
+    assert list(pd.read_excel(io.BytesIO(content)).columns) == ['a', 'b']
+
+
+def test_xlsx_rolls_over_to_new_sheet(monkeypatch):
+    monkeypatch.setattr(export, 'XLSX_MAX_ROWS', 4)
+    df = pd.DataFrame({'x': range(7)})
+    sink = io.BytesIO()
+    assert write_chunks([df.iloc[:5], df.iloc[5:]], sink, 'xlsx', sheet_name='Данные') == 7
+
+    sheets = pd.read_excel(io.BytesIO(sink.getvalue()), sheet_name=None)
+    assert list(sheets) == ['Данные', 'Данные_2', 'Данные_3']
+    assert pd.concat(sheets.values())['x'].tolist() == list(range(7))
+
+
+def test_unsupported_format_raises(sample_df):
+    with pytest.raises(ValueError, match="Неподдерживаемый формат экспорта"):
+        dataframe_to_bytes(sample_df, 'json')
+
+
+def test_export_dataframe_returns_stream_without_leftover_file(sample_df):
+    with export_dataframe(sample_df, 'xlsx') as stream:
+        assert isinstance(stream, io.BufferedReader)
+        assert not os.path.exists(stream.name)
+        result = pd.read_excel(stream)
+    pd.testing.assert_frame_equal(result, sample_df, check_dtype=False)
@@ -0,0 +1,1117 @@
+"""
+Тесты для logic/external_assessment.py
+"""
+import json
+import os
+import threading
+from datetime import date
+
+import pandas as pd
+import pytest
+import constants
+import utils
+from benchmarks.fake_supabase import FakeQuery, FakeSupabaseClient, email_key, merge_final_grades_handler
+from logic import external_assessment
+from logic.data_utils import compact_dtypes
+
+STUDENTS = pd.DataFrame({
+    constants.COL_EMAIL: ['a@edu.hse.ru', 'b@edu.hse.ru', 'c@edu.hse.ru'],
+    constants.COL_FIO: ['Иванов Иван', 'Петров Петр', 'Сидоров Сидор'],
+    constants.COL_CAMPUS_OLD: ['Москва', 'Москва', 'Пермь'],
+    constants.COL_FACULTY: ['ФКН', 'ФКН', 'ФЭН'],
+    constants.COL_PROGRAM: ['ПИ', 'ПИ', 'Экономика'],
+    constants.COL_GROUP: ['Б24-01', 'Б24-01', 'Б24-02'],
+    constants.COL_COURSE: ['Курс 2', 'Курс 2', 'Курс 3'],
+})
+
+REGISTRATION = pd.DataFrame({
+    'id': [1, 2, 3],
+    constants.COL_EMAIL: ['a@edu.hse.ru', 'a@edu.hse.ru', 'b@edu.hse.ru'],
+    constants.COL_DISCIPLINE: [constants.DISCIPLINE_INPUT, constants.DISCIPLINE_FINAL, constants.DISCIPLINE_INPUT],
+    constants.COL_CAMPUS: ['Москва', 'Москва', None],
+    constants.COL_PERIOD: ['2025/2026 2 модуль', '2025/2026 2 модуль', None],
+    constants.COL_ID_DISCIPLINE: ['101', '103', None],
+    constants.COL_FIO: ['Иванов Иван', 'Иванов Иван', 'Петров Петр'],
+    constants.COL_FACULTY: ['ФКН', 'ФКН', 'ФКН'],
+    constants.COL_PROGRAM: ['ПИ', 'ПИ', 'ПИ'],
+    constants.COL_GROUP: ['Б24-01', 'Б24-01', 'Б24-01'],
+    constants.COL_COURSE: ['Курс 2', 'Курс 2', 'Курс 2'],
+    constants.COL_CANCEL: [None, None, None],
+})
+
+STUDENT_IO = pd.DataFrame({
+    constants.COL_EMAIL: ['a@edu.hse.ru'],
+    constants.COL_DISCIPLINE: [constants.DISCIPLINE_INPUT],
+    constants.COL_GRADE: ['9'],
+})
+
+PERESDACHI = pd.DataFrame({
+    'id': [1],
+    constants.COL_EMAIL: [' B@EDU.HSE.RU '],
+    constants.COL_DISCIPLINE: [constants.DISCIPLINE_INPUT],
+    constants.COL_GRADE: ['6'],
+})
+
+TEST_GRADES = pd.DataFrame({
+    constants.COL_EMAIL: ['A@edu.hse.ru', 'b@edu.hse.ru', 'c@edu.hse.ru'],
+    constants.TEST_COL_INPUT: ['5', '4', '-'],
+    constants.TEST_COL_MID: ['-', '7', '8'],
+    constants.TEST_COL_FINAL: ['3', '-', '-'],
+})
+
+PROJECT_GRADES = pd.DataFrame({
+    constants.COL_EMAIL: ['a@edu.hse.ru', 'b@edu.hse.ru', 'c@edu.hse.ru'],
+    constants.PROJECT_COL_HUMANITIES: ['8', '-', '-'],
+    constants.PROJECT_COL_NATURAL: ['-', '6', '-'],
+})
+
+
+def make_reference_client(email_keys=False):
+    tables = {
+        constants.DB_TABLE_REGISTRATION_DATA: REGISTRATION,
+        constants.DB_TABLE_STUDENT_IO: STUDENT_IO,
+        constants.DB_TABLE_PERESDACHI: PERESDACHI,
+    }
+    generated = {table: {constants.EMAIL_KEY_COLUMN: email_key(constants.COL_EMAIL)} for table in tables}
+    return FakeSupabaseClient(tables, generated=generated if email_keys else None)
+
+
+def patch_reference_tables(mocker, compact, email_keys=False):
+    client = make_reference_client(email_keys)
+    mocker.patch.object(external_assessment, 'get_supabase_client', return_value=client)
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+    if not compact:
+        mocker.patch.object(external_assessment, 'compact_dtypes', side_effect=lambda df, *args, **kwargs: df)
+    return client
+
+
+def as_text(df):
+    return df.astype(object).where(df.notna(), None).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('process,grades', [
+    (external_assessment.process_external_assessment, TEST_GRADES),
+    (external_assessment.process_project_assessment, PROJECT_GRADES),
+])
+def test_compact_reference_tables_give_same_result(mocker, process, grades):
+    patch_reference_tables(mocker, compact=False)
+    expected, _ = process(grades.copy(), STUDENTS.copy())
+
+    mocker.stopall()
+    patch_reference_tables(mocker, compact=True)
+    result, _ = process(grades.copy(), compact_dtypes(STUDENTS.copy(), max_unique_ratio=1.0))
+
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(as_text(result), as_text(expected))
+
+
+def test_grade_priority_student_io_then_peresdachi(mocker):
+    patch_reference_tables(mocker, compact=True)
+    result, _ = external_assessment.process_external_assessment(TEST_GRADES.copy(), STUDENTS.copy())
+    grades = result.set_index([constants.COL_EMAIL, constants.COL_DISCIPLINE])[constants.COL_GRADE].astype(str)
+
+    assert grades[('a@edu.hse.ru', constants.DISCIPLINE_INPUT)] == '9'
+    assert grades[('b@edu.hse.ru', constants.DISCIPLINE_INPUT)] == '6'
+    assert grades[('c@edu.hse.ru', constants.DISCIPLINE_MID)] == '8'
+
+
+@pytest.mark.parametrize('process,grades', [
+    (external_assessment.process_external_assessment, TEST_GRADES),
+    (external_assessment.process_project_assessment, PROJECT_GRADES),
+])
+def test_email_key_columns_give_same_result(mocker, process, grades):
+    patch_reference_tables(mocker, compact=True)
+    expected, _ = process(grades.copy(), STUDENTS.copy())
+
+    mocker.stopall()
+    client = patch_reference_tables(mocker, compact=True, email_keys=True)
+    result, _ = process(grades.copy(), STUDENTS.copy())
+
+    pd.testing.assert_frame_equal(as_text(result), as_text(expected))
+    # Email нормализует БД: ни одного запроса с откатом на исходную колонку
+    assert len(client.requests) == 3
+
+
+# =====================================================================
+# Новые записи: проверка ключей на стороне БД
+# =====================================================================
+
+def make_client(existing_rows, email_keys=True):
+    peresdachi = pd.DataFrame(existing_rows, columns=[constants.COL_EMAIL, constants.COL_DISCIPLINE, constants.COL_GRADE])
+    peresdachi.insert(0, 'id', range(1, len(peresdachi) + 1))
+    generated = {constants.DB_TABLE_PERESDACHI: {constants.EMAIL_KEY_COLUMN: email_key(constants.COL_EMAIL)}}
+    return FakeSupabaseClient({constants.DB_TABLE_PERESDACHI: peresdachi}, generated=generated if email_keys else None)
+
+
+def test_new_records_anti_join(mocker):
+    client = make_client([
+        ('a@edu.hse.ru', constants.DISCIPLINE_INPUT, '5'),
+        ('z@edu.hse.ru', constants.DISCIPLINE_INPUT, '7'),
+    ])
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+    upload = pd.DataFrame({
+        constants.COL_EMAIL: ['a@edu.hse.ru', 'a@edu.hse.ru', 'b@edu.hse.ru'],
+        constants.COL_DISCIPLINE: [constants.DISCIPLINE_INPUT, constants.DISCIPLINE_FINAL, constants.DISCIPLINE_INPUT],
+        constants.COL_GRADE: ['8', '6', '4'],
+    })
+
+    result = external_assessment.get_new_records_from_dataframe(upload)
+
+    assert list(result.columns) == list(upload.columns)
+    assert list(zip(result[constants.COL_EMAIL], result[constants.COL_DISCIPLINE])) == [
+        ('a@edu.hse.ru', constants.DISCIPLINE_FINAL), ('b@edu.hse.ru', constants.DISCIPLINE_INPUT)
+    ]
+
+
+def test_key_probe_requests_only_upload_keys(mocker):
+    client = make_client([(f's{i}@edu.hse.ru', constants.DISCIPLINE_INPUT, '5') for i in range(5000)])
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+    emails = [f's{i}@edu.hse.ru' for i in range(0, 500, 2)]
+
+    keys = external_assessment.load_existing_keys(emails, chunk_size=100)
+
+    assert list(keys.columns) == [constants.COL_EMAIL, constants.COL_DISCIPLINE]
+    assert sorted(keys[constants.COL_EMAIL]) == sorted(emails)
+    # 250 email порциями по 100 — три запроса, независимо от размера таблицы
+    assert len(client.requests) == 3
+
+
+def test_key_probe_matches_stored_email_case_and_spaces(mocker):
+    client = make_client([(' A@EDU.hse.ru ', constants.DISCIPLINE_INPUT, '5'), ('b@edu.hse.ru', constants.DISCIPLINE_INPUT, '4')])
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+    upload = pd.DataFrame({
+        constants.COL_EMAIL: ['a@edu.hse.ru', 'c@edu.hse.ru'],
+        constants.COL_DISCIPLINE: [constants.DISCIPLINE_INPUT, constants.DISCIPLINE_INPUT],
+    })
+
+    result = external_assessment.get_new_records_from_dataframe(upload)
+
+    assert result[constants.COL_EMAIL].tolist() == ['c@edu.hse.ru']
+
+
+def test_key_probe_ignores_discipline_spaces(mocker):
+    client = make_client([('a@edu.hse.ru', constants.DISCIPLINE_INPUT, '5'), ('b@edu.hse.ru', constants.DISCIPLINE_MID, '4')])
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+    upload = pd.DataFrame({
+        constants.COL_EMAIL: ['a@edu.hse.ru', 'b@edu.hse.ru', 'c@edu.hse.ru'],
+        constants.COL_DISCIPLINE: [f'{constants.DISCIPLINE_INPUT}  ', f' {constants.DISCIPLINE_MID}', constants.DISCIPLINE_INPUT],
+    })
+
+    keys = external_assessment.load_existing_keys(['b@edu.hse.ru'], disciplines=[f' {constants.DISCIPLINE_MID} '])
+    result = external_assessment.get_new_records_from_dataframe(upload)
+
+    # Фильтр по дисциплине без пробелов находит сохраненную запись
+    assert keys[constants.COL_DISCIPLINE].tolist() == [constants.DISCIPLINE_MID]
+    # Дисциплина с пробелами в загрузке совпадает с сохраненной и не считается новой
+    assert result[constants.COL_EMAIL].tolist() == ['c@edu.hse.ru']
+
+
+def test_key_probe_without_email_key_column(mocker):
+    client = make_client([(f'S{i}@edu.hse.ru', constants.DISCIPLINE_INPUT, '5') for i in range(500)], email_keys=False)
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+    emails = [f's{i}@edu.hse.ru' for i in range(0, 500, 2)]
+    stored = [f'S{i}@edu.hse.ru' for i in range(0, 500, 2)]
+
+    keys = external_assessment.load_existing_keys(stored, chunk_size=100)
+
+    # Без миграции: фильтр по исходной колонке, email нормализуются на клиенте,
+    # а отсутствие email_key выясняется один раз
+    assert sorted(keys[constants.COL_EMAIL]) == sorted(emails)
+    assert len(client.requests) == 3
+
+
+# =====================================================================
+# Снимок справочных таблиц
+# =====================================================================
+
+def requests_by_table(client):
+    counts = {}
+    for table, operation, _ in client.requests:
+        counts[(table, operation)] = counts.get((table, operation), 0) + 1
+    return counts
+
+
+def test_run_fetches_each_table_once(mocker):
+    client = patch_reference_tables(mocker, compact=True, email_keys=True)
+    client.unique[constants.DB_TABLE_PERESDACHI] = constants.PERESDACHI_UNIQUE_KEY
+    snapshot = external_assessment.ReferenceSnapshot()
+
+    result, _ = external_assessment.process_external_assessment(TEST_GRADES.copy(), STUDENTS.copy(), snapshot=snapshot)
+    split = external_assessment.deduplicate_and_save(result, snapshot=snapshot)
+
+    assert split['save_success'] and split['save_stats']['inserted'] == split['new_count'] > 0
+    assert requests_by_table(client) == {
+        (constants.DB_TABLE_REGISTRATION_DATA, 'select'): 1,
+        (constants.DB_TABLE_STUDENT_IO, 'select'): 1,
+        (constants.DB_TABLE_PERESDACHI, 'select'): 1,
+        (constants.DB_TABLE_PERESDACHI, 'upsert'): 1,
+    }
+    # Сохраненные записи попали в снимок: повторная проверка не находит новых и не обращается к БД
+    assert external_assessment.get_new_records_from_dataframe(split['result_df'], snapshot=snapshot).empty
+    assert len(client.requests) == 4
+
+
+def test_preload_overlaps_reference_loads(mocker):
+    client = patch_reference_tables(mocker, compact=True)
+    client.latency = 0.05
+    active, peak = [], []
+    execute = client._execute
+
+    def tracking_execute(query):
+        active.append(query.table_name)
+        peak.append(len(active))
+        try:
+            return execute(query)
+        finally:
+            active.remove(query.table_name)
+
+    mocker.patch.object(client, '_execute', side_effect=tracking_execute)
+
+    snapshot = external_assessment.ReferenceSnapshot().preload()
+
+    assert max(peak) == 3
+    assert not snapshot.registration.empty and not snapshot.student_io.empty and not snapshot.peresdachi.empty
+    # Повторный доступ не обращается к БД
+    assert len(client.requests) == 3
+
+
+def test_preload_failure_is_retried_by_processing_step(mocker):
+    patch_reference_tables(mocker, compact=True)
+    load_student_io = external_assessment.load_student_io_from_supabase
+    load = mocker.patch.object(external_assessment, 'load_student_io_from_supabase',
+                               side_effect=[ConnectionError('timeout'), load_student_io()])
+    snapshot = external_assessment.ReferenceSnapshot()
+
+    snapshot.preload()
+    result, _ = external_assessment.process_external_assessment(TEST_GRADES.copy(), STUDENTS.copy(), snapshot=snapshot)
+
+    # Ошибка предзагрузки не прерывает запуск: шаг student_io загружает таблицу заново
+    assert load.call_count == 2
+    assert not snapshot.student_io.empty
+    assert not result.empty
+
+
+def test_access_during_prefetch_waits_for_background_load(mocker):
+    patch_reference_tables(mocker, compact=True)
+    started, release = threading.Event(), threading.Event()
+    load_student_io = external_assessment.load_student_io_from_supabase
+
+    def slow_load(emails=None):
+        started.set()
+        release.wait(5)
+        return load_student_io(emails)
+
+    load = mocker.patch.object(external_assessment, 'load_student_io_from_supabase', side_effect=slow_load)
+    snapshot = external_assessment.ReferenceSnapshot().prefetch([constants.DB_TABLE_STUDENT_IO])
+    assert started.wait(5)
+
+    threading.Timer(0.05, release.set).start()
+    student_io = snapshot.student_io
+
+    assert not student_io.empty
+    assert load.call_count == 1
+
+
+def test_failed_prefetch_is_loaded_on_access(mocker):
+    patch_reference_tables(mocker, compact=True)
+    load_student_io = external_assessment.load_student_io_from_supabase
+    load = mocker.patch.object(external_assessment, 'load_student_io_from_supabase',
+                               side_effect=[ConnectionError('timeout'), load_student_io()])
+    snapshot = external_assessment.ReferenceSnapshot()
+    utils.run_in_background(snapshot.preload, [constants.DB_TABLE_STUDENT_IO]).result()
+
+    assert not snapshot.student_io.empty and load.call_count == 2
+
+
+def test_snapshot_loads_only_needed_registration_columns(mocker):
+    client = patch_reference_tables(mocker, compact=True)
+    client.tables[constants.DB_TABLE_REGISTRATION_DATA]['ИсторияСдач'] = 'много текста'
+
+    registration = external_assessment.ReferenceSnapshot().registration
+
+    assert 'ИсторияСдач' not in registration.columns
+    assert set(registration.columns) <= set(constants.REGISTRATION_COLUMNS)
+
+
+def add_other_students(client, n):
+    """Строки registration_data для n студентов, которых нет в загрузке."""
+    registration = client.tables[constants.DB_TABLE_REGISTRATION_DATA]
+    others = pd.DataFrame({
+        'id': range(100, 100 + n),
+        constants.COL_EMAIL: [f'other{i}@edu.hse.ru' for i in range(n)],
+        constants.COL_DISCIPLINE: [constants.DISCIPLINE_INPUT] * n,
+    })
+    client.tables[constants.DB_TABLE_REGISTRATION_DATA] = client._with_generated(
+        constants.DB_TABLE_REGISTRATION_DATA, pd.concat([registration, others], ignore_index=True)
+    )
+
+
+def fetched_rows(client, table):
+    return sum(rows for name, op, rows in client.requests if name == table and op == 'select')
+
+
+@pytest.mark.parametrize('process,grades', [
+    (external_assessment.process_external_assessment, TEST_GRADES),
+    (external_assessment.process_project_assessment, PROJECT_GRADES),
+])
+def test_scoped_snapshot_reads_only_upload_rows(mocker, process, grades):
+    client = patch_reference_tables(mocker, compact=True, email_keys=True)
+    add_other_students(client, 3000)
+    expected, _ = process(grades.copy(), STUDENTS.copy(), snapshot=external_assessment.ReferenceSnapshot().preload())
+    client.requests.clear()
+
+    snapshot = external_assessment.ReferenceSnapshot()
+    result, _ = process(grades.copy(), STUDENTS.copy(), snapshot=snapshot)
+
+    pd.testing.assert_frame_equal(as_text(result), as_text(expected))
+    assert snapshot.scoped_emails == ['a@edu.hse.ru', 'b@edu.hse.ru', 'c@edu.hse.ru']
+    assert fetched_rows(client, constants.DB_TABLE_REGISTRATION_DATA) == 3
+    # Один ключевой запрос на таблицу
+    assert len(client.requests) == 3
+
+
+def test_scoped_snapshot_reads_whole_tables_without_email_key(mocker):
+    client = patch_reference_tables(mocker, compact=True)
+    client.tables[constants.DB_TABLE_STUDENT_IO][constants.COL_EMAIL] = [' A@EDU.hse.ru']
+
+    result, _ = external_assessment.process_external_assessment(TEST_GRADES.copy(), STUDENTS.copy())
+    grades = result.set_index([constants.COL_EMAIL, constants.COL_DISCIPLINE])[constants.COL_GRADE].astype(str)
+
+    # Фильтр по исходной колонке не нашел бы email в другом регистре — таблица читается целиком
+    assert grades[('a@edu.hse.ru', constants.DISCIPLINE_INPUT)] == '9'
+
+
+def test_large_upload_reads_whole_tables(mocker, monkeypatch):
+    client = patch_reference_tables(mocker, compact=True, email_keys=True)
+    monkeypatch.setattr(constants, 'REFERENCE_PROBE_MAX_EMAILS', 2)
+    snapshot = external_assessment.ReferenceSnapshot()
+
+    external_assessment.process_external_assessment(TEST_GRADES.copy(), STUDENTS.copy(), snapshot=snapshot)
+
+    assert snapshot.scoped_emails is None
+    assert fetched_rows(client, constants.DB_TABLE_REGISTRATION_DATA) == len(REGISTRATION)
+
+
+def test_scope_extension_reloads_scoped_tables(mocker):
+    patch_reference_tables(mocker, compact=True, email_keys=True)
+    snapshot = external_assessment.ReferenceSnapshot().scope(['b@edu.hse.ru'])
+    assert snapshot.registration[constants.COL_EMAIL].tolist() == ['b@edu.hse.ru']
+
+    snapshot.scope(['b@edu.hse.ru'])
+    assert snapshot.registration[constants.COL_EMAIL].tolist() == ['b@edu.hse.ru']
+    snapshot.scope(['a@edu.hse.ru'])
+
+    assert sorted(snapshot.registration[constants.COL_EMAIL].astype(str)) == ['a@edu.hse.ru', 'a@edu.hse.ru', 'b@edu.hse.ru']
+    # Снимок, загруженный целиком, не ограничивается
+    full = external_assessment.ReferenceSnapshot()
+    full.registration
+    assert full.scope(['a@edu.hse.ru']).scoped_emails is None
+
+
+@pytest.mark.parametrize('process,grades,project', [
+    (external_assessment.process_external_assessment, TEST_GRADES, False),
+    (external_assessment.process_project_assessment, PROJECT_GRADES, True),
+])
+def test_upload_emails_match_processing_scope(mocker, process, grades, project):
+    patch_reference_tables(mocker, compact=True, email_keys=True)
+    grades = pd.concat([grades, grades.head(1).assign(**{constants.COL_EMAIL: ' D-1@Edu.hse.ru '})], ignore_index=True)
+    snapshot = external_assessment.ReferenceSnapshot().scope(external_assessment.upload_emails(grades, project=project))
+    emails = snapshot.scoped_emails
+
+    process(grades.copy(), STUDENTS.copy(), snapshot=snapshot)
+
+    # Область, заданная до обработки, не расширяется обработкой
+    assert snapshot.scoped_emails == emails
+
+
+def test_final_grades_lookup_uses_projection(mocker):
+    final_grades = pd.DataFrame({
+        constants.COL_EMAIL: ['a@edu.hse.ru'],
+        constants.COL_FIO: ['Иванов Иван'],
+        constants.COL_FINAL_TEST_GRADE: ['9'],
+        constants.COL_FINAL_PROJECT_GRADE: [None],
+        constants.COL_FINAL_GRADE: ['9'],
+        'Комментарий': ['длинный текст'],
+    })
+    client = FakeSupabaseClient({constants.DB_TABLE_FINAL_GRADES: final_grades})
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+    select = mocker.spy(FakeQuery, 'select')
+
+    success, count, _ = external_assessment.update_final_grades(pd.DataFrame({
+        constants.COL_EMAIL: ['a@edu.hse.ru', 'b@edu.hse.ru'],
+        constants.COL_FIO: ['Иванов Иван', 'Петров Петр'],
+        constants.COL_GRADE: ['7', '8'],
+    }))
+
+    assert success and count == 2
+    assert select.call_args.args[1] == ", ".join(f'"{col}"' for col in constants.FINAL_GRADES_LOOKUP_COLUMNS)
+    saved = client.tables[constants.DB_TABLE_FINAL_GRADES].set_index(constants.COL_EMAIL)
+    assert saved.loc['a@edu.hse.ru', constants.COL_FINAL_GRADE] == 9.0
+    assert saved.loc['b@edu.hse.ru', constants.COL_FINAL_GRADE] == 8.0
+    assert saved.loc['a@edu.hse.ru', 'Комментарий'] == 'длинный текст'
+    # У существующей записи ФИО не затирается, новая получает фамилию и имя
+    assert saved.loc['a@edu.hse.ru', constants.COL_FIO] == 'Иванов Иван'
+    assert (saved.loc['b@edu.hse.ru', 'Фамилия'], saved.loc['b@edu.hse.ru', 'Имя']) == ('Петров', 'Петр')
+
+
+# =====================================================================
+# Пакетная запись в peresdachi
+# =====================================================================
+
+class NoConstraintClient(FakeSupabaseClient):
+    """Таблица без уникального ограничения по (email, дисциплина): upsert с on_conflict недоступен."""
+
+    def _execute(self, query):
+        if query.operation == 'upsert':
+            raise Exception("42P10: there is no unique or exclusion constraint matching the ON CONFLICT specification")
+        return super()._execute(query)
+
+
+class FailingBatchClient(FakeSupabaseClient):
+    """Клиент, у которого запись пакета с заданным первым email падает failures раз."""
+
+    def __init__(self, tables, failing_email, failures, **kwargs):
+        super().__init__(tables, **kwargs)
+        self.failing_email = failing_email
+        self.failures = failures
+
+    def _execute(self, query):
+        if query.operation != 'select' and query.payload[0][constants.COL_EMAIL] == self.failing_email and self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('connection reset')
+        return super()._execute(query)
+
+
+def make_upload(n, start=0):
+    return pd.DataFrame({
+        constants.COL_EMAIL: [f's{i}@edu.hse.ru' for i in range(start, start + n)],
+        constants.COL_DISCIPLINE: [constants.DISCIPLINE_INPUT] * n,
+        constants.COL_GRADE: ['7'] * n,
+        'Служебная колонка': ['x'] * n,
+    })
+
+
+def peresdachi_table(n):
+    df = make_upload(n).drop(columns=['Служебная колонка'])
+    df.insert(0, 'id', range(1, n + 1))
+    return df
+
+
+def peresdachi_client(rows, client_class=FakeSupabaseClient, **kwargs):
+    """peresdachi после миграций: колонка email_key и уникальный индекс (email_key, дисциплина)."""
+    return client_class(
+        {constants.DB_TABLE_PERESDACHI: rows},
+        generated={constants.DB_TABLE_PERESDACHI: {constants.EMAIL_KEY_COLUMN: email_key(constants.COL_EMAIL)}},
+        unique={constants.DB_TABLE_PERESDACHI: constants.PERESDACHI_UNIQUE_KEY},
+        **kwargs
+    )
+
+
+@pytest.fixture
+def no_write_delay(monkeypatch):
+    monkeypatch.setattr(constants, 'WRITE_RETRY_DELAY', 0)
+
+
+def test_save_skips_existing_and_payload_duplicates(mocker):
+    client = peresdachi_client(peresdachi_table(3))
+    mocker.patch.object(external_assessment, 'get_supabase_client', return_value=client)
+    upload = pd.concat([make_upload(5), make_upload(1, start=4)], ignore_index=True)
+
+    success, _, stats = external_assessment.save_to_supabase(upload)
+
+    assert success
+    assert stats == {'inserted': 2, 'skipped': 4, 'failed': 0}
+    assert len(client.tables[constants.DB_TABLE_PERESDACHI]) == 5
+    assert 'Служебная колонка' not in client.tables[constants.DB_TABLE_PERESDACHI].columns
+
+
+def test_save_splits_batches_by_rows_and_bytes(mocker):
+    client = peresdachi_client(peresdachi_table(0))
+    mocker.patch.object(external_assessment, 'get_supabase_client', return_value=client)
+    records = make_upload(100)[[constants.COL_EMAIL, constants.COL_DISCIPLINE]].to_dict('records')
+
+    stats, inserted, _ = external_assessment.write_peresdachi_batches(records, batch_rows=30, batch_bytes=10_000)
+    assert stats['inserted'] == 100 and len(inserted) == 100
+    assert [n for _, op, n in client.requests] == [30, 30, 30, 10]
+
+    stats, _, _ = external_assessment.write_peresdachi_batches(records, batch_rows=1000, batch_bytes=2_000)
+    assert stats == {'inserted': 0, 'skipped': 100, 'failed': 0}
+    assert len(client.requests) > 5
+
+
+def test_save_falls_back_to_insert_without_constraint(mocker):
+    client = NoConstraintClient({constants.DB_TABLE_PERESDACHI: peresdachi_table(0)})
+    mocker.patch.object(external_assessment, 'get_supabase_client', return_value=client)
+
+    success, _, stats = external_assessment.save_to_supabase(make_upload(10))
+
+    assert success and stats['inserted'] == 10
+    assert {op for _, op, _ in client.requests} == {'insert'}
+
+
+def test_save_retries_transient_batch_failure(mocker, no_write_delay):
+    client = peresdachi_client(peresdachi_table(0), FailingBatchClient, failing_email='s500@edu.hse.ru', failures=2)
+    mocker.patch.object(external_assessment, 'get_supabase_client', return_value=client)
+
+    success, _, stats = external_assessment.save_to_supabase(make_upload(1200))
+
+    assert success
+    assert stats == {'inserted': 1200, 'skipped': 0, 'failed': 0}
+
+
+def test_save_reports_failed_batch_and_continues(mocker, no_write_delay):
+    client = peresdachi_client(
+        peresdachi_table(0), FailingBatchClient, failing_email='s500@edu.hse.ru', failures=constants.WRITE_BATCH_RETRIES
+    )
+    mocker.patch.object(external_assessment, 'get_supabase_client', return_value=client)
+
+    success, message, stats = external_assessment.save_to_supabase(make_upload(1200))
+
+    assert not success
+    assert stats == {'inserted': 700, 'skipped': 0, 'failed': 500}
+    assert 'connection reset' in message
+
+
+
+def make_result(rows):
+    return pd.DataFrame(rows, columns=[constants.COL_EMAIL, constants.COL_DISCIPLINE, constants.COL_GRADE])
+
+
+def test_new_records_are_rows_inserted_by_database(mocker):
+    stored = make_result([(' A@EDU.hse.ru ', constants.DISCIPLINE_INPUT, '5')]).assign(id=[1])
+    client = peresdachi_client(stored)
+    mocker.patch.object(external_assessment, 'get_supabase_client', return_value=client)
+    result = make_result([
+        ('a@edu.hse.ru', constants.DISCIPLINE_INPUT, '8'),
+        ('a@edu.hse.ru', constants.DISCIPLINE_FINAL, '6'),
+        ('b@edu.hse.ru', constants.DISCIPLINE_INPUT, '4'),
+        ('b@edu.hse.ru', constants.DISCIPLINE_INPUT, '7'),
+    ])
+
+    split = external_assessment.deduplicate_and_save(result)
+
+    assert split['duplicates_removed'] == 1 and split['total_count'] == 3
+    assert list(zip(split['display_new_records'][constants.COL_EMAIL], split['display_new_records'][constants.COL_GRADE])) == [
+        ('a@edu.hse.ru', '6'), ('b@edu.hse.ru', '4')
+    ]
+    assert split['save_success'] and split['save_stats'] == {'inserted': 2, 'skipped': 1, 'failed': 0}
+    # Существующие записи отсекает индекс: peresdachi не читается
+    assert [op for _, op, _ in client.requests] == ['upsert']
+    assert len(client.tables[constants.DB_TABLE_PERESDACHI]) == 3
+
+
+def test_save_without_unique_key_compares_on_client(mocker):
+    client = make_client([('a@edu.hse.ru', constants.DISCIPLINE_INPUT, '5')], email_keys=False)
+    mocker.patch.object(external_assessment, 'get_supabase_client', return_value=client)
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+    result = make_result([
+        ('a@edu.hse.ru', constants.DISCIPLINE_INPUT, '8'),
+        ('c@edu.hse.ru', constants.DISCIPLINE_INPUT, '7'),
+        ('c@edu.hse.ru', constants.DISCIPLINE_INPUT, '9'),
+    ])
+
+    expected = external_assessment.deduplicate_and_split(result)
+    split = external_assessment.deduplicate_and_save(result)
+
+    assert split['save_success'] and split['duplicates_removed'] == 1
+    pd.testing.assert_frame_equal(split['display_new_records'], expected['display_new_records'])
+    assert split['display_new_records'][constants.COL_EMAIL].tolist() == ['c@edu.hse.ru']
+    # Без индекса уже сохраненная запись не дублируется: она отсеяна сравнением до записи
+    assert len(client.tables[constants.DB_TABLE_PERESDACHI]) == 2
+
+
+def test_unique_key_migration_on_postgres():
+    """Проверка sql/migration_peresdachi_unique_key.sql на локальном Postgres (TEST_DATABASE_URL)."""
+    dsn = os.environ.get('TEST_DATABASE_URL')
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL не задан")
+    psycopg = pytest.importorskip('psycopg')
+    sql_path = os.path.join(os.path.dirname(__file__), '..', 'sql', 'migration_peresdachi_unique_key.sql')
+    with open(sql_path, encoding='utf-8') as f:
+        migration = f.read()
+
+    # Скрипт сам управляет транзакцией, поэтому схема удаляется явно
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        try:
+            conn.execute("CREATE SCHEMA peresdachi_unique_key_test")
+            conn.execute("SET search_path TO peresdachi_unique_key_test")
+            conn.execute("""
+                CREATE TABLE peresdachi (
+                    id BIGSERIAL PRIMARY KEY,
+                    "Адрес электронной почты" TEXT,
+                    "Наименование дисциплины" TEXT,
+                    "Оценка" TEXT,
+                    email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED
+                )
+            """)
+            conn.execute("""
+                INSERT INTO peresdachi ("Адрес электронной почты", "Наименование дисциплины", "Оценка")
+                VALUES ('a@edu.hse.ru', 'Тест', '5'), (' A@EDU.hse.ru', 'Тест ', '7'),
+                       ('b@edu.hse.ru', 'Тест', '4'), (NULL, 'Тест', '3'), (NULL, 'Тест', '2')
+            """)
+            conn.execute(migration)
+            rows = conn.execute('SELECT id, "Оценка" FROM peresdachi ORDER BY id').fetchall()
+            inserted = conn.execute("""
+                INSERT INTO peresdachi ("Адрес электронной почты", "Наименование дисциплины", "Оценка")
+                VALUES ('A@edu.hse.ru', 'Тест', '9'), ('c@edu.hse.ru', 'Тест', '8')
+                ON CONFLICT (email_key, "Наименование дисциплины") DO NOTHING
+                RETURNING "Адрес электронной почты"
+            """).fetchall()
+        finally:
+            conn.execute("DROP SCHEMA IF EXISTS peresdachi_unique_key_test CASCADE")
+
+    # Остается самая ранняя запись ключа; строки без email не считаются дубликатами
+    assert rows == [(1, '5'), (3, '4'), (4, '3'), (5, '2')]
+    assert inserted == [('c@edu.hse.ru',)]
+
+# =====================================================================
+# Общий этап обогащения
+# =====================================================================
+
+def test_lookup_positions_on_composite_key():
+    lookup = external_assessment._index_by(pd.DataFrame({
+        constants.COL_EMAIL: ['a@edu.hse.ru', 'a@edu.hse.ru', 'b@edu.hse.ru', None],
+        constants.COL_DISCIPLINE: ['X', 'Y', 'X', 'Y'],
+        constants.COL_GRADE: ['1', '2', '3', '4'],
+    }), [constants.COL_EMAIL, constants.COL_DISCIPLINE])
+    rows = pd.DataFrame({
+        constants.COL_EMAIL: ['b@edu.hse.ru', 'a@edu.hse.ru', 'c@edu.hse.ru', 'b@edu.hse.ru', None],
+        constants.COL_DISCIPLINE: ['X', 'Y', 'X', 'Y', 'Y'],
+    })
+
+    positions = external_assessment._lookup_positions(lookup.index, rows)
+
+    assert positions.tolist() == [2, 1, -1, -1, -1]
+
+
+def test_enrichment_lookups_are_built_once_per_snapshot(mocker):
+    patch_reference_tables(mocker, compact=True)
+    snapshot = external_assessment.ReferenceSnapshot()
+    students = STUDENTS.copy()
+
+    first, _ = external_assessment.process_external_assessment(TEST_GRADES.copy(), students, snapshot=snapshot)
+    lookups = (snapshot.registration_lookup, snapshot.student_lookup(students),
+               snapshot.grade_lookup(constants.DB_TABLE_STUDENT_IO))
+    clean = mocker.spy(external_assessment, 'clean_email_column')
+    second, _ = external_assessment.process_project_assessment(PROJECT_GRADES.copy(), students, snapshot=snapshot)
+
+    assert lookups[0] is snapshot.registration_lookup
+    assert lookups[1] is snapshot.student_lookup(students)
+    assert lookups[2] is snapshot.grade_lookup(constants.DB_TABLE_STUDENT_IO)
+    # Справочники не очищаются повторно — только загруженный файл
+    assert clean.call_count == 1
+    assert len(first) > 0 and len(second) > 0
+
+
+def test_saved_records_refresh_peresdachi_lookup(mocker):
+    patch_reference_tables(mocker, compact=True)
+    snapshot = external_assessment.ReferenceSnapshot()
+    assert ('c@edu.hse.ru', constants.DISCIPLINE_MID) not in snapshot.grade_lookup(constants.DB_TABLE_PERESDACHI).index
+
+    snapshot.record_saved(pd.DataFrame({
+        constants.COL_EMAIL: ['c@edu.hse.ru'], constants.COL_DISCIPLINE: [constants.DISCIPLINE_MID], constants.COL_GRADE: ['5'],
+    }))
+
+    assert snapshot.grade_lookup(constants.DB_TABLE_PERESDACHI)[('c@edu.hse.ru', constants.DISCIPLINE_MID)] == '5'
+
+
+# =====================================================================
+# final_grades
+# =====================================================================
+
+def make_final_grades(rows):
+    return pd.DataFrame(rows, columns=[
+        constants.COL_EMAIL, constants.COL_FIO, constants.COL_FINAL_TEST_GRADE,
+        constants.COL_FINAL_PROJECT_GRADE, constants.COL_FINAL_GRADE
+    ])
+
+
+def test_final_grade_payloads_take_maximum():
+    existing = make_final_grades([
+        ('a@edu.hse.ru', 'Иванов Иван', '9', None, '9'),
+        ('b@edu.hse.ru', 'Петров Петр', '', None, '4'),
+    ]).set_index(constants.COL_EMAIL)
+    work_df = pd.DataFrame({
+        constants.COL_EMAIL: ['a@edu.hse.ru', 'b@edu.hse.ru', 'b@edu.hse.ru', 'c@edu.hse.ru', 'd@edu.hse.ru', ''],
+        constants.COL_FIO: [None, None, None, 'Сидоров Сидор Сидорович', float('nan'), 'Пусто'],
+        constants.COL_GRADE: ['7', '5', '6.0', ' 8 ', 'abc', '9'],
+    })
+
+    updates, new_records = external_assessment.build_final_grade_payloads(work_df, existing)
+
+    assert updates.set_index(constants.COL_EMAIL)[constants.COL_FINAL_GRADE].to_dict() == {
+        'a@edu.hse.ru': 9.0, 'b@edu.hse.ru': 6.0
+    }
+    assert updates.set_index(constants.COL_EMAIL)[constants.COL_FINAL_PROJECT_GRADE]['b@edu.hse.ru'] == 6.0
+    assert new_records.to_dict('records') == [{
+        constants.COL_EMAIL: 'c@edu.hse.ru', constants.COL_FINAL_PROJECT_GRADE: 8.0, constants.COL_FINAL_GRADE: 8.0,
+        constants.COL_FIO: 'Сидоров Сидор Сидорович', 'Фамилия': 'Сидоров', 'Имя': 'Сидор',
+    }]
+
+
+def test_final_grades_surfaces_lookup_errors(mocker, monkeypatch):
+    class FailingClient(FakeSupabaseClient):
+        def _execute(self, query):
+            raise ConnectionError('timeout')
+
+    monkeypatch.setattr(utils, 'FETCH_RETRY_DELAY', 0)
+    client = FailingClient({constants.DB_TABLE_FINAL_GRADES: make_final_grades([])})
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+
+    success, count, message = external_assessment.update_final_grades(pd.DataFrame({
+        constants.COL_EMAIL: ['a@edu.hse.ru'], constants.COL_GRADE: ['7'],
+    }))
+
+    assert not success and count == 0
+    assert 'timeout' in message
+
+
+def test_final_grades_upserts_batches_concurrently(mocker, monkeypatch):
+    monkeypatch.setattr(constants, 'FINAL_GRADES_CHUNK_SIZE', 50)
+    client = FakeSupabaseClient({constants.DB_TABLE_FINAL_GRADES: make_final_grades([
+        (f's{i}@edu.hse.ru', None, '6', None, '6') for i in range(0, 500, 2)
+    ])})
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+
+    success, count, _ = external_assessment.update_final_grades(pd.DataFrame({
+        constants.COL_EMAIL: [f'S{i}@edu.hse.ru ' for i in range(500)],
+        constants.COL_GRADE: ['8'] * 250 + ['5'] * 250,
+    }))
+
+    saved = client.tables[constants.DB_TABLE_FINAL_GRADES].set_index(constants.COL_EMAIL)[constants.COL_FINAL_GRADE]
+    assert success and count == 500
+    assert len(saved) == 500
+    assert saved['s0@edu.hse.ru'] == 8.0 and saved['s498@edu.hse.ru'] == 6.0 and saved['s499@edu.hse.ru'] == 5.0
+    assert sum(op == 'upsert' for _, op, _ in client.requests) == 10
+
+
+def test_final_grades_lookup_uses_client_per_thread(mocker, monkeypatch):
+    monkeypatch.setattr(constants, 'FINAL_GRADES_CHUNK_SIZE', 10)
+    tables = {constants.DB_TABLE_FINAL_GRADES: make_final_grades([
+        (f's{i}@edu.hse.ru', None, '6', None, '6') for i in range(200)
+    ])}
+    generated = {constants.DB_TABLE_FINAL_GRADES: {constants.EMAIL_KEY_COLUMN: email_key(constants.COL_EMAIL)}}
+    served = []
+
+    class RecordingClient(FakeSupabaseClient):
+        def _execute(self, query):
+            served.append((threading.get_ident(), id(self)))
+            return super()._execute(query)
+
+    shared = RecordingClient(tables, generated=generated)
+    mocker.patch.object(utils, 'get_supabase_client', return_value=shared)
+    mocker.patch.object(utils, 'create_supabase_client',
+                        side_effect=lambda: RecordingClient(tables, generated=generated))
+
+    existing = external_assessment._load_final_grades([f's{i}@edu.hse.ru' for i in range(200)])
+
+    clients_by_thread = {}
+    for thread, client in served:
+        clients_by_thread.setdefault(thread, set()).add(client)
+    clients = [client for thread_clients in clients_by_thread.values() for client in thread_clients]
+    assert len(existing) == 200
+    # Порции запрашивают клиенты потоков, а не общий клиент: один клиент на поток
+    assert id(shared) not in clients
+    assert len(clients) == len(set(clients)) == len(clients_by_thread)
+
+
+def _final_grades_client(rows):
+    client = FakeSupabaseClient({constants.DB_TABLE_FINAL_GRADES: make_final_grades(rows)})
+    client.rpc_handlers[constants.FINAL_GRADES_MERGE_FUNCTION] = merge_final_grades_handler(client)
+    return client
+
+
+FINAL_GRADES_ROWS = [
+    ('a@edu.hse.ru', 'Иванов Иван', '9', None, '9'),
+    ('b@edu.hse.ru', 'Петров Петр', '', None, '4'),
+]
+FINAL_GRADES_INPUT = pd.DataFrame({
+    constants.COL_EMAIL: ['A@edu.hse.ru', 'b@edu.hse.ru', 'b@edu.hse.ru', 'c@edu.hse.ru'],
+    constants.COL_FIO: ['Иванов И.', None, None, 'Сидоров  Сидор Сидорович'],
+    constants.COL_GRADE: ['7', '5', '6.0', ' 8 '],
+})
+
+
+def test_final_grades_merged_by_server_function(mocker):
+    client = _final_grades_client(FINAL_GRADES_ROWS)
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+
+    success, count, _ = external_assessment.update_final_grades(FINAL_GRADES_INPUT)
+
+    saved = client.tables[constants.DB_TABLE_FINAL_GRADES].set_index(constants.COL_EMAIL)
+    assert success and count == 3
+    assert saved[constants.COL_FINAL_GRADE].to_dict() == {'a@edu.hse.ru': 9.0, 'b@edu.hse.ru': 6.0, 'c@edu.hse.ru': 8.0}
+    assert saved.loc['a@edu.hse.ru', constants.COL_FIO] == 'Иванов Иван'
+    assert (saved.loc['c@edu.hse.ru', 'Фамилия'], saved.loc['c@edu.hse.ru', 'Имя']) == ('Сидоров', 'Сидор')
+    # Без чтения final_grades: один вызов функции на пакет
+    assert [op for _, op, _ in client.requests] == ['rpc']
+
+
+def test_server_merge_updates_row_stored_in_other_case(mocker):
+    client = _final_grades_client([('Ivanov@Edu.hse.ru ', 'Иванов Иван', '9', None, '9')])
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+
+    success, count, _ = external_assessment.update_final_grades(pd.DataFrame({
+        constants.COL_EMAIL: ['ivanov@edu.hse.ru'], constants.COL_GRADE: ['10'],
+    }))
+
+    saved = client.tables[constants.DB_TABLE_FINAL_GRADES]
+    assert success and count == 1
+    # Конфликт по email_key: запись обновлена под сохраненным email, дубликата нет
+    assert saved[constants.COL_EMAIL].tolist() == ['Ivanov@Edu.hse.ru ']
+    assert saved[constants.COL_FINAL_GRADE].tolist() == [10.0]
+
+
+def test_server_and_client_merge_agree(mocker):
+    results = []
+    for with_function in (True, False):
+        client = _final_grades_client(FINAL_GRADES_ROWS)
+        if not with_function:
+            client.rpc_handlers.clear()
+        mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+        assert external_assessment.update_final_grades(FINAL_GRADES_INPUT)[:2] == (True, 3)
+        saved = client.tables[constants.DB_TABLE_FINAL_GRADES]
+        results.append(saved.sort_values(constants.COL_EMAIL).reset_index(drop=True).astype(object))
+
+    pd.testing.assert_frame_equal(results[0], results[1][results[0].columns])
+
+
+def test_server_merge_retries_failed_first_batch(mocker, monkeypatch):
+    monkeypatch.setattr(constants, 'FINAL_GRADES_CHUNK_SIZE', 2)
+    monkeypatch.setattr(constants, 'WRITE_RETRY_DELAY', 0)
+    client = _final_grades_client([])
+    merge = client.rpc_handlers[constants.FINAL_GRADES_MERGE_FUNCTION]
+    calls = []
+
+    def flaky(params):
+        calls.append(len(params['payload']))
+        if len(calls) == 1:
+            raise ConnectionError('timeout')
+        return merge(params)
+
+    client.rpc_handlers[constants.FINAL_GRADES_MERGE_FUNCTION] = flaky
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+
+    success, count, _ = external_assessment.update_final_grades(pd.DataFrame({
+        constants.COL_EMAIL: [f's{i}@edu.hse.ru' for i in range(5)], constants.COL_GRADE: ['7'] * 5,
+    }))
+
+    assert success and count == 5
+    assert len(client.tables[constants.DB_TABLE_FINAL_GRADES]) == 5
+    assert not any(table == constants.DB_TABLE_FINAL_GRADES for table, op, _ in client.requests if op == 'select')
+
+
+def test_merge_function_sql_on_postgres():
+    """Проверка sql/function_merge_final_grades.sql на локальном Postgres (TEST_DATABASE_URL)."""
+    dsn = os.environ.get('TEST_DATABASE_URL')
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL не задан")
+    psycopg = pytest.importorskip('psycopg')
+
+    # Скрипт сам управляет транзакцией, поэтому схема удаляется явно
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        try:
+            conn.execute("CREATE SCHEMA merge_final_grades_test")
+            conn.execute("SET search_path TO merge_final_grades_test")
+            conn.execute("""
+                CREATE TABLE final_grades (
+                    "Адрес электронной почты" TEXT PRIMARY KEY,
+                    "ФИО" TEXT, "Фамилия" TEXT, "Имя" TEXT,
+                    "Оценка за тест" TEXT, "Оценка за проект" TEXT, "Итоговая оценка" TEXT,
+                    email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED
+                )
+            """)
+            conn.execute("""
+                INSERT INTO final_grades ("Адрес электронной почты", "ФИО", "Оценка за тест", "Итоговая оценка")
+                VALUES ('a@edu.hse.ru', 'Иванов Иван', '9', '9'), ('b@edu.hse.ru', 'Петров Петр', '', '4'),
+                       ('D@Edu.hse.ru ', 'Кузнецов Дмитрий', '5', '5'),
+                       ('e@edu.hse.ru', 'Егоров Егор', '3', '3'), ('E@edu.hse.ru', 'Егоров Е.', '', '8')
+            """)
+            conn.execute(read_sql('function_merge_final_grades.sql'))
+
+            payload = [
+                {'email': 'A@edu.hse.ru', 'fio': 'Иванов И.', 'project_grade': 7},
+                {'email': 'b@edu.hse.ru', 'fio': None, 'project_grade': 5},
+                {'email': 'b@edu.hse.ru', 'fio': None, 'project_grade': 6},
+                {'email': 'c@edu.hse.ru', 'fio': 'Сидоров  Сидор Сидорович', 'project_grade': 8},
+                {'email': 'd@edu.hse.ru', 'fio': None, 'project_grade': 7},
+                {'email': 'e@edu.hse.ru', 'fio': None, 'project_grade': 6},
+            ]
+            count = conn.execute("SELECT merge_final_grades(%s::jsonb)", [json.dumps(payload)]).fetchone()[0]
+            rows = conn.execute("""
+                SELECT "Адрес электронной почты", "ФИО", "Фамилия", "Имя", "Итоговая оценка"::NUMERIC
+                FROM final_grades ORDER BY email_key
+            """).fetchall()
+        finally:
+            conn.execute("DROP SCHEMA IF EXISTS merge_final_grades_test CASCADE")
+
+    assert count == 5
+    assert rows == [
+        ('a@edu.hse.ru', 'Иванов Иван', None, None, 9),
+        ('b@edu.hse.ru', 'Петров Петр', None, None, 6),
+        ('c@edu.hse.ru', 'Сидоров  Сидор Сидорович', 'Сидоров', 'Сидор', 8),
+        # Запись в другом регистре обновлена, а не продублирована
+        ('D@Edu.hse.ru ', 'Кузнецов Дмитрий', None, None, 7),
+        # Дубликаты по email_key сведены к нормализованной записи с наибольшей оценкой
+        ('e@edu.hse.ru', 'Егоров Егор', None, None, 8),
+    ]
+
+
+# =====================================================================
+# Индексы и секционирование peresdachi (EXPLAIN на локальном Postgres)
+# =====================================================================
+
+def read_sql(name):
+    with open(os.path.join(os.path.dirname(__file__), '..', 'sql', name), encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.fixture
+def peresdachi_history():
+    """
+    Схема с таблицей peresdachi из sql/create_peresdachi_table.sql и пятью учебными годами
+    синтетических пересдач: 200 000 записей, created_at растет, период — модуль учебного года.
+    """
+    dsn = os.environ.get('TEST_DATABASE_URL')
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL не задан")
+    psycopg = pytest.importorskip('psycopg')
+
+    # Миграции сами управляют транзакциями, поэтому схема удаляется явно
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        try:
+            conn.execute("CREATE SCHEMA peresdachi_history_test")
+            conn.execute("SET search_path TO peresdachi_history_test")
+            conn.execute(read_sql('create_peresdachi_table.sql'))
+            conn.execute("""
+                INSERT INTO peresdachi ("ФИО", "Адрес электронной почты", "Наименование дисциплины",
+                                        "Период аттестации", "Оценка", created_at)
+                SELECT 'Студент ' || g, 's' || g || '@edu.hse.ru', discipline,
+                       academic_year || '/' || (academic_year + 1) || ' ' || (1 + month_in_year / 3) || ' модуль',
+                       (g %% 10)::TEXT, created_at
+                FROM (
+                    SELECT g, created_at,
+                           (ARRAY[%s, %s, %s])[1 + g %% 3] AS discipline,
+                           extract(year FROM created_at - interval '8 months')::INTEGER AS academic_year,
+                           extract(month FROM created_at - interval '8 months')::INTEGER - 1 AS month_in_year
+                    FROM generate_series(1, 200000) AS g,
+                         LATERAL (SELECT timestamptz '2021-09-01' + g * interval '13 minutes' AS created_at) AS t
+                ) AS history
+            """, [constants.DISCIPLINE_INPUT, constants.DISCIPLINE_MID, constants.DISCIPLINE_FINAL])
+            conn.execute("ANALYZE peresdachi")
+            yield conn
+        finally:
+            conn.execute("DROP SCHEMA IF EXISTS peresdachi_history_test CASCADE")
+
+
+def explain(conn, query, params):
+    """Узлы плана запроса: (тип узла, таблица, индекс)."""
+    plan = conn.execute(f"EXPLAIN (FORMAT JSON) {query}", params).fetchone()[0]
+    nodes, pending = [], [plan[0]['Plan']]
+    while pending:
+        node = pending.pop()
+        nodes.append((node['Node Type'], node.get('Relation Name'), node.get('Index Name')))
+        pending.extend(node.get('Plans', []))
+    return nodes
+
+
+# Страница выгрузки load_peresdachi_by_date_range: фильтр по created_at и keyset по id
+DATE_RANGE_PAGE = """
+    SELECT * FROM peresdachi
+    WHERE created_at >= %s AND created_at < %s AND id > %s
+    ORDER BY id LIMIT 1000
+"""
+
+
+def buffers(conn, query, params):
+    """Число страниц (shared buffers), прочитанных при выполнении запроса."""
+    plan = conn.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params).fetchone()[0][0]['Plan']
+    return plan['Shared Hit Blocks'] + plan['Shared Read Blocks']
+
+
+def test_date_range_export_uses_created_at_index(peresdachi_history):
+    conn = peresdachi_history
+    month = [date(2024, 3, 1), date(2024, 4, 1), 0]
+    conn.execute("DROP INDEX idx_peresdachi_created_at")
+    table_pages = conn.execute("SELECT relpages FROM pg_class WHERE relname = 'peresdachi'").fetchone()[0]
+
+    before = buffers(conn, DATE_RANGE_PAGE, month)
+    conn.execute(read_sql('migration_peresdachi_created_at_index.sql'))
+    after = buffers(conn, DATE_RANGE_PAGE, month)
+
+    # Проверка не зависит от выбранного плана: без индекса страница выгрузки читает большую
+    # часть таблицы (последовательно или по первичному ключу), с индексом — только диапазон
+    assert after * 10 < before
+    assert after * 10 < table_pages
+    assert len(conn.execute(DATE_RANGE_PAGE, month).fetchall()) == 1000
+
+
+def test_partitioning_by_period_prunes_partitions(peresdachi_history):
+    conn = peresdachi_history
+    count = conn.execute("SELECT count(*) FROM peresdachi").fetchone()[0]
+    periods = conn.execute('SELECT count(DISTINCT "Период аттестации") FROM peresdachi').fetchone()[0]
+
+    conn.execute(read_sql('optional_partition_peresdachi_by_period.sql'))
+    plan = explain(conn, 'SELECT * FROM peresdachi WHERE "Период аттестации" = %s', ['2023/2024 2 модуль'])
+    scanned = {relation for _, relation, _ in plan if relation}
+
+    assert conn.execute("SELECT count(*) FROM peresdachi").fetchone()[0] == count
+    # Запрос по периоду читает одну секцию из двадцати (и не читает секцию по умолчанию)
+    assert periods == 20
+    assert len(scanned) == 1 and scanned.pop().startswith('peresdachi_p_')
+
+    # Новый период попадает в секцию по умолчанию и переносится в отдельную секцию по вызову
+    conn.execute("""
+        INSERT INTO peresdachi ("Адрес электронной почты", "Наименование дисциплины", "Период аттестации")
+        VALUES ('new@edu.hse.ru', %s, '2026/2027 1 модуль')
+    """, [constants.DISCIPLINE_INPUT])
+    partition = conn.execute("SELECT create_peresdachi_period_partition('2026/2027 1 модуль')").fetchone()[0]
+    assert conn.execute(f"SELECT count(*) FROM {partition}").fetchone()[0] == 1
+    assert conn.execute("SELECT count(*) FROM peresdachi_default").fetchone()[0] == 0
+
+
+# Ключевой запрос справочной таблицы по email загрузки (_fetch_by_emails)
+EMAIL_PROBE = 'SELECT * FROM student_io WHERE email_key = ANY(%s) ORDER BY id LIMIT 1000'
+
+
+def test_reference_probe_uses_composite_index():
+    """Проверка sql/migration_add_join_key_indexes.sql на локальном Postgres (TEST_DATABASE_URL)."""
+    dsn = os.environ.get('TEST_DATABASE_URL')
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL не задан")
+    psycopg = pytest.importorskip('psycopg')
+
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        try:
+            conn.execute("CREATE SCHEMA join_key_indexes_test")
+            conn.execute("SET search_path TO join_key_indexes_test")
+            # Скрипт registration_data создает таблицу в public; для миграции достаточно ключевых колонок
+            conn.execute("""
+                CREATE TABLE registration_data (
+                    id SERIAL PRIMARY KEY,
+                    "Адрес электронной почты" TEXT,
+                    "Наименование дисциплины" TEXT,
+                    email_key TEXT GENERATED ALWAYS AS (lower(btrim("Адрес электронной почты"))) STORED
+                )
+            """)
+            conn.execute(read_sql('create_student_io_table.sql'))
+            conn.execute("DROP INDEX idx_student_io_email_key_discipline")
+            conn.execute("""
+                INSERT INTO student_io ("Адрес электронной почты", "Наименование дисциплины", "Оценка")
+                SELECT ' S' || g || '@Edu.hse.ru', (ARRAY[%s, %s, %s])[1 + g %% 3], (g %% 10)::TEXT
+                FROM generate_series(1, 200000) AS g
+            """, [constants.DISCIPLINE_INPUT, constants.DISCIPLINE_MID, constants.DISCIPLINE_FINAL])
+            conn.execute("ANALYZE student_io")
+            emails = [f's{i}@edu.hse.ru' for i in range(1, 200000, 1000)]
+
+            before = explain(conn, EMAIL_PROBE, [emails])
+            conn.execute(read_sql('migration_add_join_key_indexes.sql'))
+            after = explain(conn, EMAIL_PROBE, [emails])
+            found = conn.execute(EMAIL_PROBE, [emails]).fetchall()
+
+            assert ('Seq Scan', 'student_io', None) in before
+            assert 'idx_student_io_email_key_discipline' in {index for _, _, index in after}
+            assert 'Seq Scan' not in {node for node, _, _ in after}
+            assert len(found) == len(emails)
+        finally:
+            conn.execute("DROP SCHEMA IF EXISTS join_key_indexes_test CASCADE")
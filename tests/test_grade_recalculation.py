@@ -2,10 +2,16 @@
 Тесты для logic/grade_recalculation.py
 Покрывают основные ветки расчёта ДПР_итог и НЭ_итог
 """
+import io
+import zipfile
 import pytest
 import pandas as pd
 import numpy as np
-from logic.grade_recalculation import process_grade_recalculation
+from logic.grade_recalculation import (
+    process_grade_recalculation, compile_rule_table, sweep_grade_recalculation, sweep_variants_from_rows,
+    stream_grade_recalculation, detect_stage, classify_stage,
+    process_grade_recalculation_batch
+)
 
 
 def make_row(ne_name, ne_grade, dpr_grade, vhod, prom, itog):
@@ -32,6 +38,23 @@ def process_single(ne_name, ne_grade, dpr_grade, vhod, prom, itog, use_dynamics=
 # =====================================================================
 
 class TestStageDetection:
+    def test_lookup_matches_substring_search(self):
+        names = pd.Series(['Введение к анализу данных', 'ВВЕДЕНИЕ К ПРОГРАММИРОВАНИЮ', 'ЦГ', np.nan,
+                           'анализу данных и программированию', 'Введение к анализу данных'])
+        expected = pd.Series(1, index=names.index)
+        expected[names.str.contains('анализу данных', case=False, na=False)] = 3
+        expected[names.str.contains('программированию', case=False, na=False)] = 2
+        pd.testing.assert_series_equal(detect_stage(names), expected, check_dtype=False)
+
+    def test_unique_names_classified_once(self):
+        classify_stage.cache_clear()
+        names = pd.Series(['Введение к программированию', 'ЦГ'] * 500)
+        detect_stage(names)
+        detect_stage(names)
+        info = classify_stage.cache_info()
+        assert info.misses == 2
+        assert info.hits == 2
+
     def test_stage_1_default(self):
         """По умолчанию этап = 1 (входной контроль)"""
         df = pd.DataFrame([make_row('Цифровая грамотность', 5, 5, 10, 3, 3)])
@@ -255,3 +278,298 @@ class TestMultipleRows:
         # Row 2: ne == dpr
         assert pd.isna(result['ДПР_итог'].iloc[2])
         assert pd.isna(result['НЭ_итог'].iloc[2])
+
+
+# =====================================================================
+# Эквивалентность векторного движка построчному расчёту
+# =====================================================================
+
+def reference_process(df, use_dynamics):
+    """Исходная построчная реализация (iterrows), эталон для сравнения."""
+    processed_df = df.copy()
+    processed_df['Оценка дисциплины-пререквизита'] = processed_df['Оценка дисциплины-пререквизита'].apply(
+        lambda x: 8 if x >= 9 else x
+    )
+    processed_df['Этап'] = 1
+    processed_df.loc[processed_df['Наименование НЭ'].str.contains('анализу данных', case=False, na=False), 'Этап'] = 3
+    processed_df.loc[processed_df['Наименование НЭ'].str.contains('программированию', case=False, na=False), 'Этап'] = 2
+
+    dpr_results = []
+    ie_results = []
+    for _, row in processed_df.iterrows():
+        vhod = row['Внешнее измерение цифровых компетенций. Входной контроль']
+        prom = row['Внешнее измерение цифровых компетенций. Промежуточный контроль']
+        itog = row['Внешнее измерение цифровых компетенций. Итоговый контроль']
+        innopolis_grade = vhod if row['Этап'] == 1 else prom if row['Этап'] == 2 else itog
+
+        if use_dynamics and ((vhod - prom > 1) or (vhod - itog > 1) or (prom - itog > 1)):
+            dpr_results.append(np.nan)
+            ie_results.append(np.nan)
+            continue
+
+        ne_grade = row['Оценка НЭ']
+        dpr_grade = row['Оценка дисциплины-пререквизита']
+        ne_grade = 0 if pd.isna(ne_grade) else ne_grade
+        dpr_grade = 0 if pd.isna(dpr_grade) else dpr_grade
+        innopolis_grade = 0 if pd.isna(innopolis_grade) else innopolis_grade
+        max_grade = max(ne_grade, dpr_grade, innopolis_grade)
+        innopolis_wins = (max_grade == innopolis_grade and innopolis_grade > 3
+                          and innopolis_grade != dpr_grade and innopolis_grade != ne_grade)
+
+        if ne_grade < 4:
+            dpr_final = np.nan
+        elif innopolis_wins:
+            dpr_final = innopolis_grade
+        elif ne_grade == dpr_grade:
+            dpr_final = np.nan
+        elif dpr_grade < 4:
+            dpr_final = ne_grade if ne_grade >= 4 else np.nan
+        elif max_grade == dpr_grade and dpr_grade >= 4:
+            dpr_final = np.nan
+        else:
+            dpr_final = ne_grade
+        dpr_results.append(dpr_final)
+
+        if ne_grade < 4:
+            ie_final = np.nan
+        elif innopolis_wins:
+            ie_final = innopolis_grade
+        elif ne_grade == dpr_grade:
+            ie_final = np.nan
+        elif max_grade == dpr_grade and dpr_grade >= 4:
+            if ne_grade >= 8:
+                ie_final = np.nan
+            elif dpr_grade >= 8:
+                ie_final = 8
+            else:
+                ie_final = dpr_grade
+        else:
+            ie_final = np.nan
+        ie_results.append(ie_final)
+
+    processed_df['ДПР_итог'] = dpr_results
+    processed_df['НЭ_итог'] = ie_results
+    return processed_df
+
+
+def make_random_frame(n_rows, seed, nan_share=0.1):
+    """Случайные оценки 0..10 с пропусками и разными названиями НЭ."""
+    rng = np.random.default_rng(seed)
+    names = np.array(['Цифровая грамотность', 'Введение к программированию',
+                      'Введение к анализу данных', 'АНАЛИЗУ ДАННЫХ и программированию'])
+
+    def grades():
+        values = rng.integers(0, 11, n_rows).astype(float)
+        values[rng.random(n_rows) < nan_share] = np.nan
+        return values
+
+    name_col = rng.choice(names, n_rows).astype(object)
+    name_col[rng.random(n_rows) < nan_share] = np.nan
+    return pd.DataFrame([make_row(*values) for values in zip(
+        name_col, grades(), grades(), grades(), grades(), grades()
+    )])
+
+
+class TestVectorizedEquivalence:
+    @pytest.mark.parametrize('use_dynamics', [False, True])
+    @pytest.mark.parametrize('seed', [0, 1, 2])
+    def test_matches_reference_on_random_input(self, seed, use_dynamics):
+        df = make_random_frame(2000, seed)
+        expected = reference_process(df, use_dynamics)
+        result = process_grade_recalculation(df, use_dynamics=use_dynamics)
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    def test_matches_reference_without_nans(self):
+        df = make_random_frame(500, 42, nan_share=0.0)
+        for use_dynamics in (False, True):
+            expected = reference_process(df, use_dynamics)
+            result = process_grade_recalculation(df, use_dynamics=use_dynamics)
+            pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    def test_input_is_not_modified(self):
+        df = make_random_frame(50, 7)
+        snapshot = df.copy()
+        process_grade_recalculation(df, use_dynamics=True)
+        pd.testing.assert_frame_equal(df, snapshot)
+
+
+# =====================================================================
+# Таблицы правил
+# =====================================================================
+
+class TestRuleTables:
+    def make_context(self, **columns):
+        context = {k: np.asarray(v, dtype=float) for k, v in columns.items()}
+        context['n_rows'] = len(next(iter(context.values())))
+        return context
+
+    def test_first_matching_rule_wins(self):
+        table = {
+            'rules': [
+                {'name': 'a', 'when': [('ne', '>=', 8)], 'then': 10},
+                {'name': 'b', 'when': [('ne', '>=', 4)], 'then': 'ne'},
+            ],
+            'default': None,
+        }
+        evaluate = compile_rule_table(table)
+        result = evaluate(self.make_context(ne=[9, 5, 2]))
+        assert result[0] == 10
+        assert result[1] == 5
+        assert np.isnan(result[2])
+
+    def test_conditions_are_combined_with_and(self):
+        table = {
+            'rules': [{'name': 'a', 'when': [('ne', '>', 'dpr'), ('ne', '>=', 4)], 'then': 'ne'}],
+            'default': 'dpr',
+        }
+        evaluate = compile_rule_table(table)
+        result = evaluate(self.make_context(ne=[6, 3, 5], dpr=[5, 2, 7]))
+        assert result.tolist() == [6, 2, 7]
+
+    def test_params_are_resolved_from_context(self):
+        table = {
+            'rules': [{'name': 'cap', 'when': [('dpr_raw', '>=', 'dpr_cap_threshold')], 'then': 'dpr_cap_value'}],
+            'default': 'dpr_raw',
+        }
+        evaluate = compile_rule_table(table)
+        context = self.make_context(dpr_raw=[10, 7])
+        context.update({'dpr_cap_threshold': 7, 'dpr_cap_value': 6})
+        assert evaluate(context).tolist() == [6, 6]
+
+    def test_unknown_operand_raises(self):
+        table = {'rules': [{'name': 'typo', 'when': [('neee', '<', 4)], 'then': None}], 'default': None}
+        with pytest.raises(ValueError, match="Неизвестный операнд"):
+            compile_rule_table(table)
+
+    def test_unknown_operator_raises(self):
+        table = {'rules': [{'name': 'bad', 'when': [('ne', '=<', 4)], 'then': None}], 'default': None}
+        with pytest.raises(ValueError, match="Неизвестный оператор"):
+            compile_rule_table(table)
+
+
+# =====================================================================
+# Сравнение вариантов правил (what-if)
+# =====================================================================
+
+class TestSweep:
+    def test_variants_match_separate_runs(self):
+        df = make_random_frame(1000, 3)
+        variants = {
+            'Без динамики': {'use_dynamics': False},
+            'С динамикой': {'use_dynamics': True},
+            'С динамикой, падение > 2': {'use_dynamics': True, 'dynamics_max_drop': 2},
+            'Ограничение ДПР до 7': {'dpr_cap_threshold': 8, 'dpr_cap_value': 7},
+        }
+        summary = sweep_grade_recalculation(df, variants).set_index('Вариант')
+        baseline = process_grade_recalculation(df, use_dynamics=False)
+
+        for name, params in variants.items():
+            result = process_grade_recalculation(df, use_dynamics=params.get('use_dynamics', False), params=params)
+            assert summary.loc[name, 'Перезачтено ДПР_итог'] == result['ДПР_итог'].notna().sum()
+            assert summary.loc[name, 'Перезачтено НЭ_итог'] == result['НЭ_итог'].notna().sum()
+
+            changed = pd.Series(False, index=df.index)
+            for col in ['ДПР_итог', 'НЭ_итог']:
+                same = (result[col] == baseline[col]) | (result[col].isna() & baseline[col].isna())
+                changed |= ~same
+            assert summary.loc[name, 'Изменений относительно базового'] == changed.sum()
+
+    def test_baseline_has_no_changes(self):
+        df = make_random_frame(200, 4)
+        summary = sweep_grade_recalculation(df, {'База': {}, 'Динамика': {'use_dynamics': True}})
+        assert summary.iloc[0]['Изменений относительно базового'] == 0
+        assert summary.iloc[0]['use_dynamics'] == False
+
+    def test_unknown_param_raises(self):
+        df = make_random_frame(10, 5)
+        with pytest.raises(ValueError, match="Неизвестные параметры"):
+            sweep_grade_recalculation(df, {'Опечатка': {'dpr_cap': 7}})
+
+    def test_empty_variants_raises(self):
+        with pytest.raises(ValueError):
+            sweep_grade_recalculation(make_random_frame(10, 6), {})
+
+    def test_variants_from_rows_keep_every_row(self):
+        rows = [
+            {'Вариант': 'База', 'use_dynamics': False, 'dpr_cap_value': np.nan},
+            {'Вариант': ' Динамика ', 'use_dynamics': True, 'dpr_cap_value': 7},
+        ]
+        assert sweep_variants_from_rows(rows) == {
+            'База': {'use_dynamics': False},
+            'Динамика': {'use_dynamics': True, 'dpr_cap_value': 7},
+        }
+
+    @pytest.mark.parametrize('names,message', [
+        (['База', 'База '], 'Повторяющиеся названия вариантов: База'),
+        (['База', None], 'строках: 2'),
+        (['База', '  '], 'строках: 2'),
+    ])
+    def test_variants_from_rows_rejects_blank_and_duplicate_names(self, names, message):
+        rows = [{'Вариант': name, 'use_dynamics': False} for name in names]
+        with pytest.raises(ValueError, match=message):
+            sweep_variants_from_rows(rows)
+
+
+# =====================================================================
+# Потоковая обработка
+# =====================================================================
+
+class TestStreaming:
+    def make_csv(self, df):
+        return io.BytesIO(df.to_csv(index=False).encode('utf-8'))
+
+    @pytest.mark.parametrize('fmt', ['csv', 'xlsx'])
+    def test_stream_matches_in_memory(self, fmt):
+        df = make_random_frame(1000, 8)
+        expected = process_grade_recalculation(df, use_dynamics=True)
+
+        sink = io.BytesIO()
+        total_rows, preview = stream_grade_recalculation(
+            self.make_csv(df), sink, use_dynamics=True, fmt=fmt, chunksize=128
+        )
+        sink.seek(0)
+        if fmt == 'csv':
+            result = pd.read_csv(sink, encoding='utf-8-sig')
+        else:
+            result = pd.read_excel(sink, sheet_name='Результат')
+
+        assert total_rows == len(df)
+        assert len(preview) == 10
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    def test_unsupported_format_raises(self):
+        with pytest.raises(ValueError, match="Неподдерживаемый формат"):
+            stream_grade_recalculation(self.make_csv(make_random_frame(5, 9)), io.BytesIO(), False, fmt='json')
+
+
+# =====================================================================
+# Пакетная обработка
+# =====================================================================
+
+class TestBatch:
+    def test_batch_zip_and_summary(self):
+        df_a = make_random_frame(300, 10)
+        df_b = make_random_frame(200, 11)
+        files = [
+            ('Факультет_А.csv', df_a.to_csv(index=False).encode('utf-8')),
+            ('Факультет_Б.csv', df_b.to_csv(index=False).encode('utf-8')),
+            ('Пустой.csv', b'col\n1\n'),
+        ]
+        archive, summary = process_grade_recalculation_batch(files, use_dynamics=False, max_workers=2)
+
+        assert summary['Файл'].tolist() == ['Факультет_А.csv', 'Факультет_Б.csv', 'Пустой.csv']
+        assert summary['Строк'].tolist() == [300, 200, 0]
+        assert summary.loc[0, 'Ошибка'] == ''
+        assert 'Отсутствует обязательный столбец' in summary.loc[2, 'Ошибка']
+
+        with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+            assert sorted(zf.namelist()) == ['Результат_Факультет_А.xlsx', 'Результат_Факультет_Б.xlsx', 'Сводка.xlsx']
+            result_a = pd.read_excel(io.BytesIO(zf.read('Результат_Факультет_А.xlsx')))
+
+        expected_a = process_grade_recalculation(df_a, use_dynamics=False)
+        pd.testing.assert_frame_equal(result_a, expected_a, check_dtype=False)
+        assert summary.loc[0, 'Перезачтено ДПР_итог'] == expected_a['ДПР_итог'].notna().sum()
+
+    def test_empty_batch_raises(self):
+        with pytest.raises(ValueError):
+            process_grade_recalculation_batch([], use_dynamics=False)
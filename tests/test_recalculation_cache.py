@@ -0,0 +1,63 @@
+"""
+Тесты для logic/recalculation_cache.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from logic.grade_recalculation import process_grade_recalculation
+from logic.recalculation_cache import RecalculationCache, process_grade_recalculation_cached, row_fingerprints
+from benchmarks.generators import make_recalculation_frame
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return RecalculationCache(path=str(tmp_path / 'cache.sqlite3'))
+
+
+def test_second_run_served_from_cache(cache):
+    df = make_recalculation_frame(500, 20)
+    expected = process_grade_recalculation(df, use_dynamics=True)
+
+    first, first_hits = process_grade_recalculation_cached(df, True, cache)
+    second, second_hits = process_grade_recalculation_cached(df, True, cache)
+
+    assert first_hits == 0
+    assert second_hits == len(df)
+    pd.testing.assert_frame_equal(first, expected, check_dtype=False)
+    pd.testing.assert_frame_equal(second, expected, check_dtype=False)
+
+
+def test_only_edited_rows_recomputed(cache):
+    df = make_recalculation_frame(300, 21, nan_share=0.0)
+    process_grade_recalculation_cached(df, False, cache)
+
+    edited = df.copy()
+    edited.loc[[3, 50, 120], 'Оценка НЭ'] = (edited.loc[[3, 50, 120], 'Оценка НЭ'] + 1) % 11
+    result, hits = process_grade_recalculation_cached(edited, False, cache)
+
+    assert hits == len(df) - 3
+    pd.testing.assert_frame_equal(result, process_grade_recalculation(edited, use_dynamics=False), check_dtype=False)
+
+
+def test_use_dynamics_changes_fingerprint(cache):
+    df = make_recalculation_frame(100, 22)
+    process_grade_recalculation_cached(df, False, cache)
+    _, hits = process_grade_recalculation_cached(df, True, cache)
+    assert hits == 0
+
+
+def test_int_and_float_grades_share_fingerprint():
+    df = make_recalculation_frame(50, 23, nan_share=0.0)
+    as_int = df.copy()
+    for col in df.select_dtypes('number').columns:
+        as_int[col] = as_int[col].astype(int)
+    params = {'use_dynamics': False}
+    assert np.array_equal(row_fingerprints(df, params), row_fingerprints(as_int, params))
+
+
+def test_cache_is_bounded(tmp_path):
+    small_cache = RecalculationCache(path=str(tmp_path / 'small.sqlite3'), max_entries=100)
+    process_grade_recalculation_cached(make_recalculation_frame(300, 24), False, small_cache)
+    fingerprints = np.arange(1000, dtype=np.int64)
+    small_cache.put_many(fingerprints, np.zeros(1000), np.full(1000, np.nan))
+    assert len(small_cache.get_many(fingerprints)) <= 100
@@ -42,3 +42,42 @@ def test_load_student_list_file_unsupported_format():
     mock_file = MockUploadedFile("test.txt", b"some text")
     with pytest.raises(ValueError, match="Неподдерживаемый формат файла"):
         load_student_list_file(mock_file)
+
+def test_load_students_requests_only_given_columns(mocker):
+    import utils
+    from benchmarks.fake_supabase import FakeSupabaseClient
+    from logic.student_management import load_students_from_supabase
+    students = pd.DataFrame({
+        'корпоративная_почта': ['a@edu.hse.ru', 'b@edu.hse.ru'],
+        'фио': ['Иванов Иван', 'Петров Петр'],
+        'курс': ['Курс 2', 'Курс 3'],
+        'уровень_образования': ['Бакалавриат', 'Бакалавриат'],
+    })
+    mocker.patch.object(utils, 'get_supabase_client', return_value=FakeSupabaseClient({'students': students}))
+
+    result_df = load_students_from_supabase(filters={'курс': 'Курс 2'}, columns=['Адрес электронной почты', 'ФИО'])
+
+    assert list(result_df.columns) == ['Адрес электронной почты', 'ФИО']
+    assert result_df.iloc[0]['ФИО'] == 'Иванов Иван'
+
+
+def test_load_students_normalized_email_from_key(mocker):
+    import utils
+    from benchmarks.fake_supabase import FakeSupabaseClient, email_key
+    from logic.student_management import load_students_from_supabase
+    students = pd.DataFrame({
+        'корпоративная_почта': [' A@Edu.hse.ru', 'b@edu.hse.ru'],
+        'курс': ['Курс 2', 'Курс 3'],
+    })
+    client = FakeSupabaseClient(
+        {'students': students}, generated={'students': {'email_key': email_key('корпоративная_почта')}}
+    )
+    mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+
+    normalized = load_students_from_supabase(normalize_email=True)
+    raw = load_students_from_supabase()
+
+    assert normalized['Адрес электронной почты'].tolist() == ['a@edu.hse.ru', 'b@edu.hse.ru']
+    # Без нормализации почта как в БД, служебная колонка не попадает в результат
+    assert raw['Адрес электронной почты'].tolist() == [' A@Edu.hse.ru', 'b@edu.hse.ru']
+    assert 'email_key' not in raw.columns and 'email_key' not in normalized.columns
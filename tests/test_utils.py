@@ -0,0 +1,281 @@
+"""
+Тесты для utils.py: загрузка и пакетирование запросов к Supabase
+"""
+import threading
+import pandas as pd
+import pytest
+import constants
+import utils
+from benchmarks.fake_supabase import FakeSupabaseClient, email_key
+
+
+def make_table(n):
+    return pd.DataFrame({
+        'id': range(1, n + 1),
+        constants.COL_EMAIL: [f's{i}@edu.hse.ru' for i in range(n)],
+        'created_at': [f'2025-01-{1 + i % 28:02d}' for i in range(n)],
+    })
+
+
+class ShrinkingClient(FakeSupabaseClient):
+    """Клиент, из таблицы которого после первой страницы удаляются начальные строки."""
+
+    def _execute(self, query):
+        response = super()._execute(query)
+        if len(self.requests) == 1:
+            table = self.tables[query.table_name]
+            self.tables[query.table_name] = table.iloc[10:].reset_index(drop=True)
+        return response
+
+
+@pytest.fixture
+def patch_client(mocker):
+    def patch(client):
+        mocker.patch.object(utils, 'get_supabase_client', return_value=client)
+        return client
+    return patch
+
+
+@pytest.mark.parametrize('pagination', ['keyset', 'offset'])
+def test_modes_return_whole_table(patch_client, pagination):
+    client = patch_client(FakeSupabaseClient({constants.DB_TABLE_PERESDACHI: make_table(2500)}))
+
+    rows = utils.fetch_all_from_supabase(constants.DB_TABLE_PERESDACHI, page_size=1000, pagination=pagination)
+
+    assert [row['id'] for row in rows] == list(range(1, 2501))
+    assert len(client.requests) == 3
+
+
+def test_keyset_is_default_for_serial_tables(patch_client):
+    patch_client(ShrinkingClient({constants.DB_TABLE_PERESDACHI: make_table(2500)}))
+
+    rows = utils.fetch_all_from_supabase(constants.DB_TABLE_PERESDACHI, page_size=1000)
+
+    # Удаление уже прочитанных строк не сдвигает следующие страницы
+    assert [row['id'] for row in rows] == list(range(1, 2501))
+
+
+def test_offset_skips_rows_when_table_shrinks(patch_client):
+    patch_client(ShrinkingClient({constants.DB_TABLE_PERESDACHI: make_table(2500)}))
+
+    rows = utils.fetch_all_from_supabase(constants.DB_TABLE_PERESDACHI, page_size=1000, pagination='offset')
+
+    assert len(rows) == 2490
+
+
+def test_keyset_strips_key_not_requested(patch_client):
+    patch_client(FakeSupabaseClient({constants.DB_TABLE_PERESDACHI: make_table(1500)}))
+
+    rows = utils.fetch_all_from_supabase(
+        constants.DB_TABLE_PERESDACHI, select_query=f'"{constants.COL_EMAIL}"', page_size=1000
+    )
+
+    assert len(rows) == 1500
+    assert list(rows[0]) == [constants.COL_EMAIL]
+
+
+def test_conditions_are_applied(patch_client):
+    patch_client(FakeSupabaseClient({constants.DB_TABLE_PERESDACHI: make_table(2800)}))
+
+    rows = utils.fetch_all_from_supabase(
+        constants.DB_TABLE_PERESDACHI,
+        conditions=[('gte', 'created_at', '2025-01-05'), ('lt', 'created_at', '2025-01-08')],
+        page_size=100
+    )
+
+    assert len(rows) == 300
+    assert {row['created_at'] for row in rows} == {'2025-01-05', '2025-01-06', '2025-01-07'}
+
+
+def test_keyset_requires_key(patch_client):
+    patch_client(FakeSupabaseClient({constants.DB_TABLE_STUDENT_IO: make_table(10)}))
+
+    with pytest.raises(ValueError):
+        utils.fetch_all_from_supabase(constants.DB_TABLE_STUDENT_IO, pagination='keyset')
+
+
+# =====================================================================
+# Параллельная загрузка
+# =====================================================================
+
+class FlakyClient(FakeSupabaseClient):
+    """Клиент, у которого запрос страницы с заданным смещением падает failures раз."""
+
+    def __init__(self, tables, failing_offset, failures):
+        super().__init__(tables)
+        self.failing_offset = failing_offset
+        self.failures = failures
+
+    def _execute(self, query):
+        if query.count_mode is None and query.offset == self.failing_offset and self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('timeout')
+        return super()._execute(query)
+
+
+def make_students(n):
+    return pd.DataFrame({
+        'корпоративная_почта': [f's{i:05d}@edu.hse.ru' for i in range(n)][::-1],
+        'курс': ['Курс 1', 'Курс 2'] * (n // 2),
+    })
+
+
+@pytest.fixture
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(utils, 'FETCH_RETRY_DELAY', 0)
+
+
+def test_parallel_returns_pages_in_key_order(patch_client):
+    patch_client(FakeSupabaseClient({constants.DB_TABLE_STUDENTS: make_students(5000)}))
+
+    rows = utils.fetch_all_from_supabase(constants.DB_TABLE_STUDENTS, page_size=500, pagination='parallel')
+
+    emails = [row['корпоративная_почта'] for row in rows]
+    assert len(emails) == 5000
+    assert emails == sorted(emails)
+
+
+def test_parallel_counts_with_filters(patch_client):
+    client = patch_client(FakeSupabaseClient({constants.DB_TABLE_STUDENTS: make_students(3000)}))
+
+    rows = utils.fetch_all_from_supabase(
+        constants.DB_TABLE_STUDENTS, filters={'курс': 'Курс 2'}, page_size=500, pagination='parallel'
+    )
+
+    assert len(rows) == 1500
+    # Один запрос количества и три страницы
+    assert len(client.requests) == 4
+
+
+def test_parallel_uses_client_per_thread(mocker):
+    tables = {constants.DB_TABLE_STUDENTS: make_students(20000)}
+    mocker.patch.object(utils, 'get_supabase_client', return_value=FakeSupabaseClient(tables))
+    mocker.patch.object(utils, 'create_supabase_client', side_effect=lambda: FakeSupabaseClient(tables))
+    seen = {}
+    lock = threading.Lock()
+    # Все потоки пула заняты одновременно, поэтому каждый создает клиент
+    barrier = threading.Barrier(constants.FETCH_MAX_WORKERS, timeout=5)
+
+    def record(client, item):
+        barrier.wait()
+        with lock:
+            seen.setdefault(threading.get_ident(), set()).add(id(client))
+        return client.table(constants.DB_TABLE_STUDENTS).select('*').limit(1).execute().data
+
+    utils.map_concurrently(record, list(range(constants.FETCH_MAX_WORKERS)))
+
+    clients = [client for thread_clients in seen.values() for client in thread_clients]
+    assert len(seen) == constants.FETCH_MAX_WORKERS
+    # Один клиент на поток, у разных потоков — разные клиенты
+    assert len(clients) == len(set(clients)) == constants.FETCH_MAX_WORKERS
+    assert id(utils.get_supabase_client()) not in clients
+
+
+def test_parallel_retries_failed_page(patch_client, no_retry_delay):
+    client = patch_client(FlakyClient({constants.DB_TABLE_STUDENTS: make_students(3000)}, failing_offset=1000, failures=2))
+
+    rows = utils.fetch_all_from_supabase(constants.DB_TABLE_STUDENTS, page_size=1000, pagination='parallel')
+
+    assert len(rows) == 3000
+    # Повторена только упавшая страница
+    assert len(client.requests) == 4
+
+
+def test_parallel_raises_after_retries(patch_client, no_retry_delay):
+    patch_client(FlakyClient(
+        {constants.DB_TABLE_STUDENTS: make_students(3000)}, failing_offset=2000, failures=constants.FETCH_PAGE_RETRIES
+    ))
+
+    with pytest.raises(ConnectionError):
+        utils.fetch_all_from_supabase(constants.DB_TABLE_STUDENTS, page_size=1000, pagination='parallel')
+
+
+def test_parallel_empty_table(patch_client):
+    patch_client(FakeSupabaseClient({constants.DB_TABLE_STUDENTS: make_students(0)}))
+
+    assert utils.fetch_all_from_supabase(constants.DB_TABLE_STUDENTS, pagination='parallel') == []
+
+
+def test_payload_batches_respect_rows_and_bytes():
+    records = [{'email': f's{i}@edu.hse.ru', 'comment': 'x' * (500 if i == 5 else 10)} for i in range(10)]
+
+    by_rows = list(utils.iter_payload_batches(records, max_rows=4, max_bytes=1_000_000))
+    by_bytes = list(utils.iter_payload_batches(records, max_rows=100, max_bytes=200))
+
+    assert [len(batch) for batch in by_rows] == [4, 4, 2]
+    assert [record for batch in by_bytes for record in batch] == records
+    # Большая запись уходит отдельным пакетом
+    assert [records[5]] in by_bytes
+
+
+def test_run_in_background_returns_result_and_error():
+    assert utils.run_in_background(sum, [1, 2, 3]).result() == 6
+
+    future = utils.run_in_background(int, 'не число')
+    with pytest.raises(ValueError):
+        future.result()
+
+
+def test_run_in_background_attaches_script_context(mocker):
+    attach = mocker.patch.object(utils, 'add_script_run_ctx')
+
+    thread = utils.run_in_background(threading.current_thread).result()
+
+    # Контекст скрипта передается потоку задачи до его запуска
+    assert thread is not threading.current_thread()
+    attach.assert_called_once_with(thread)
+
+
+# =====================================================================
+# Нормализованный email (email_key)
+# =====================================================================
+
+def make_dirty_table(n):
+    table = make_table(n)
+    table[constants.COL_EMAIL] = [f' S{i}@Edu.hse.ru' for i in range(n)]
+    return table
+
+
+def keyed_client(table):
+    return FakeSupabaseClient(
+        {constants.DB_TABLE_PERESDACHI: table},
+        generated={constants.DB_TABLE_PERESDACHI: {constants.EMAIL_KEY_COLUMN: email_key(constants.COL_EMAIL)}}
+    )
+
+
+@pytest.mark.parametrize('columns', [None, [constants.COL_EMAIL, 'created_at']])
+def test_email_key_reads_and_filters_normalized_email(patch_client, columns):
+    client = patch_client(keyed_client(make_dirty_table(1500)))
+
+    rows = utils.fetch_all_from_supabase(
+        constants.DB_TABLE_PERESDACHI, filters={constants.COL_EMAIL: ['s3@edu.hse.ru', 's1200@edu.hse.ru']},
+        columns=columns, email_key=constants.COL_EMAIL
+    )
+
+    assert [row[constants.COL_EMAIL] for row in rows] == ['s3@edu.hse.ru', 's1200@edu.hse.ru']
+    assert all(constants.EMAIL_KEY_COLUMN not in row for row in rows)
+    assert len(client.requests) == 1
+
+
+def test_email_key_falls_back_without_migration(patch_client):
+    client = patch_client(FakeSupabaseClient({constants.DB_TABLE_PERESDACHI: make_dirty_table(1500)}))
+
+    for _ in range(2):
+        rows = utils.fetch_all_from_supabase(
+            constants.DB_TABLE_PERESDACHI, columns=[constants.COL_EMAIL], page_size=1000, email_key=constants.COL_EMAIL
+        )
+        assert len(rows) == 1500 and rows[0][constants.COL_EMAIL] == 's0@edu.hse.ru'
+
+    # Отсутствие колонки выясняется один раз для клиента: две загрузки по две страницы
+    assert len(client.requests) == 4
+
+
+def test_email_key_other_errors_are_raised(patch_client):
+    class BrokenClient(FakeSupabaseClient):
+        def _execute(self, query):
+            raise ConnectionError('timeout')
+
+    patch_client(BrokenClient({constants.DB_TABLE_PERESDACHI: make_dirty_table(10)}))
+
+    with pytest.raises(ConnectionError):
+        utils.fetch_all_from_supabase(constants.DB_TABLE_PERESDACHI, email_key=constants.COL_EMAIL)
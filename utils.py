@@ -5,6 +5,12 @@ DataCulture Platform - Shared Utilities
 
 import streamlit as st
 import os
+import json
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 from supabase import create_client, Client
 from openai import OpenAI
 import requests
@@ -13,13 +19,100 @@ from streamlit_lottie import st_lottie
 # =============================================================================
 # КОНСТАНТЫ
 # =============================================================================
-from constants import LOGO_URL
+from constants import (
+    LOGO_URL, KEYSET_PAGINATION_KEYS, PAGINATION_ORDER_KEYS,
+    FETCH_MAX_WORKERS, FETCH_PAGE_RETRIES, FETCH_RETRY_DELAY, PREFETCH_MAX_WORKERS, EMAIL_KEY_COLUMN
+)
 
 # =============================================================================
 # SUPABASE HELPERS
 # =============================================================================
 
-def fetch_all_from_supabase(table_name: str, select_query: str = "*", filters: dict = None, page_size: int = 1000) -> list:
+def build_select_query(columns: list = None) -> str:
+    """Строка select для PostgREST: только перечисленные колонки (в кавычках) или все."""
+    if not columns:
+        return "*"
+    return ", ".join(f'"{col}"' for col in columns)
+
+
+def _apply_filters(query, filters: dict = None, conditions: list = None):
+    """Применение фильтров fetch_all_from_supabase к запросу."""
+    if filters:
+        for key, value in filters.items():
+            if isinstance(value, (list, tuple)):
+                query = query.in_(key, value)
+            else:
+                query = query.eq(key, value)
+    for operator, column, value in conditions or []:
+        query = getattr(query, operator)(column, value)
+    return query
+
+
+# Таблицы без колонки email_key (миграция не применена) для каждой базы (общего клиента
+# get_supabase_client): повторно ключ у них не запрашивается. Запросы идут и из потоков
+# map_concurrently, поэтому обращения к реестру защищены блокировкой
+_tables_without_email_key = weakref.WeakKeyDictionary()
+_tables_without_email_key_lock = threading.Lock()
+
+
+def _is_missing_email_key(error: Exception) -> bool:
+    """Ошибка PostgREST/Postgres: колонки email_key в таблице нет (42703, PGRST204)."""
+    message = str(error)
+    return EMAIL_KEY_COLUMN in message and any(
+        marker in message for marker in ('42703', 'PGRST204', 'does not exist', 'Could not find')
+    )
+
+
+def has_email_key(table_name: str) -> bool:
+    """
+    Можно ли фильтровать таблицу по email_key: False, если для текущего клиента уже
+    выяснилось, что колонки нет (до первого запроса с email_key считается, что есть).
+    """
+    database = get_supabase_client()
+    with _tables_without_email_key_lock:
+        return table_name not in _tables_without_email_key.get(database, ())
+
+
+def _mark_without_email_key(table_name: str) -> None:
+    """Запомнить, что в таблице нет колонки email_key."""
+    database = get_supabase_client()
+    with _tables_without_email_key_lock:
+        _tables_without_email_key.setdefault(database, set()).add(table_name)
+
+
+def _use_email_key(select_query: str, filters: dict, conditions: list, email_column: str):
+    """
+    Запрос, в котором колонка email читается (алиас "email":email_key) и фильтруется
+    по сгенерированной колонке email_key (lower(btrim(email))).
+
+    Returns:
+        (select_query, filters, conditions)
+    """
+    parts = [part.strip() for part in select_query.split(',')]
+    select_query = ", ".join(
+        f'"{email_column}":{EMAIL_KEY_COLUMN}' if part.strip('"') == email_column else part for part in parts
+    )
+    filters = {EMAIL_KEY_COLUMN if key == email_column else key: value for key, value in (filters or {}).items()}
+    conditions = [
+        (operator, EMAIL_KEY_COLUMN if column == email_column else column, value)
+        for operator, column, value in conditions or []
+    ]
+    return select_query, filters, conditions
+
+
+def _normalize_email_rows(rows: list, email_column: str) -> list:
+    """Email в строках ответа: из email_key, если он пришел (select *), иначе нормализация здесь."""
+    for row in rows:
+        if EMAIL_KEY_COLUMN in row:
+            row[email_column] = row.pop(EMAIL_KEY_COLUMN)
+        elif isinstance(row.get(email_column), str):
+            row[email_column] = row[email_column].strip().lower()
+    return rows
+
+
+def fetch_all_from_supabase(table_name: str, select_query: str = "*", filters: dict = None, page_size: int = 1000,
+                            conditions: list = None, pagination: str = None, columns: list = None,
+                            email_key: str = None, client: Client = None) -> list:
     """
     Generic function to fetch all records from a Supabase table with pagination.
     
@@ -28,27 +121,83 @@ def fetch_all_from_supabase(table_name: str, select_query: str = "*", filters: d
         select_query: Columns to select (default "*")
         filters: Dictionary of filters to apply (e.g., {'курс': 'Курс 4'})
         page_size: Number of records per page
+        conditions: Additional filters as (operator, column, value) tuples,
+            e.g. [('gte', 'created_at', '2025-01-01')]
+        pagination: 'keyset' (order by key, key > last seen), 'offset' (range),
+            'parallel' (exact count, then concurrent range pages)
+            or None — keyset for tables listed in KEYSET_PAGINATION_KEYS
+        columns: Columns to fetch (overrides select_query); only these are sent over the wire
+        email_key: Email column to read and filter through the generated email_key column
+            (lower-cased and trimmed in the database, sql/migration_add_email_keys.sql);
+            without the migration the values are normalized here instead
+        client: Supabase client for the requests (e.g. the worker's client in map_concurrently);
+            defaults to get_supabase_client()
         
     Returns:
         List of all records
     """
-    supabase = get_supabase_client()
+    if columns:
+        select_query = build_select_query(columns)
+    if email_key:
+        if has_email_key(table_name):
+            keyed_select, keyed_filters, keyed_conditions = _use_email_key(
+                select_query, filters, conditions, email_key
+            )
+            try:
+                rows = _fetch_all(table_name, keyed_select, keyed_filters, page_size, keyed_conditions, pagination, client)
+            except Exception as e:
+                if not _is_missing_email_key(e):
+                    raise
+                _mark_without_email_key(table_name)
+            else:
+                return _normalize_email_rows(rows, email_key)
+        rows = _fetch_all(table_name, select_query, filters, page_size, conditions, pagination, client)
+        return _normalize_email_rows(rows, email_key)
+    return _fetch_all(table_name, select_query, filters, page_size, conditions, pagination, client)
+
+
+def _fetch_all(table_name: str, select_query: str, filters: dict, page_size: int, conditions: list,
+               pagination: str, client: Client = None) -> list:
+    """Постраничная загрузка для fetch_all_from_supabase."""
+    key_column = KEYSET_PAGINATION_KEYS.get(table_name)
+    if pagination is None:
+        pagination = 'keyset' if key_column else 'offset'
+    if pagination not in ('keyset', 'offset', 'parallel'):
+        raise ValueError(f"Неизвестный режим пагинации: {pagination}")
+    if pagination == 'keyset' and not key_column:
+        raise ValueError(f"Для таблицы {table_name} не задан ключ пагинации")
+    if pagination == 'parallel':
+        return _fetch_pages_parallel(table_name, select_query, filters, conditions, page_size, client)
+
+    # Ключ нужен в ответе, чтобы продолжить со следующей страницы;
+    # если его не запрашивали, он удаляется из результата
+    strip_key = False
+    if pagination == 'keyset' and select_query.strip() != "*":
+        requested = [part.strip().strip('"') for part in select_query.split(',')]
+        if key_column not in requested:
+            select_query = f'{select_query}, "{key_column}"'
+            strip_key = True
+
+    supabase = client or get_supabase_client()
     all_data = []
     offset = 0
+    last_key = None
     
     while True:
-        query = supabase.table(table_name).select(select_query)
-        
-        if filters:
-            for key, value in filters.items():
-                if isinstance(value, (list, tuple)):
-                    query = query.in_(key, value)
-                else:
-                    query = query.eq(key, value)
-                
-        response = query.range(offset, offset + page_size - 1).execute()
+        query = _apply_filters(supabase.table(table_name).select(select_query), filters, conditions)
+
+        if pagination == 'keyset':
+            if last_key is not None:
+                query = query.gt(key_column, last_key)
+            response = query.order(key_column).limit(page_size).execute()
+        else:
+            response = query.range(offset, offset + page_size - 1).execute()
         
         if response.data:
+            last_key = response.data[-1][key_column] if pagination == 'keyset' else None
+            if strip_key:
+                for row in response.data:
+                    del row[key_column]
             all_data.extend(response.data)
             if len(response.data) < page_size:
                 break
@@ -58,6 +207,123 @@ def fetch_all_from_supabase(table_name: str, select_query: str = "*", filters: d
             
     return all_data
 
+
+def map_concurrently(func, items: list, max_workers: int = FETCH_MAX_WORKERS, retries: int = FETCH_PAGE_RETRIES,
+                     retry_delay: float = None, return_exceptions: bool = False) -> list:
+    """
+    Параллельное выполнение func(client, item) для каждого элемента в пуле потоков.
+
+    Каждый поток создает свой клиент Supabase (create_supabase_client): общий клиент
+    get_supabase_client не делится между потоками. Упавший элемент повторяется до retries
+    раз с растущей задержкой, остальные элементы при этом не перезапускаются.
+
+    Args:
+        func: Функция (client, item) -> результат
+        items: Элементы (страницы, порции email, пакеты записей)
+        max_workers: Ограничение числа одновременных запросов
+        retries: Число попыток для одного элемента
+        retry_delay: Базовая задержка между попытками (по умолчанию FETCH_RETRY_DELAY)
+        return_exceptions: Вернуть исключение на месте результата вместо его выброса
+
+    Returns:
+        Результаты в порядке items
+    """
+    if not items:
+        return []
+    delay = FETCH_RETRY_DELAY if retry_delay is None else retry_delay
+    local = threading.local()
+
+    def run(item):
+        for attempt in range(1, retries + 1):
+            try:
+                if not hasattr(local, 'client'):
+                    local.client = create_supabase_client()
+                return func(local.client, item)
+            except Exception as e:
+                if attempt == retries:
+                    if return_exceptions:
+                        return e
+                    raise
+                time.sleep(delay * attempt)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(run, items))
+
+
+def _fetch_pages_parallel(table_name: str, select_query: str, filters: dict, conditions: list,
+                          page_size: int, client: Client = None) -> list:
+    """
+    Параллельная загрузка: точное число строк, затем страницы range(...) в пуле потоков.
+
+    Количество запрашивается клиентом вызова, страницы — клиентами потоков; страницы собираются
+    в исходном порядке (по уникальному ключу из PAGINATION_ORDER_KEYS, если он задан), а неудачная
+    страница повторяется до FETCH_PAGE_RETRIES раз без перезапуска всей выборки.
+    """
+    order_key = PAGINATION_ORDER_KEYS.get(table_name)
+    count_query = _apply_filters(
+        (client or get_supabase_client()).table(table_name).select(select_query, count='exact'), filters, conditions
+    )
+    total = count_query.limit(1).execute().count or 0
+    if total == 0:
+        return []
+
+    def fetch_page(client, start: int) -> list:
+        query = _apply_filters(client.table(table_name).select(select_query), filters, conditions)
+        if order_key:
+            query = query.order(order_key)
+        return query.range(start, start + page_size - 1).execute().data or []
+
+    pages = map_concurrently(fetch_page, list(range(0, total, page_size)))
+    return [row for page in pages for row in page]
+
+
+def iter_payload_batches(records: list, max_rows: int, max_bytes: int):
+    """
+    Разбиение записей на пакеты не больше max_rows строк и max_bytes байт JSON.
+
+    Запись, которая одна превышает max_bytes, отправляется отдельным пакетом.
+    """
+    batch, batch_bytes = [], 0
+    for record in records:
+        size = len(json.dumps(record, ensure_ascii=False, default=str).encode('utf-8')) + 1
+        if batch and (len(batch) >= max_rows or batch_bytes + size > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(record)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+# Ограничение числа одновременных фоновых задач процесса (общее для всех сессий Streamlit)
+_background_slots = threading.BoundedSemaphore(PREFETCH_MAX_WORKERS)
+
+def run_in_background(func, *args, **kwargs) -> Future:
+    """
+    Запуск func(*args, **kwargs) в фоновом потоке.
+
+    Поток получает ScriptRunContext вызывающего скрипта, поэтому st.cache_resource,
+    st.cache_data и st.secrets работают в нем так же, как в скрипте страницы.
+    Одновременно выполняется не больше PREFETCH_MAX_WORKERS задач.
+
+    Returns:
+        Future: result() дожидается завершения и выбрасывает исключение func, если оно было
+    """
+    future = Future()
+
+    def run():
+        with _background_slots:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    thread = threading.Thread(target=run, name='prefetch', daemon=True)
+    add_script_run_ctx(thread)
+    thread.start()
+    return future
+
 # =============================================================================
 # LUCIDE SVG ИКОНКИ
 # =============================================================================
@@ -227,13 +493,17 @@ def apply_custom_css():
 # SUPABASE CLIENT
 # =============================================================================
 
-@st.cache_resource
-def get_supabase_client() -> Client:
-    """Получить клиент Supabase"""
+def create_supabase_client() -> Client:
+    """Создать новый клиент Supabase (без кэша) — для потоков пула map_concurrently"""
     if "url" not in st.secrets or "key" not in st.secrets:
         raise ValueError("Supabase URL и KEY не найдены в secrets.toml")
     return create_client(st.secrets["url"], st.secrets["key"])
 
+@st.cache_resource
+def get_supabase_client() -> Client:
+    """Получить клиент Supabase"""
+    return create_supabase_client()
+
 # =============================================================================
 # NEBIUS AI CLIENT
 # =============================================================================